@@ -0,0 +1,93 @@
+WINNERS_CONSOLATION_LADDER = 'WINNERS_CONSOLATION_LADDER'
+LOSERS_CONSOLATION_LADDER = 'LOSERS_CONSOLATION_LADDER'
+
+# What kind of week a week is, as far as the playoffs go; see SeasonBracket.round
+class PlayoffRound:
+    __slots__ = ('week', 'is_playoff', 'is_round_one', 'is_round_two', 'is_round_three', 'is_quarterfinals',
+        'is_semifinals', 'is_finals', 'is_consolation_finals', 'is_consolation_over')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+# The shape of a season's playoffs, worked out from the league settings once (it's part of the league
+# snapshot, see espn.py) instead of by everything that needs to know whether a week is the finals.
+#
+# It also knows which consolation ladder games count for a week: ESPN keeps scheduling games for
+# teams that are out of it (like the 5th place game), and those shouldn't show up on the scoreboard
+# or the prediction form. A game counts if both teams are in that week's set for its ladder, so
+# checking a box score is a lookup instead of a walk through both teams' outcomes.
+class SeasonBracket:
+    def __init__(self, settings, teams):
+        self.last_week_of_regular_season = settings.reg_season_count
+        self.number_of_teams = settings.team_count
+        self.number_of_playoff_teams = settings.playoff_team_count
+        self.teams = teams
+        self.rounds = {}
+        self.eligible_teams = {}
+
+    def round(self, week):
+        week = int(week)
+        if week not in self.rounds:
+            last_week_of_regular_season = self.last_week_of_regular_season
+            has_quarterfinals = self.number_of_playoff_teams > 4
+
+            is_round_one = last_week_of_regular_season + 1 == week
+            is_round_two = last_week_of_regular_season + 2 == week
+            is_round_three = last_week_of_regular_season + 3 == week
+            is_semifinals = is_round_two if has_quarterfinals else is_round_one
+            is_finals = is_round_three if has_quarterfinals else is_round_two
+            # smaller leagues with a big playoff run out of consolation teams a round early
+            is_consolation_finals = is_semifinals if (self.number_of_teams < 12 and has_quarterfinals) else is_finals
+
+            self.rounds[week] = PlayoffRound(
+                week=week,
+                is_playoff=week > last_week_of_regular_season,
+                is_round_one=is_round_one,
+                is_round_two=is_round_two,
+                is_round_three=is_round_three,
+                is_quarterfinals=has_quarterfinals and is_round_one,
+                is_semifinals=is_semifinals,
+                is_finals=is_finals,
+                is_consolation_finals=is_consolation_finals,
+                is_consolation_over=is_round_three and not is_consolation_finals,
+            )
+        return self.rounds[week]
+
+    # team IDs that can still play a game that counts on each consolation ladder this week
+    def eligible(self, week):
+        week = int(week)
+        if week not in self.eligible_teams:
+            playoff_round = self.round(week)
+            # outcomes are indexed from 0, so round one is the week after the regular season
+            round_one_winners = self.winners_of(self.last_week_of_regular_season)
+            round_two_winners = self.winners_of(self.last_week_of_regular_season + 1)
+            all_teams = { t.team_id for t in self.teams }
+
+            # only the third place game counts, and that's between the two teams that lost in round two
+            winners_ladder = all_teams - round_two_winners if playoff_round.is_round_three else set()
+
+            # anyone who's won a consolation game is out of the running for last place
+            losers_ladder = set()
+            if not playoff_round.is_consolation_over:
+                losers_ladder = set(all_teams)
+                if playoff_round.is_round_three:
+                    losers_ladder -= round_two_winners
+                if not playoff_round.is_round_one:
+                    losers_ladder -= round_one_winners
+
+            self.eligible_teams[week] = {
+                WINNERS_CONSOLATION_LADDER: frozenset(winners_ladder),
+                LOSERS_CONSOLATION_LADDER: frozenset(losers_ladder),
+            }
+        return self.eligible_teams[week]
+
+    def winners_of(self, index):
+        return { t.team_id for t in self.teams if index < len(t.outcomes) and t.outcomes[index] == 'W' }
+
+    # whether a box score (with a team on both sides) belongs on the scoreboard and the prediction form
+    def counts(self, box_score, week):
+        eligible = self.eligible(week).get(box_score.matchup_type)
+        if eligible is None:
+            return True
+        return box_score.home_team.team_id in eligible and box_score.away_team.team_id in eligible
@@ -0,0 +1,56 @@
+import time
+from pymongo import UpdateOne
+
+# Every endpoint that saves more than one thing used to make a round trip to the database per
+# record; on Atlas that adds up. This collects an endpoint's writes and sends them in one go:
+#
+#   with BulkWriter(app, mongo.db.prediction_standings) as writer:
+#       for username, total in totals.items():
+#           writer.upsert({ 'username': username, ... }, { 'total': total })
+#
+# The writes are sent when the with block ends (unless it raised), or whenever flush() is called.
+# They're unordered, so one bad write doesn't stop the rest, and Mongo is free to run them in parallel.
+class BulkWriter:
+    def __init__(self, app, collection):
+        self.app = app
+        self.collection = collection
+        self.requests = []
+        # what the last flush did, see flush()
+        self.summary = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        if error_type is None:
+            self.flush()
+
+    # guarantees one record matching filter, with fields set on it
+    def upsert(self, filter, fields):
+        self.requests.append(UpdateOne(filter, { '$set': fields }, upsert=True))
+
+    # for anything that isn't a plain upsert, any pymongo write (UpdateOne, DeleteMany, etc.)
+    def add(self, request):
+        self.requests.append(request)
+
+    def flush(self):
+        requests, self.requests = self.requests, []
+        started = time.perf_counter()
+        if requests:
+            result = self.collection.bulk_write(requests, ordered=False)
+            matched, modified, upserted = result.matched_count, result.modified_count, result.upserted_count
+        else:
+            matched, modified, upserted = 0, 0, 0
+
+        self.summary = {
+            'collection': self.collection.name,
+            'requests': len(requests),
+            'matched': matched,
+            'modified': modified,
+            'upserted': upserted,
+            'seconds': round(time.perf_counter() - started, 3),
+        }
+        if requests:
+            self.app.logger.info('bulk write collection=%s requests=%d matched=%d modified=%d upserted=%d seconds=%.3f',
+                self.summary['collection'], len(requests), matched, modified, upserted, self.summary['seconds'])
+        return self.summary
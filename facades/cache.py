@@ -0,0 +1,137 @@
+import threading
+from datetime import datetime
+
+# Under threaded workers, a burst of requests on a cold (or just invalidated) cache would all run
+# the same Mongo query or ESPN load at once. With this, the first caller does the load and
+# everyone else who asks for the same key in the meantime waits for it and gets the same answer.
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, load):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = InFlightCall()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = load()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.value
+
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+# Drop-in for functools.cached_property that loads through SingleFlight. Like cached_property,
+# the value lives in the instance's __dict__, so reading a loaded value costs nothing extra.
+# Always clear these with invalidate() below, not by deleting from __dict__ by hand, so a load
+# that was already running when the cache was cleared can't put its stale value back.
+class single_flight_property:
+    def __init__(self, load):
+        self.load = load
+        self.name = load.__name__
+        self.__doc__ = load.__doc__
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        state = cache_state(instance)
+        return state.single_flight.do(self.name, lambda: self.load_and_store(instance, state))
+
+    def load_and_store(self, instance, state):
+        # someone else may have finished loading while we waited for our turn
+        if self.name in instance.__dict__:
+            return instance.__dict__[self.name]
+
+        generation = state.generations.get(self.name, 0)
+        value = self.load(instance)
+        with state.lock:
+            if state.generations.get(self.name, 0) == generation:
+                instance.__dict__[self.name] = value
+        return value
+
+# Same as single_flight_property, but the value also goes stale at a time of the caller's choosing:
+#
+#   @expiring_single_flight_property(lambda self, value: value['end_of_week_time'])
+#   def matchup_data(self):
+#
+# The expiry function gets the freshly loaded value and returns when it stops being good.
+# Unlike the plain version this checks the clock on every read, so only use it where that matters.
+class expiring_single_flight_property(single_flight_property):
+    def __init__(self, expires_at):
+        self.expires_at = expires_at
+
+    def __call__(self, load):
+        super().__init__(load)
+        return self
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        state = cache_state(instance)
+        if self.name in instance.__dict__ and datetime.now() < state.expirations.get(self.name, datetime.max):
+            return instance.__dict__[self.name]
+        return state.single_flight.do(self.name, lambda: self.load_and_store(instance, state))
+
+    # having __set__ makes this a data descriptor, so reads always go through __get__ (and the clock)
+    def __set__(self, instance, value):
+        raise AttributeError(self.name + ' is loaded from the database and cannot be set')
+
+    def load_and_store(self, instance, state):
+        if self.name in instance.__dict__ and datetime.now() < state.expirations.get(self.name, datetime.max):
+            return instance.__dict__[self.name]
+
+        generation = state.generations.get(self.name, 0)
+        value = self.load(instance)
+        expires_at = self.expires_at(instance, value)
+        with state.lock:
+            if state.generations.get(self.name, 0) == generation:
+                instance.__dict__[self.name] = value
+                state.expirations[self.name] = expires_at
+        return value
+
+class CacheState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.single_flight = SingleFlight()
+        # bumped every time a name is invalidated, so in-flight loads know their value is stale
+        self.generations = {}
+        # when each expiring value goes stale, see expiring_single_flight_property
+        self.expirations = {}
+
+CACHE_STATE_LOCK = threading.Lock()
+
+def cache_state(instance):
+    state = instance.__dict__.get('_cache_state')
+    if state is None:
+        with CACHE_STATE_LOCK:
+            state = instance.__dict__.setdefault('_cache_state', CacheState())
+    return state
+
+# clears all of the named cached values at once
+def invalidate(instance, *names):
+    state = cache_state(instance)
+    with state.lock:
+        for name in names:
+            state.generations[name] = state.generations.get(name, 0) + 1
+            instance.__dict__.pop(name, None)
@@ -1,26 +1,214 @@
-from functools import cached_property
+import threading
+import time
+from datetime import datetime, timedelta
 from espn_api.football import League
+from facades.bracket import SeasonBracket
+from facades.cache import SingleFlight, single_flight_property, invalidate
 
 import os
 ESPN_SWID = os.environ.get('ESPN_SWID')
 ESPN_S2 = os.environ.get('ESPN_S2')
 
+# how long a copy of ESPN data is good for, when it can still change;
+# box scores for finished weeks never change, so those are kept forever
+LEAGUE_TTL = timedelta(minutes=15)
+CURRENT_WEEK_TTL = timedelta(seconds=60)
+
+# after this many ESPN failures in a row, stop asking for a while and live off the cache
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 60
+
+class EspnUnavailable(Exception):
+    pass
+
+# Keeps us from hammering ESPN while it's down (it's usually down when everyone's checking scores):
+# - closed: calls go through, and failures are counted
+# - open: calls fail right away, until the cooldown is up
+# - after the cooldown, one call is let through; if it works the breaker closes, if not it opens again
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cooldown_seconds=COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self.lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown_seconds
+
+    def call(self, fetch):
+        with self.lock:
+            if self.opened_at is not None:
+                if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                    raise EspnUnavailable('ESPN has failed ' + str(self.failures) + ' times in a row, waiting before trying again')
+                # half-open; let this one through, but keep everyone else out until we know how it went
+                self.opened_at = time.monotonic()
+
+        try:
+            result = fetch()
+        except Exception as e:
+            with self.lock:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.monotonic()
+            raise EspnUnavailable(str(e)) from e
+
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+# Building an espn_api League means several calls to ESPN, and box scores are another one per week,
+# so we keep a copy of just the parts we use in the espn_cache collection (shared by every worker).
+# These snapshot classes quack like the espn_api objects, so callers don't know the difference.
+class TeamSnapshot:
+    __slots__ = ('team_id', 'owners', 'wins', 'points_for', 'outcomes', 'scores', 'standing', 'final_standing')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    @classmethod
+    def from_team(cls, team):
+        return cls(
+            team_id=team.team_id,
+            # we only ever use the owner's ESPN ID
+            owners=[{ 'id': o['id'] } for o in team.owners],
+            wins=team.wins,
+            points_for=team.points_for,
+            outcomes=list(team.outcomes),
+            scores=list(team.scores),
+            standing=team.standing,
+            final_standing=team.final_standing,
+        )
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(**document)
+
+    def to_document(self):
+        return { name: getattr(self, name) for name in self.__slots__ }
+
+class BoxScoreSnapshot:
+    __slots__ = ('matchup_type', 'is_playoff', 'home_team', 'away_team',
+        'home_score', 'away_score', 'home_projected', 'away_projected')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    @classmethod
+    def from_box_score(cls, box_score):
+        return cls(
+            matchup_type=box_score.matchup_type,
+            is_playoff=box_score.is_playoff,
+            # ESPN uses 0 for the missing team on a bye week
+            home_team=TeamSnapshot.from_team(box_score.home_team) if box_score.home_team else 0,
+            away_team=TeamSnapshot.from_team(box_score.away_team) if box_score.away_team else 0,
+            home_score=box_score.home_score,
+            away_score=box_score.away_score,
+            home_projected=box_score.home_projected,
+            away_projected=box_score.away_projected,
+        )
+
+    @classmethod
+    def from_document(cls, document):
+        fields = dict(document)
+        for side in ('home_team', 'away_team'):
+            fields[side] = TeamSnapshot.from_document(fields[side]) if fields[side] else 0
+        return cls(**fields)
+
+    def to_document(self):
+        document = { name: getattr(self, name) for name in self.__slots__ }
+        for side in ('home_team', 'away_team'):
+            document[side] = document[side].to_document() if document[side] else 0
+        return document
+
+# box scores for a week, plus when we got them from ESPN
+class BoxScores(list):
+    def __init__(self, box_scores, fetched_at, is_final):
+        super().__init__(box_scores)
+        self.fetched_at = fetched_at
+        self.is_final = is_final
+
+class SettingsSnapshot:
+    __slots__ = ('reg_season_count', 'team_count', 'playoff_team_count')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            reg_season_count=settings.reg_season_count,
+            team_count=settings.team_count,
+            playoff_team_count=settings.playoff_team_count,
+        )
+
+    def to_document(self):
+        return { name: getattr(self, name) for name in self.__slots__ }
+
+# everything we use from the espn_api League itself, parsed once per copy we get from ESPN
+class LeagueSnapshot:
+    def __init__(self, document):
+        data = document['data']
+        self.fetched_at = document['fetched_at']
+        self.settings = SettingsSnapshot(**data['settings'])
+        self.teams = [TeamSnapshot.from_document(t) for t in data['teams']]
+        self.current_week = data['current_week']
+        # TODO - this should support co-owners
+        self.team_lookup_by_owner_id = { t.owners[0]['id']: t for t in self.teams if t.owners }
+        # which week is which playoff round, and which consolation games count, see bracket.py
+        self.bracket = SeasonBracket(self.settings, self.teams)
+
 class Espn:
-    def __init__(self, league_id, league_year):
+    def __init__(self, league_id, league_year, app, mongo):
         self.league_id = league_id
         self.league_year = league_year
+        self.app = app
+        self.mongo = mongo
+        self.breaker = CircuitBreaker()
+        # what we've read from espn_cache so far, keyed by (kind, week)
+        self.documents = {}
+        self.refreshing = set()
+        self.refreshing_lock = threading.Lock()
+        self.single_flight = SingleFlight()
 
-    @cached_property
+    # the real thing; only built when we actually have to go to ESPN
+    @single_flight_property
     def league(self):
         return League(league_id=int(self.league_id), year=int(self.league_year), espn_s2=ESPN_S2, swid=ESPN_SWID)
 
-    @cached_property
+    @property
+    def snapshot(self):
+        document = self.get_cached('league', None, self.fetch_league)
+        if 'parsed' not in document:
+            document['parsed'] = LeagueSnapshot(document)
+        return document['parsed']
+
+    @property
     def teams(self):
-        return self.league.teams
+        return self.snapshot.teams
 
-    @cached_property
+    @property
     def settings(self):
-        return self.league.settings
+        return self.snapshot.settings
+
+    @property
+    def bracket(self):
+        return self.snapshot.bracket
+
+    @property
+    def current_week(self):
+        return self.snapshot.current_week
+
+    # when our copy of the league was last fetched from ESPN
+    @property
+    def fetched_at(self):
+        return self.snapshot.fetched_at
 
     @property
     def weeks_in_regular_season(self):
@@ -34,13 +222,111 @@ class Espn:
     def number_of_playoff_teams(self):
         return self.settings.playoff_team_count
 
-    def invalidate_cached_year(self):
-        if "league" in self.__dict__:
-            del self.__dict__["league"]
-        if "teams" in self.__dict__:
-            del self.__dict__["teams"]
-        if "settings" in self.__dict__:
-            del self.__dict__["settings"]
+    # Only the worker that changed the year should clear the shared cache; the rest would just be
+    # throwing away the copies it (or they) already fetched again, and every one of them would go back
+    # to ESPN for the whole league.
+    def invalidate_cached_year(self, clear_shared_cache=False):
+        invalidate(self, 'league')
+        self.documents = {}
+        if not clear_shared_cache:
+            return
+        # finished weeks are still good, but anything that could have changed gets fetched again
+        with self.app.app_context():
+            self.mongo.db.espn_cache.delete_many({ 'league_id': self.league_id, 'year': self.league_year,
+                'expires_at': { '$ne': None } })
 
     def box_scores(self, week):
-        return self.league.box_scores(week)
+        return self.parse_box_scores(self.get_cached('box_scores', week, lambda: self.fetch_box_scores(week)))
+
+    # For when only the final scores will do, like closing out a week (see week_close.py): if the copy
+    # we have isn't final, ask ESPN again now, instead of refreshing in the background for next time.
+    def final_box_scores(self, week):
+        box_scores = self.box_scores(week)
+        if box_scores.is_final:
+            return box_scores
+        return self.parse_box_scores(self.refresh('box_scores', week, lambda: self.fetch_box_scores(week)))
+
+    def parse_box_scores(self, document):
+        return BoxScores([BoxScoreSnapshot.from_document(s) for s in document['data']],
+            document['fetched_at'], document['expires_at'] is None)
+
+    def fetch_league(self):
+        # start from scratch, or we'd just get the same League object back
+        invalidate(self, 'league')
+        league = self.league
+        return {
+            'settings': SettingsSnapshot.from_settings(league.settings).to_document(),
+            'teams': [TeamSnapshot.from_team(t).to_document() for t in league.teams],
+            'current_week': league.current_week,
+        }, LEAGUE_TTL
+
+    def fetch_box_scores(self, week):
+        league = self.league
+        box_scores = [BoxScoreSnapshot.from_box_score(s).to_document() for s in league.box_scores(week)]
+        # once ESPN has moved on to a later week, this one's final
+        is_week_over = week < league.current_week or week < league.nfl_week
+        return box_scores, None if is_week_over else CURRENT_WEEK_TTL
+
+    # Stale-while-revalidate: whatever copy we have is returned right away, even if it's expired,
+    # and an expired copy gets refreshed in the background for the next caller. We only make
+    # the caller wait on ESPN when we've never fetched this data at all.
+    def get_cached(self, kind, week, fetch):
+        key = (kind, week)
+        document = self.documents.get(key)
+        if document is None or self.is_expired(document):
+            document = self.read_cache(kind, week) or document
+
+        if document is None:
+            # everyone who shows up while we're waiting on ESPN gets the same copy
+            document = self.single_flight.do(key, lambda: self.documents.get(key) or self.refresh(kind, week, fetch))
+        elif self.is_expired(document):
+            self.refresh_in_background(kind, week, fetch)
+
+        self.documents[key] = document
+        return document
+
+    def refresh(self, kind, week, fetch):
+        data, ttl = self.breaker.call(fetch)
+        document = self.write_cache(kind, data, ttl, week)
+        self.documents[(kind, week)] = document
+        return document
+
+    def refresh_in_background(self, kind, week, fetch):
+        # no point trying while the breaker's open, we'd just fail fast anyway
+        if self.breaker.is_open:
+            return
+        key = (kind, week)
+        with self.refreshing_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(kind, week, fetch)
+            except EspnUnavailable as e:
+                self.app.logger.error('could not refresh ESPN %s for week %s, still serving the old copy: %s', kind, week, e)
+            finally:
+                with self.refreshing_lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, name='espn-refresh', daemon=True).start()
+
+    def is_expired(self, document):
+        return document['expires_at'] is not None and document['expires_at'] <= datetime.now()
+
+    def cache_key(self, kind, week=None):
+        return { 'league_id': self.league_id, 'year': self.league_year, 'kind': kind, 'week': week }
+
+    def read_cache(self, kind, week=None):
+        with self.app.app_context():
+            return self.mongo.db.espn_cache.find_one(self.cache_key(kind, week))
+
+    # ttl of None means it's good forever
+    def write_cache(self, kind, data, ttl, week=None):
+        now = datetime.now()
+        document = dict(self.cache_key(kind, week), data=data, fetched_at=now,
+            expires_at=now + ttl if ttl else None)
+        with self.app.app_context():
+            self.mongo.db.espn_cache.replace_one(self.cache_key(kind, week), document, upsert=True)
+        return document
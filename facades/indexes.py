@@ -0,0 +1,195 @@
+import threading
+from datetime import datetime
+from pymongo.errors import OperationFailure
+from facades.jobs import JOB_RETENTION
+
+# Every index the app's queries need, by collection. These are created (if they're missing) when a
+# worker boots, and with `flask ensure-indexes`; see the readme. Keys are in the same format as
+# pymongo's create_index, and options are passed along as-is.
+#
+# If you add a query, add its shape to query_shapes below too, so `flask check-indexes` can make
+# sure it's covered.
+INDEXES = {
+    'league_metadata': [
+        ([('year', -1)], { 'unique': True }),
+    ],
+    'matchup_metadata': [
+        ([('year', -1), ('week', -1)], { 'unique': True }),
+        # the current week, and the last week that's over, see Metadata.matchup_data/last_matchup_data
+        ([('year', 1), ('start_of_week_time', -1)], {}),
+        ([('year', 1), ('end_of_week_time', -1)], {}),
+    ],
+    'matchup_results': [
+        ([('year', -1), ('week', -1)], { 'unique': True }),
+    ],
+    'predictions': [
+        ([('username', 1), ('year', -1), ('week', -1)], { 'unique': True }),
+        # everyone's predictions for a week
+        ([('year', -1), ('week', -1)], {}),
+    ],
+    'prediction_standings': [
+        ([('username', 1), ('year', -1), ('week', -1)], { 'unique': True }),
+        # everyone's standings for a week, best first
+        ([('year', -1), ('week', -1), ('total', -1)], {}),
+    ],
+    'scores': [
+        ([('year', -1), ('week', -1)], { 'unique': True }),
+    ],
+    # if this is a view (it is on Atlas), these have to go on whatever it's a view of instead
+    'scores_per_matchup': [
+        # the championship, third place and Breckfast Bowl games, see season_summaries.py
+        ([('consolation', 1), ('championship', 1), ('third_place', 1)], {}),
+    ],
+    # one rule per first season it covers, see ensure_payout_rules in history.py
+    'payout_rules': [
+        ([('from_year', 1)], { 'unique': True }),
+    ],
+    'espn_cache': [
+        ([('league_id', 1), ('year', 1), ('kind', 1), ('week', 1)], { 'unique': True }),
+    ],
+    'jobs': [
+        # expires every job a while after it was queued, see facades/jobs.py
+        ([('queued_at', 1)], { 'expireAfterSeconds': int(JOB_RETENTION.total_seconds()) }),
+    ],
+    'slack_outbox': [
+        # see Outbox.claim, Outbox.deliver and Outbox.metrics
+        ([('status', 1), ('next_attempt_at', 1)], {}),
+        ([('status', 1), ('claimed_at', 1)], {}),
+        ([('coalesce_key', 1), ('status', 1)], {}),
+        ([('status', 1), ('queued_at', 1)], {}),
+        ([('status', 1), ('sent_at', -1)], {}),
+    ],
+}
+
+# A stand-in for every query the endpoints make, for explain() to check. The values don't matter,
+# just the shape; years and weeks are strings everywhere but scores (see scoreboard.py).
+def query_shapes():
+    now = datetime.now()
+    return [
+        ('latest league year', 'league_metadata', {}, [('year', -1)]),
+        ('league year', 'league_metadata', { 'year': '2023' }, None),
+        ('current week', 'matchup_metadata', { 'year': '2023', 'start_of_week_time': { '$lte': now } }, [('start_of_week_time', -1)]),
+        ('last week', 'matchup_metadata', { 'year': '2023', 'end_of_week_time': { '$lte': now } }, [('end_of_week_time', -1)]),
+        ('matchup result', 'matchup_results', { 'year': '2023', 'week': '1' }, None),
+        ('season of matchup results', 'matchup_results', { 'year': '2023' }, None),
+        ('prediction', 'predictions', { 'username': 'walker', 'year': '2023', 'week': '1' }, None),
+        ('week of predictions', 'predictions', { 'year': '2023', 'week': '1' }, None),
+        ('season of predictions', 'predictions', { 'year': '2023' }, None),
+        ('week of prediction standings', 'prediction_standings', { 'year': '2023', 'week': '1' }, [('total', -1)]),
+        ('season of prediction standings', 'prediction_standings', { 'year': '2023' }, None),
+        ('scores', 'scores', { 'year': 2023, 'week': 1 }, None),
+        ('season of scores so far', 'scores', { 'year': 2023, 'week': { '$lte': 5 },
+            '$or': [ { 'results': { '$exists': True } }, { 'playoffs': False } ] }, None),
+        ('championships', 'scores_per_matchup', { 'consolation': False, 'championship': True, 'third_place': False }, None),
+        ('third place games', 'scores_per_matchup', { 'consolation': False, 'championship': False, 'third_place': True }, None),
+        ('breckfast bowls', 'scores_per_matchup', { 'consolation': True, 'championship': True }, None),
+        ('season summaries', 'season_summaries', {}, [('_id', -1)]),
+        ('payout rule', 'payout_rules', { 'from_year': { '$lte': 2023 }, 'to_year': { '$gte': 2023 } }, [('from_year', -1)]),
+        ('head-to-head pairs', 'head_to_head', { '_id': { '$in': [ 'Joel|Walker' ] } }, None),
+        ('espn cache', 'espn_cache', { 'league_id': 1, 'year': 2023, 'kind': 'settings', 'week': None }, None),
+        ('outbox claim', 'slack_outbox', { '$or': [
+            { 'status': 'pending', 'next_attempt_at': { '$lte': now } },
+            { 'status': 'sending', 'claimed_at': { '$lte': now } },
+        ] }, [('next_attempt_at', 1)]),
+        ('outbox coalesce', 'slack_outbox', { 'coalesce_key': 'chat_update', 'status': 'pending' }, None),
+        ('outbox oldest pending', 'slack_outbox', { 'status': { '$in': [ 'pending', 'sending' ] } }, [('queued_at', 1)]),
+        ('outbox recently sent', 'slack_outbox', { 'status': 'sent' }, [('sent_at', -1)]),
+    ]
+
+# every stage in the plan(s) Mongo picked, however deep they're nested (plans nest differently across
+# Mongo versions, and for views); the plans it didn't pick, and how they ran, are left out
+def plan_stages(explain):
+    if isinstance(explain, list):
+        for item in explain:
+            yield from plan_stages(item)
+    elif isinstance(explain, dict):
+        if 'stage' in explain:
+            yield explain['stage']
+        for key, value in explain.items():
+            if key not in [ 'rejectedPlans', 'executionStats' ]:
+                yield from plan_stages(value)
+
+# Makes sure the indexes above exist, and that the queries above use them.
+class Indexes:
+    def __init__(self, app, mongo):
+        self.app = app
+        self.mongo = mongo
+        self.thread = None
+        self.lock = threading.Lock()
+
+    # safe to run as often as you like; an index that's already there (under any name) is left alone,
+    # and one that can't be built (duplicate data, say) is reported rather than stopping the rest
+    def ensure(self):
+        report = []
+        with self.app.app_context():
+            db = self.mongo.db
+            views = set(db.list_collection_names(filter={ 'type': 'view' }))
+            for collection_name, indexes in INDEXES.items():
+                if collection_name in views:
+                    report += [{ 'collection': collection_name, 'keys': keys, 'status': 'view' } for keys, options in indexes]
+                    continue
+
+                collection = db[collection_name]
+                # directions can come back as floats (1.0), or strings for special indexes ('text')
+                existing = [[(field, direction if isinstance(direction, str) else int(direction)) for field, direction in index['key']]
+                    for index in collection.index_information().values()]
+                for keys, options in indexes:
+                    result = { 'collection': collection_name, 'keys': keys }
+                    if keys in existing:
+                        result['status'] = 'exists'
+                    else:
+                        try:
+                            result['name'] = collection.create_index(keys, **options)
+                            result['status'] = 'created'
+                        except OperationFailure as e:
+                            result.update(status='error', error=str(e))
+                    report.append(result)
+
+        for result in report:
+            if result['status'] == 'created':
+                self.app.logger.info('created index collection=%s keys=%s', result['collection'], result['keys'])
+            elif result['status'] == 'view':
+                self.app.logger.warning('cannot index a view, index the collection behind it instead collection=%s keys=%s',
+                    result['collection'], result['keys'])
+            elif result['status'] == 'error':
+                self.app.logger.error('could not create index collection=%s keys=%s: %s',
+                    result['collection'], result['keys'], result['error'])
+        return report
+
+    # explain() every query shape, and flag any that scan the whole collection
+    def check_query_plans(self):
+        report = []
+        with self.app.app_context():
+            for name, collection_name, filter, sort in query_shapes():
+                cursor = self.mongo.db[collection_name].find(filter)
+                if sort:
+                    cursor = cursor.sort(sort)
+                stages = sorted(set(plan_stages(cursor.explain())))
+                report.append({
+                    'query': name,
+                    'collection': collection_name,
+                    'stages': stages,
+                    'collection_scan': 'COLLSCAN' in stages,
+                })
+
+        for result in report:
+            if result['collection_scan']:
+                self.app.logger.warning('query scans the whole collection query="%s" collection=%s',
+                    result['query'], result['collection'])
+        return report
+
+    # at boot, so a worker never waits on index builds before serving requests
+    def ensure_in_background(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.ensure_and_check, name='ensure-indexes', daemon=True)
+            self.thread.start()
+
+    def ensure_and_check(self):
+        try:
+            self.ensure()
+            self.check_query_plans()
+        except Exception as e:
+            # an index is an optimization; the app works (slower) without it
+            self.app.logger.error('could not ensure indexes: %s', e)
@@ -0,0 +1,93 @@
+import time
+import traceback
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import cached_property
+from flask import Response
+
+# the heavy commands mostly wait on ESPN and Mongo, so a couple of threads per worker is plenty
+MAX_CONCURRENT_JOBS = 2
+# how long a job's record is kept (queued, finished, or stuck), see the jobs TTL index in facades/indexes.py
+JOB_RETENTION = timedelta(days=30)
+
+# Slack only gives a slash command 3 seconds to respond, but a response_url stays good
+# for 30 minutes, so slow commands can answer right away and post their real output later:
+# https://api.slack.com/interactivity/handling#message_responses
+class Jobs:
+    def __init__(self, app, mongo, max_workers=MAX_CONCURRENT_JOBS):
+        self.app = app
+        self.mongo = mongo
+        self.max_workers = max_workers
+
+    @cached_property
+    def executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='jobs')
+
+    # form is the original Slack request form, so the job can see the same request.form
+    # the endpoint would have seen if it ran inside the request
+    def submit(self, name, response_url, form, func, *args, **kwargs):
+        queued_at = datetime.now()
+        with self.app.app_context():
+            job_id = self.mongo.db.jobs.insert_one({
+                'name': name,
+                'status': 'queued',
+                'text': form.get('text'),
+                'user_name': form.get('user_name'),
+                'queued_at': queued_at,
+            }).inserted_id
+
+        self.executor.submit(self.run, job_id, queued_at, response_url, form, func, args, kwargs)
+        return job_id
+
+    # args and kwargs are whatever the endpoint was called with, route variables included
+    def run(self, job_id, queued_at, response_url, form, func, args, kwargs):
+        started_at = datetime.now()
+        started = time.perf_counter()
+        # track how long jobs sit in the queue, in case the pool needs to grow
+        self.update_job(job_id, {
+            'status': 'running',
+            'started_at': started_at,
+            'queue_seconds': round((started_at - queued_at).total_seconds(), 3),
+        })
+
+        try:
+            with self.app.test_request_context(method='POST', data=form):
+                try:
+                    result = func(*args, **kwargs)
+                # give the app's error handlers (see __init__.py) a chance to turn this into a message;
+                # anything without a handler is raised again
+                except Exception as e:
+                    result = self.app.handle_user_exception(e)
+            payload = self.build_response_payload(result)
+            if payload:
+                requests.post(response_url, json=payload, timeout=10).raise_for_status()
+            status, error = 'succeeded', None
+        except Exception:
+            status, error = 'failed', traceback.format_exc()
+            self.app.logger.error('job %s failed: %s', job_id, error)
+            # let the person who ran the command know it didn't just disappear
+            try:
+                requests.post(response_url, json={ 'text': 'Sorry, something went wrong running that command.' }, timeout=10)
+            except Exception:
+                pass
+
+        self.update_job(job_id, {
+            'status': status,
+            'error': error,
+            'finished_at': datetime.now(),
+            'run_seconds': round(time.perf_counter() - started, 3),
+        })
+
+    def update_job(self, job_id, fields):
+        with self.app.app_context():
+            self.mongo.db.jobs.update_one({ '_id': job_id }, { '$set': fields })
+
+    # endpoints either return a message dict or a plain text Response (usually an error)
+    def build_response_payload(self, result):
+        if result is None:
+            return None
+        if isinstance(result, Response):
+            text = result.get_data(as_text=True)
+            return { 'text': text } if text else None
+        return result
@@ -1,14 +1,49 @@
 import pprint
-from functools import cached_property
+import threading
+from time import perf_counter
 from datetime import datetime, time, timedelta
+from facades.bulk import BulkWriter
+from facades.cache import single_flight_property, expiring_single_flight_property, invalidate
 from facades.espn import Espn
+from facades.players import PlayerRegistry
+
+# if a week has ended and the next week's schedule hasn't been set yet, check back this often
+WEEK_RECHECK_INTERVAL = timedelta(minutes=5)
+# how often each worker checks whether another worker invalidated the caches
+CACHE_VERSION_CHECK_INTERVAL = timedelta(seconds=5)
+# what can be invalidated across workers: the league year, the week, (whenever a season's finals
+# are saved) anything built from past seasons' results, and (whenever scores are saved) the standings
+CACHE_VERSION_SCOPES = [ 'year', 'week', 'finals', 'scores' ]
+
+# The week caches roll over on their own at the times stored with the week, so nobody has to
+# remember to hit /scoreboard/invalidate/week (and nobody has to invalidate them defensively).
+# matchup_data changes when the next week starts, which is when this one ends; the deadline
+# is when predictions lock, so refresh then too in case the schedule was touched up before it.
+def next_week_boundary(metadata, matchup):
+    now = datetime.now()
+    boundaries = [matchup['deadline_time'].replace(tzinfo=None), matchup['end_of_week_time'].replace(tzinfo=None)]
+    upcoming = [b for b in boundaries if b > now]
+    return min(upcoming) if upcoming else now + WEEK_RECHECK_INTERVAL
+
+# last_matchup_data changes when the current week ends
+def end_of_current_week(metadata, last_matchup):
+    now = datetime.now()
+    end_of_week_time = metadata.matchup_data['end_of_week_time'].replace(tzinfo=None)
+    return end_of_week_time if end_of_week_time > now else now + WEEK_RECHECK_INTERVAL
 
 class Metadata:
     def __init__(self, app, mongo):
         self.app = app
         self.mongo = mongo
-
-    @cached_property
+        self.warm_up_thread = None
+        self.warm_up_lock = threading.Lock()
+        self.last_warm_up = None
+        # the last cache_versions this worker has caught up to, see sync_cache_versions
+        self.cache_versions = None
+        self.cache_versions_checked_at = datetime.min
+        self.cache_versions_lock = threading.Lock()
+
+    @single_flight_property
     def league(self):
         # TODO - Find a way to fetch some of this through the ESPN API when teams are locked in
         # Might have to always manually link an ESPN user to their Slack user
@@ -35,46 +70,35 @@ class Metadata:
     def user_ids(self):
         return [m['slack_user_id'] for m in self.league['members']]
 
-    @cached_property
-    def players(self):
+    # see facades/players.py; every lookup below is built once per load
+    @single_flight_property
+    def player_registry(self):
         with self.app.app_context():
-            return list(self.mongo.db.player_metadata.find())
+            return PlayerRegistry(self.mongo.db.player_metadata.find())
+
+    @property
+    def players(self):
+        return self.player_registry.players
 
     @property
     def player_lookup_by_espn_name(self):
-        lookup = {}
-        for p in self.players:
-            if p['espn_owner_name']:
-                lookup[p['espn_owner_name']] = p
-        return lookup
+        return self.player_registry.by_espn_name
 
     @property
     def player_lookup_by_espn_owner_id(self):
-        lookup = {}
-        for p in self.players:
-            if p['espn_owner_id']:
-                lookup[p['espn_owner_id']] = p
-        return lookup
+        return self.player_registry.by_espn_owner_id
 
     @property
     def player_lookup_by_id(self):
-        lookup = {}
-        for p in self.players:
-            if p['player_id']:
-                lookup[p['player_id']] = p
-        return lookup
+        return self.player_registry.by_id
 
     @property
     def player_lookup_by_username(self):
-        lookup = {}
-        for p in self.players:
-            if p['slack_username']:
-                lookup[p['slack_username']] = p
-        return lookup
+        return self.player_registry.by_username
 
     # get the matchup data for the current week
     # IF IT DOESN'T EXIST FOR THIS WEEK, THIS API WILL COME TO A CRASHING HALT
-    @cached_property
+    @expiring_single_flight_property(next_week_boundary)
     def matchup_data(self):
         with self.app.app_context():
             matchup = self.mongo.db.matchup_metadata.find_one({ 'year': self.league_year,
@@ -111,7 +135,7 @@ class Metadata:
     def prediction_eligible_members(self):
         return [m['team_one'] for m in self.matchups] + [m['team_two'] for m in self.matchups]
 
-    @cached_property
+    @expiring_single_flight_property(end_of_current_week)
     def last_matchup_data(self):
         with self.app.app_context():
             last_matchup = self.mongo.db.matchup_metadata.find_one({ 'year': self.league_year,
@@ -124,39 +148,126 @@ class Metadata:
     def last_league_week(self):
         return self.last_matchup_data['week']
 
-    @cached_property
+    @single_flight_property
     def espn(self):
-        return Espn(self.league_id, self.league_year)
+        return Espn(self.league_id, self.league_year, self.app, self.mongo)
 
-    @cached_property
+    # built once per copy of the league we get from ESPN, see LeagueSnapshot in facades/espn.py
+    @property
     def team_lookup_by_espn_owner_id(self):
-        lookup = {}
-        # TODO - this should support co-owners
-        for t in self.espn.teams:
-            lookup[t.owners[0]['id']] = t
-        return lookup
-
-    def invalidate_cached_year(self):
-        if "league" in self.__dict__:
-            del self.__dict__["league"]
-        if "players" in self.__dict__:
-            del self.__dict__["players"]
-        if "player_lookup_by_espn_name" in self.__dict__:
-            del self.__dict__["player_lookup_by_espn_name"]
-        if "player_lookup_by_id" in self.__dict__:
-            del self.__dict__["player_lookup_by_id"]
-        if "player_lookup_by_username" in self.__dict__:
-            del self.__dict__["player_lookup_by_username"]
-        if "team_lookup_by_espn_owner_id" in self.__dict__:
-            del self.__dict__["team_lookup_by_espn_owner_id"]
-        self.espn.invalidate_cached_year()
-        self.invalidate_cached_week()
+        return self.espn.snapshot.team_lookup_by_owner_id
+
+    # The first request a worker handles shouldn't have to load everything from scratch, since it's
+    # usually a Slack button click with 3 seconds to answer. This loads every cache we can ahead of time.
+    def warm_up(self):
+        started = perf_counter()
+        error = None
+        try:
+            # anything invalidated from here on will be caught by the next check, see sync_cache_versions
+            self.sync_cache_versions()
+            self.league
+            self.player_registry
+            self.matchup_data
+            self.last_matchup_data
+            self.espn.snapshot
+            # whichever week the scoreboard is going to ask for
+            self.espn.box_scores(int(self.last_league_week))
+            self.espn.box_scores(int(self.league_week))
+        except Exception as e:
+            error = str(e)
+            self.app.logger.error('metadata warm up failed: %s', e)
+
+        self.last_warm_up = {
+            'finished_at': datetime.now(),
+            'seconds': round(perf_counter() - started, 3),
+            'error': error,
+        }
+
+    def warm_up_in_background(self):
+        with self.warm_up_lock:
+            if self.warm_up_thread and self.warm_up_thread.is_alive():
+                return
+            self.warm_up_thread = threading.Thread(target=self.warm_up, name='metadata-warm-up', daemon=True)
+            self.warm_up_thread.start()
+
+    @property
+    def is_warming_up(self):
+        return self.warm_up_thread is not None and self.warm_up_thread.is_alive()
+
+    # which caches are loaded right now; see the /status/ready/ endpoint
+    @property
+    def warm_caches(self):
+        return {
+            'league': 'league' in self.__dict__,
+            'players': 'player_registry' in self.__dict__,
+            'matchup_data': 'matchup_data' in self.__dict__,
+            'last_matchup_data': 'last_matchup_data' in self.__dict__,
+            'espn_league': 'espn' in self.__dict__ and ('league', None) in self.espn.documents,
+        }
+
+    # Invalidating only clears the caches in the worker that handled the request, so every
+    # invalidation also bumps a counter in the cache_versions collection. Every worker checks
+    # those counters (at most every few seconds, see __init__.py) and clears its own caches
+    # when they've moved, so the whole deployment catches up without a restart.
+    def broadcast_invalidation(self, scope):
+        with self.app.app_context():
+            versions = self.mongo.db.cache_versions.find_one_and_update({ '_id': 'metadata' }, {
+                '$inc': { scope: 1 }
+            }, upsert=True, return_document=True)
+        with self.cache_versions_lock:
+            self.cache_versions = { s: versions.get(s, 0) for s in CACHE_VERSION_SCOPES }
+
+        if scope == 'year':
+            self.invalidate_cached_year(clear_shared_cache=True)
+        elif scope == 'week':
+            self.invalidate_cached_week()
+        else:
+            # nothing in here depends on it, see cache_version
+            return
+        self.warm_up_in_background()
+
+    # For caches that live outside this class but should be cleared along with everyone else's
+    # (like the winnings leaderboard in history.py): keep what you cached with the version it was
+    # cached under, and load it again when the version's moved. None means we haven't checked yet.
+    def cache_version(self, scope):
+        with self.cache_versions_lock:
+            return self.cache_versions[scope] if self.cache_versions else None
+
+    def sync_cache_versions(self):
+        now = datetime.now()
+        with self.cache_versions_lock:
+            if now - self.cache_versions_checked_at < CACHE_VERSION_CHECK_INTERVAL:
+                return
+            self.cache_versions_checked_at = now
+
+        with self.app.app_context():
+            versions = self.mongo.db.cache_versions.find_one({ '_id': 'metadata' }) or {}
+        self.apply_cache_versions(versions)
+
+    def apply_cache_versions(self, versions):
+        with self.cache_versions_lock:
+            seen = self.cache_versions
+            self.cache_versions = { s: versions.get(s, 0) for s in CACHE_VERSION_SCOPES }
+        # a brand new worker has nothing stale to clear
+        if seen is None:
+            return
+
+        if self.cache_versions['year'] != seen['year']:
+            self.invalidate_cached_year()
+        elif self.cache_versions['week'] != seen['week']:
+            self.invalidate_cached_week()
+        else:
+            return
+        self.warm_up_in_background()
+
+    # the other workers only drop what they have in memory, see Espn.invalidate_cached_year
+    def invalidate_cached_year(self, clear_shared_cache=False):
+        self.espn.invalidate_cached_year(clear_shared_cache)
+        # the league year (and ID) may have changed, so ESPN gets a new facade too
+        invalidate(self, 'league', 'player_registry', 'espn', 'matchup_data', 'last_matchup_data')
 
     def invalidate_cached_week(self):
-        if "matchup_data" in self.__dict__:
-            del self.__dict__["matchup_data"]
-        if "last_matchup_data" in self.__dict__:
-            del self.__dict__["last_matchup_data"]
+        invalidate(self, 'matchup_data', 'last_matchup_data')
 
     def insert_matchup_data(self, week=None):
         week_string = str(week)
@@ -188,19 +299,7 @@ class Metadata:
         week = int(week_string)
         box_scores = self.espn.box_scores(week)
 
-        last_week_of_regular_season = self.espn.weeks_in_regular_season
-        number_of_teams_in_league = self.espn.number_of_teams
-        number_of_playoff_teams = self.espn.number_of_playoff_teams
-
-        is_round_one = last_week_of_regular_season + 1 == week
-        is_round_two = last_week_of_regular_season + 2 == week
-        is_round_three = last_week_of_regular_season + 3 == week
-        is_semifinals = is_round_two if (number_of_playoff_teams > 4) else is_round_one
-        is_finals = is_round_three if (number_of_playoff_teams > 4) else is_round_two
-        is_consolation_finals = is_semifinals if (number_of_teams_in_league < 12 and number_of_playoff_teams > 4) else is_finals
-        is_consolation_over = is_round_three and not is_consolation_finals
-        index_for_round_two = last_week_of_regular_season + 2 - 1
-        index_for_round_one = last_week_of_regular_season + 1 - 1
+        bracket = self.espn.bracket
 
         # TODO - save these as ints instead
         database_key = { 'year': self.league_year, 'week': week_string }
@@ -213,38 +312,12 @@ class Metadata:
             home_espn_id = s.home_team.owners[0]['id']
             away_espn_id = s.away_team.owners[0]['id']
 
-            if s.matchup_type == 'WINNERS_CONSOLATION_LADDER':
-                if is_round_three:
-                    round_two_home_game = s.home_team.outcomes[index_for_round_two]
-                    round_two_away_game = s.away_team.outcomes[index_for_round_two]
-
-                    # if either team won the last game, this isn't the third place game
-                    if round_two_home_game == 'W' or round_two_away_game == 'W':
-                        continue
-                else:
-                    continue
-
-            if s.matchup_type == 'LOSERS_CONSOLATION_LADDER':
-                if is_consolation_over:
-                   continue
-
-                # HACK - if they won any completed consolation game, ignore the box score
-                if is_round_three:
-                    round_two_home_game = s.home_team.outcomes[index_for_round_two]
-                    round_two_away_game = s.away_team.outcomes[index_for_round_two]
-
-                    if round_two_home_game == 'W' or round_two_away_game == 'W':
-                        continue
-
-                if not is_round_one:
-                    round_one_home_game = s.home_team.outcomes[index_for_round_one]
-                    round_one_away_game = s.away_team.outcomes[index_for_round_one]
-
-                    if round_one_home_game == 'W' or round_one_away_game == 'W':
-                        continue
+            # leave off consolation games that don't matter anymore
+            if not bracket.counts(s, week):
+                continue
 
-            home_name = self.player_lookup_by_espn_owner_id[home_espn_id]['display_name']
-            away_name = self.player_lookup_by_espn_owner_id[away_espn_id]['display_name']
+            home_name = self.player_lookup_by_espn_owner_id[home_espn_id].display_name
+            away_name = self.player_lookup_by_espn_owner_id[away_espn_id].display_name
 
             matchup = {
                 'team_one': away_name,
@@ -265,8 +338,7 @@ class Metadata:
         }
 
         # guarantee one record per year/week
-        self.mongo.db.matchup_metadata.update_one(database_key, {
-            '$set': record
-        }, upsert=True)
+        with BulkWriter(self.app, self.mongo.db.matchup_metadata) as writer:
+            writer.upsert(database_key, record)
 
         return record
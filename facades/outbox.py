@@ -0,0 +1,266 @@
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from slack.errors import SlackApiError
+
+# Slack errors worth trying again; anything else (bad token, bad payload, etc.) won't fix itself
+# https://api.slack.com/docs/rate-limits
+RETRYABLE_ERRORS = [ 'ratelimited', 'internal_error', 'fatal_error', 'service_unavailable', 'request_timeout' ]
+MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 120
+# if a worker dies mid-send, another worker picks the message back up after this long
+CLAIM_TIMEOUT = timedelta(seconds=60)
+# keep delivered messages around long enough to report latency on them
+SENT_RETENTION = timedelta(days=7)
+# and the ones we gave up on a while longer, so there's time to see what went wrong
+FAILED_RETENTION = timedelta(days=30)
+
+# Every Slack call we make goes through here, so a 429 or a Slack hiccup doesn't lose a message:
+# - the message is saved to the slack_outbox collection before it's sent
+# - callers that need an answer right away (the form fan-out, dialogs) can wait a short while
+#   for it to go out, retrying with backoff (or whatever Retry-After Slack asks for)
+# - anything still undelivered is left in the collection, where a background thread in every
+#   worker keeps retrying it, even across restarts
+# - chat_update calls for the same message are coalesced, so only the latest version is sent
+class Outbox:
+    def __init__(self, app, mongo, slack):
+        self.app = app
+        self.mongo = mongo
+        self.slack = slack
+        self.wake_up = threading.Event()
+        self.sender = None
+        self.sender_lock = threading.Lock()
+
+    @property
+    def collection(self):
+        return self.mongo.db.slack_outbox
+
+    def start(self):
+        with self.sender_lock:
+            if self.sender and self.sender.is_alive():
+                return
+            self.sender = threading.Thread(target=self.send_forever, name='slack-outbox', daemon=True)
+            self.sender.start()
+
+    # user_id means the call needs that user's DM channel; see Slack.call_with_dm_channel
+    # wait is how many seconds the caller is willing to block for the message to go out
+    def deliver(self, method, kwargs, user_id=None, coalesce_key=None, wait=0):
+        self.start()
+        now = datetime.now()
+
+        with self.app.app_context():
+            if coalesce_key:
+                # replace the payload of a queued message for the same thing instead of adding another one;
+                # queued_at stays the same, so latency is still measured from the first request
+                coalesced = self.collection.find_one_and_update({ 'coalesce_key': coalesce_key, 'status': 'pending' }, {
+                    '$set': { 'kwargs': kwargs, 'updated_at': now },
+                    '$inc': { 'coalesced': 1 }
+                })
+                if coalesced:
+                    self.wake_up.set()
+                    return { 'user_id': user_id, 'status': 'pending', 'error': None }
+
+            message = {
+                'method': method,
+                'kwargs': kwargs,
+                'user_id': user_id,
+                'coalesce_key': coalesce_key,
+                'status': 'sending' if wait else 'pending',
+                'attempts': 0,
+                'coalesced': 0,
+                'queued_at': now,
+                'claimed_at': now,
+                'next_attempt_at': now,
+            }
+            message['_id'] = self.collection.insert_one(message).inserted_id
+
+        if not wait:
+            self.wake_up.set()
+            return { 'user_id': user_id, 'status': 'pending', 'error': None }
+
+        give_up_at = time.monotonic() + wait
+        while True:
+            delay = self.attempt(message)
+            if delay is None or time.monotonic() + delay > give_up_at:
+                break
+            time.sleep(delay)
+            # the background sender may have picked up the retry while we slept; if so, it's theirs now
+            if not self.reclaim(message):
+                break
+
+        return { 'user_id': user_id, 'status': message['status'], 'error': message.get('error') }
+
+    # try to send the message once; returns how long to wait before the next try,
+    # or None if there's nothing left to do (it was sent, or it failed for good)
+    def attempt(self, message):
+        started = time.perf_counter()
+        try:
+            method = getattr(self.slack.client, message['method'])
+            if message['user_id']:
+                self.slack.call_with_dm_channel(message['user_id'], method, **message['kwargs'])
+            else:
+                method(**message['kwargs'])
+        except Exception as e:
+            return self.handle_failure(message, e)
+
+        now = datetime.now()
+        message['status'] = 'sent'
+        message['error'] = None
+        self.update(message, {
+            'status': 'sent',
+            'sent_at': now,
+            'expire_at': now + SENT_RETENTION,
+            'send_seconds': round(time.perf_counter() - started, 3),
+            'latency_seconds': round((now - message['queued_at']).total_seconds(), 3),
+            'error': None,
+        })
+        return None
+
+    def handle_failure(self, message, e):
+        attempts = message['attempts'] + 1
+        error = str(e)
+        retryable = not isinstance(e, SlackApiError)
+        delay = None
+
+        if isinstance(e, SlackApiError):
+            error = e.response.get('error', error)
+            retryable = e.response.status_code == 429 or e.response.status_code >= 500 or error in RETRYABLE_ERRORS
+            if e.response.status_code == 429:
+                delay = int(e.response.headers.get('Retry-After', BACKOFF_BASE_SECONDS))
+
+        message['attempts'] = attempts
+        message['error'] = error
+        if not retryable or attempts >= MAX_ATTEMPTS:
+            message['status'] = 'failed'
+            self.app.logger.error('slack outbox gave up on %s after %d attempt(s): %s', message['method'], attempts, error)
+            failed_at = datetime.now()
+            self.update(message, { 'status': 'failed', 'attempts': attempts, 'error': error, 'failed_at': failed_at,
+                'expire_at': failed_at + FAILED_RETENTION })
+            return None
+
+        # full jitter, so every worker that got a 429 at the same moment doesn't retry at the same moment too
+        if delay is None:
+            delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempts))
+        message['status'] = 'pending'
+        self.update(message, {
+            'status': 'pending',
+            'attempts': attempts,
+            'error': error,
+            'next_attempt_at': datetime.now() + timedelta(seconds=delay),
+        })
+        return delay
+
+    def update(self, message, fields):
+        with self.app.app_context():
+            self.collection.update_one({ '_id': message['_id'] }, { '$set': fields })
+
+    def reclaim(self, message):
+        with self.app.app_context():
+            return self.collection.find_one_and_update({ '_id': message['_id'], 'status': 'pending' }, {
+                '$set': { 'status': 'sending', 'claimed_at': datetime.now() }
+            })
+
+    # atomically take the next message that's due, so two workers never send the same one
+    def claim(self):
+        now = datetime.now()
+        with self.app.app_context():
+            return self.collection.find_one_and_update({ '$or': [
+                { 'status': 'pending', 'next_attempt_at': { '$lte': now } },
+                { 'status': 'sending', 'claimed_at': { '$lte': now - CLAIM_TIMEOUT } },
+            ] }, {
+                '$set': { 'status': 'sending', 'claimed_at': now }
+            }, sort=[('next_attempt_at', 1)])
+
+    def send_forever(self):
+        try:
+            with self.app.app_context():
+                self.collection.create_index('expire_at', expireAfterSeconds=0)
+                # failures from before they were given a retention would otherwise never expire
+                self.collection.update_many({ 'status': 'failed', 'expire_at': { '$exists': False } },
+                    { '$set': { 'expire_at': datetime.now() + FAILED_RETENTION } })
+        except Exception as e:
+            self.app.logger.error('slack outbox could not create its TTL index: %s', e)
+
+        while True:
+            # this is the only thread sending, so nothing can be allowed to kill it; a message that was
+            # claimed but not finished goes back in the queue once its claim times out (see claim)
+            try:
+                message = self.claim()
+                if message:
+                    self.attempt(message)
+                    continue
+            except Exception as e:
+                self.app.logger.error('slack outbox could not send: %s', e)
+
+            # nothing due; sleep until someone queues something, or a retry comes due
+            self.wake_up.wait(timeout=1)
+            self.wake_up.clear()
+
+    # send the same message to every user as a DM, a few at a time, and report back
+    # how each one went; results come back in the same order as user_ids
+    def fan_out(self, user_ids, text, attachments, wait=10):
+        started = time.perf_counter()
+        # load the cached channels up front, so the threads below don't all race to do it
+        if self.slack.dm_channel_ids is None:
+            self.slack.load_dm_channel_ids()
+
+        futures = [self.slack.executor.submit(self.send_direct_message, user_id, text, attachments, wait)
+            for user_id in user_ids]
+        results = [f.result() for f in futures]
+
+        sent = [r for r in results if r['status'] == 'sent']
+        failures = [r for r in results if not r['ok']]
+        self.app.logger.info('slack fan_out sent=%d queued=%d failed=%d seconds=%.3f',
+            len(sent), len(results) - len(sent) - len(failures), len(failures), time.perf_counter() - started)
+        for r in failures:
+            self.app.logger.error('slack fan_out failed user_id=%s error=%s', r['user_id'], r['error'])
+
+        return results
+
+    def send_direct_message(self, user_id, text, attachments, wait):
+        started = time.perf_counter()
+        try:
+            result = self.deliver('chat_postMessage', {
+                'text': text,
+                'attachments': attachments,
+                'as_user': False
+            }, user_id=user_id, wait=wait)
+        # a dead connection to the database shouldn't stop everyone else's form from going out
+        except Exception as e:
+            result = { 'user_id': user_id, 'status': 'failed', 'error': str(e) }
+        # anything still pending will be retried by the outbox, so it isn't a failure (yet)
+        result['ok'] = result['status'] != 'failed'
+        result['seconds'] = round(time.perf_counter() - started, 3)
+        return result
+
+    def metrics(self):
+        with self.app.app_context():
+            depth = { s['_id']: s['count'] for s in self.collection.aggregate([
+                { '$group': { '_id': '$status', 'count': { '$sum': 1 } } }
+            ]) }
+            oldest_pending = self.collection.find_one({ 'status': { '$in': [ 'pending', 'sending' ] } },
+                sort=[('queued_at', 1)])
+            recently_sent = list(self.collection.find({ 'status': 'sent' }, { 'latency_seconds': 1, 'attempts': 1, 'coalesced': 1 },
+                sort=[('sent_at', -1)], limit=100))
+
+        latencies = sorted(m['latency_seconds'] for m in recently_sent)
+        return {
+            'depth': {
+                'pending': depth.get('pending', 0),
+                'sending': depth.get('sending', 0),
+                'sent': depth.get('sent', 0),
+                'failed': depth.get('failed', 0),
+            },
+            'oldest_pending_seconds': round((datetime.now() - oldest_pending['queued_at']).total_seconds(), 3) if oldest_pending else 0,
+            'recently_sent': len(latencies),
+            'latency_seconds': {
+                'average': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+                'p50': latencies[len(latencies) // 2] if latencies else 0,
+                'p95': latencies[int(len(latencies) * 0.95)] if latencies else 0,
+                'max': latencies[-1] if latencies else 0,
+            },
+            'retried': sum(1 for m in recently_sent if m['attempts']),
+            'coalesced': sum(m['coalesced'] for m in recently_sent),
+        }
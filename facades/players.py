@@ -0,0 +1,25 @@
+# Player lookups happen several times per box score on the scoreboard, and once per team in the
+# tiebreakers, so every index is built once when the players are loaded, instead of on every lookup.
+class Player:
+    __slots__ = ('player_id', 'display_name', 'slack_username', 'espn_owner_id', 'espn_owner_name')
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields[name])
+
+    # only the player_metadata fields we use; anything missing is None
+    @classmethod
+    def from_document(cls, document):
+        return cls(**{ name: document.get(name) for name in cls.__slots__ })
+
+    def __repr__(self):
+        return 'Player(' + str(self.player_id) + ', ' + str(self.display_name) + ')'
+
+class PlayerRegistry:
+    def __init__(self, documents):
+        self.players = [Player.from_document(d) for d in documents]
+        # players missing a value (say, someone who hasn't linked their ESPN account) aren't indexed by it
+        self.by_espn_name = { p.espn_owner_name: p for p in self.players if p.espn_owner_name }
+        self.by_espn_owner_id = { p.espn_owner_id: p for p in self.players if p.espn_owner_id }
+        self.by_id = { p.player_id: p for p in self.players if p.player_id }
+        self.by_username = { p.slack_username: p for p in self.players if p.slack_username }
@@ -0,0 +1,71 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from slack import WebClient
+from slack.errors import SlackApiError
+
+# Slack lets a bot burst a handful of chat.postMessage calls at once, but not a whole
+# league's worth, so keep the fan-out small enough to stay under the rate limit;
+# see facades/outbox.py for what happens when we go over it anyway
+MAX_CONCURRENT_SENDS = 4
+
+class Slack:
+    def __init__(self, app, mongo, max_workers=MAX_CONCURRENT_SENDS):
+        self.app = app
+        self.mongo = mongo
+        self.max_workers = max_workers
+        # DM channel IDs never change for a user, so look them up once per worker
+        # and keep them next to the member in league_metadata for every other worker
+        self.dm_channel_ids = None
+
+    # one client (and one thread pool) per worker, instead of a new one for every send;
+    # the client is stateless between calls, so it's safe to share it across threads
+    @cached_property
+    def client(self):
+        return WebClient(token=os.environ['SLACK_API_TOKEN'])
+
+    @cached_property
+    def executor(self):
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='slack')
+
+    def load_dm_channel_ids(self):
+        with self.app.app_context():
+            league = self.mongo.db.league_metadata.find_one(sort=[('year', -1)])
+        members = league['members'] if league else []
+        self.dm_channel_ids = { m['slack_user_id']: m['slack_channel_id']
+            for m in members if m.get('slack_channel_id') }
+
+    def dm_channel_id(self, user_id):
+        if self.dm_channel_ids is None:
+            self.load_dm_channel_ids()
+        if user_id in self.dm_channel_ids:
+            return self.dm_channel_ids[user_id]
+
+        channel = self.client.conversations_open(users=user_id)
+        # unwrap channel information
+        channel_id = channel['channel']['id']
+        self.dm_channel_ids[user_id] = channel_id
+        with self.app.app_context():
+            self.mongo.db.league_metadata.update_many({ 'members.slack_user_id': user_id }, {
+                '$set': { 'members.$.slack_channel_id': channel_id }
+            })
+        return channel_id
+
+    def forget_dm_channel_id(self, user_id):
+        if self.dm_channel_ids:
+            self.dm_channel_ids.pop(user_id, None)
+        with self.app.app_context():
+            self.mongo.db.league_metadata.update_many({ 'members.slack_user_id': user_id }, {
+                '$unset': { 'members.$.slack_channel_id': '' }
+            })
+
+    # call a Slack method that needs the user's DM channel; if the cached channel went away
+    # (the bot was removed, the workspace was migrated, etc.) look it up again and retry once
+    def call_with_dm_channel(self, user_id, method, **kwargs):
+        try:
+            return method(channel=self.dm_channel_id(user_id), **kwargs)
+        except SlackApiError as e:
+            if e.response.get('error') != 'channel_not_found':
+                raise
+            self.forget_dm_channel_id(user_id)
+            return method(channel=self.dm_channel_id(user_id), **kwargs)
@@ -0,0 +1,166 @@
+import atexit
+import os
+import threading
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+
+# how long a write can sit in the buffer, picking up more changes, before it goes to the database
+FLUSH_INTERVAL = timedelta(milliseconds=int(os.environ.get('WRITE_BEHIND_FLUSH_MS', 500)))
+
+# Right before the prediction deadline, everyone clicks through their whole form in a few seconds,
+# and every click used to be its own update. Instead, clicks are held here for a moment, and every
+# click for the same record is merged into one $set:
+# - a record's writes are flushed at most FLUSH_INTERVAL after its first buffered click, and never
+#   later than the flush_by time it was buffered with (the prediction deadline, for predictions)
+# - anything that reads the record back should flush it first, see flush(); that only covers this
+#   worker's clicks, since a different worker's are only visible once it's flushed them
+# - whatever's left is flushed when the worker shuts down
+# - every flush is one round trip, however many records and clicks are in it
+#
+# The buffer is per worker, and someone's clicks can land on different workers, which flush in any
+# order; so a late flush mustn't overwrite a newer click for the same field from somewhere else.
+# Each field is saved along with the time it was last clicked, in a shadow field under set_at:
+#
+# {
+#     'picks': { 'winners': { '2': 'Walker' }, 'blowout': 'Renato' },
+#     'set_at': { 'picks': { 'winners': { '2': <datetime> }, 'blowout': <datetime> } },
+#     'last_modified': <datetime>,    # the latest click of all, see modified_field
+# }
+#
+# A field is only changed if its click is at least as new as its saved set_at. That's a filter per
+# field, so each field is its own (conditional) update within the flush; the record's upserted first,
+# in the same batch. A timestamp per field, rather than one per record, is what lets two workers
+# save different picks on the same record without one throwing the other away.
+class WriteBehind:
+    def __init__(self, app, mongo, collection_name, flush_interval=FLUSH_INTERVAL, set_at_field='set_at',
+            modified_field='last_modified'):
+        self.app = app
+        self.mongo = mongo
+        self.collection_name = collection_name
+        self.flush_interval = flush_interval
+        self.set_at_field = set_at_field
+        self.modified_field = modified_field
+        # filter (as a tuple, so it can be a key) -> the merged write for that record
+        self.pending = {}
+        self.lock = threading.Lock()
+        # only one flush at a time, so an older write for a record can't land after a newer one
+        self.flush_lock = threading.Lock()
+        self.wake_up = threading.Event()
+        self.flusher = None
+        self.buffered = 0
+        self.written = 0
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.collection_name]
+
+    def start(self):
+        with self.lock:
+            if self.flusher and self.flusher.is_alive():
+                return
+            self.flusher = threading.Thread(target=self.flush_forever, name='write-behind-' + self.collection_name, daemon=True)
+            self.flusher.start()
+            atexit.register(self.flush)
+
+    # buffer a $set for the (upserted) record matching filter
+    def set(self, filter, fields, flush_by=None):
+        self.start()
+        key = tuple(sorted(filter.items()))
+        set_at = datetime.now()
+        flush_at = set_at + self.flush_interval
+        if flush_by:
+            flush_at = min(flush_at, flush_by)
+
+        with self.lock:
+            write = self.pending.get(key)
+            if write is None:
+                write = self.pending[key] = { 'filter': dict(filter), 'fields': {}, 'set_at': {}, 'flush_at': flush_at }
+            write['fields'].update(fields)
+            write['set_at'].update({ name: set_at for name in fields })
+            write['flush_at'] = min(write['flush_at'], flush_at)
+            self.buffered += 1
+        self.wake_up.set()
+
+    # write out everything buffered right now, or just the record matching filter
+    def flush(self, filter=None):
+        with self.flush_lock:
+            with self.lock:
+                if filter is None:
+                    writes = list(self.pending.values())
+                    self.pending = {}
+                else:
+                    write = self.pending.pop(tuple(sorted(filter.items())), None)
+                    writes = [write] if write else []
+            self.write(writes)
+
+    def flush_due(self):
+        with self.flush_lock:
+            now = datetime.now()
+            with self.lock:
+                writes = [w for w in self.pending.values() if w['flush_at'] <= now]
+                for write in writes:
+                    del self.pending[tuple(sorted(write['filter'].items()))]
+            self.write(writes)
+
+    def write(self, writes):
+        if not writes:
+            return
+        try:
+            with self.app.app_context():
+                # in order, so each record exists before its fields are (conditionally) set
+                self.collection.bulk_write([request for w in writes for request in self.requests(w)])
+        except Exception as e:
+            self.app.logger.error('write-behind could not write %d %s record(s), will try again: %s',
+                len(writes), self.collection_name, e)
+            self.put_back(writes)
+            raise
+
+        with self.lock:
+            self.written += len(writes)
+        self.app.logger.debug('write-behind wrote %d %s record(s), %d writes buffered so far, %d written',
+            len(writes), self.collection_name, self.buffered, self.written)
+
+    # the record's created if it's missing (and its modified time moved up), then each field is set,
+    # unless what's saved was clicked later
+    def requests(self, write):
+        requests = [UpdateOne(write['filter'], { '$max': { self.modified_field: max(write['set_at'].values()) } }, upsert=True)]
+        for name, value in write['fields'].items():
+            set_at_name = self.set_at_field + '.' + name
+            set_at = write['set_at'][name]
+            requests.append(UpdateOne(dict(write['filter'], **{ '$or': [
+                { set_at_name: { '$exists': False } },
+                { set_at_name: { '$lte': set_at } },
+            ] }), { '$set': { name: value, set_at_name: set_at } }))
+        return requests
+
+    # anything buffered since we took these out is newer, so it wins
+    def put_back(self, writes):
+        with self.lock:
+            for write in writes:
+                key = tuple(sorted(write['filter'].items()))
+                newer = self.pending.get(key)
+                if newer:
+                    write['fields'].update(newer['fields'])
+                    write['set_at'].update(newer['set_at'])
+                self.pending[key] = write
+
+    def next_flush_at(self):
+        with self.lock:
+            return min((w['flush_at'] for w in self.pending.values()), default=None)
+
+    def flush_forever(self):
+        while True:
+            next_flush_at = self.next_flush_at()
+            if next_flush_at is None:
+                timeout = 1
+            else:
+                timeout = max(0, (next_flush_at - datetime.now()).total_seconds())
+            if timeout:
+                self.wake_up.wait(timeout=timeout)
+                self.wake_up.clear()
+
+            try:
+                self.flush_due()
+            except Exception:
+                # already logged; back off a little so a dead database doesn't spin this thread
+                self.wake_up.wait(timeout=1)
@@ -2,12 +2,19 @@ import os
 import sys
 import logging
 import types
-from flask import Flask, jsonify
+import functools
+import multiprocessing
+from flask import Flask, Response, jsonify, request
 import flask_restful as restful
 from flask_pymongo import PyMongo
-from slack import WebClient
 from dotenv import load_dotenv
+from facades.espn import EspnUnavailable
+from facades.indexes import Indexes
+from facades.jobs import Jobs
 from facades.metadata import Metadata
+from facades.outbox import Outbox
+from facades.slack import Slack
+from facades.write_behind import WriteBehind
 
 load_dotenv()
 
@@ -36,7 +43,9 @@ api = restful.Api(app)
 
 @api.representation('application/json')
 def output_json(obj, code, headers=None):
-    return jsonify(obj)
+    response = jsonify(obj)
+    response.status_code = code
+    return response
 
 # support api.route decorators like the regular flask object
 # http://flask.pocoo.org/snippets/129/
@@ -47,60 +56,95 @@ def api_route(self, *args, **kwargs):
     return wrapper
 api.route = types.MethodType(api_route, api)
 
+# we only get here if ESPN is down and we've never cached what the command needs;
+# Slack shows a 200 response as a message, so let whoever asked know to try again later
+@app.errorhandler(EspnUnavailable)
+def handle_espn_unavailable(e):
+    app.logger.error('ESPN unavailable: %s', e)
+    return Response("ESPN isn't responding right now. Try again in a few minutes.")
+
 ### LEAGUE CONSTANTS (mostly data we need to abstract away from the business logic)
 
 metadata = Metadata(app, mongo)
+slack = Slack(app, mongo)
+outbox = Outbox(app, mongo, slack)
+jobs = Jobs(app, mongo)
+# clicks on the prediction form, see facades/write_behind.py
+prediction_writes = WriteBehind(app, mongo, 'predictions')
+indexes = Indexes(app, mongo)
+
+# processes started by the app itself (like the rescore-predictions ones) only need the code, not
+# the background threads; gunicorn forks its workers without multiprocessing, so they get them
+if multiprocessing.parent_process() is None:
+    # pick up anything a previous worker left undelivered
+    outbox.start()
+    # load the league caches before this worker's first request needs them
+    metadata.warm_up_in_background()
+    # create any missing indexes, and warn about any query that doesn't use one (see facades/indexes.py)
+    indexes.ensure_in_background()
+
+# pick up any cache invalidations made by other workers (cheap; see Metadata.sync_cache_versions)
+@app.before_request
+def sync_cache_versions():
+    try:
+        metadata.sync_cache_versions()
+    except Exception as e:
+        # a stale cache beats a failed request
+        app.logger.error('could not check cache versions: %s', e)
 
 ### GENERAL PURPOSE METHODS (not API related) ###
-# TODO - move this into a utils/slack.py file
+# the Slack client itself lives in facades/slack.py; these just unwrap the payloads and hand
+# them to the outbox (see facades/outbox.py), which handles rate limits and retries
 
-# requires 'text' (string) and 'attachments' (JSON) to be defined in the payload
+# requires 'text' (string) and 'attachments' (JSON) to be defined in the payload;
+# returns one result per member, see Outbox.fan_out for details
 def post_to_slack(payload):
-    slack_token = os.environ['SLACK_API_TOKEN']
-    sc = WebClient(token=slack_token)
-
-    for user_id in metadata.user_ids:
-	# uncomment this line to send messages only to Walker
-        #if user_id in [ 'U3NE3S6CQ' ]:
-            channel = sc.conversations_open(users=user_id)
-            # unwrap channel information
-            channel = channel['channel']
-
-            sc.chat_postMessage(
-                channel=channel['id'],
-                text=payload['text'],
-                attachments=payload['attachments'],
-                as_user=False
-            )
+    user_ids = metadata.user_ids
+    # uncomment this line to send messages only to Walker
+    #user_ids = [ 'U3NE3S6CQ' ]
+
+    return outbox.fan_out(user_ids, payload['text'], payload['attachments'])
 
 # requires 'trigger_id' (string) and 'dialog' (JSON) to be defined in the payload
 def open_dialog(payload):
-    slack_token = os.environ['SLACK_API_TOKEN']
-    sc = WebClient(token=slack_token)
-
-    sc.dialog_open(
-        trigger_id=payload['trigger_id'],
-        dialog=payload['dialog']
-    )
+    # a trigger_id is only good for 3 seconds, so there's no point retrying much past that
+    outbox.deliver('dialog_open', {
+        'trigger_id': payload['trigger_id'],
+        'dialog': payload['dialog']
+    }, wait=2)
 
 # requires 'user_id', 'message_ts', 'text' (all strings),
 # and 'attachments' (JSON) to be defined in the payload
 def update_message(payload):
-    slack_token = os.environ['SLACK_API_TOKEN']
-    sc = WebClient(token=slack_token)
-
-    channel = sc.conversations_open(users=payload['user_id'])
-    channel = channel['channel']
-
-    sc.chat_update(
-        channel=channel['id'],
-        ts=payload['message_ts'],
-        text=payload['text'],
-        attachments=payload['attachments']
-    )
+    # nobody's waiting on this one, and if they submit scores again before it goes out,
+    # only the newest version of the form gets sent
+    outbox.deliver('chat_update', {
+        'ts': payload['message_ts'],
+        'text': payload['text'],
+        'attachments': payload['attachments']
+    }, user_id=payload['user_id'], coalesce_key='chat_update-' + payload['user_id'] + '-' + payload['message_ts'])
+
+# decorate a slow endpoint's post method with this; when it's run as a Slack slash command,
+# it acknowledges right away and posts the real response to the command's response_url
+# once it's done (see facades/jobs.py); called any other way, it runs like it always has
+def deferred(name):
+    def wrapper(method):
+        @functools.wraps(method)
+        def run_in_background(self, *args, **kwargs):
+            response_url = request.form.get('response_url', None)
+            if not response_url:
+                return method(self, *args, **kwargs)
+
+            jobs.submit(name, response_url, request.form.to_dict(), method, self, *args, **kwargs)
+            # echo the command in the channel, so everyone knows the results are coming
+            return { 'response_type': 'in_channel' }
+        return run_in_background
+    return wrapper
 
 ### SEE BELOW FOR API ENDPOINT DEFINITIONS ###
 
 import flask_rest_service.predictions
 import flask_rest_service.scoreboard
 import flask_rest_service.history
+import flask_rest_service.status
+import flask_rest_service.week_close
@@ -0,0 +1,162 @@
+import click
+from pymongo import DeleteMany, ReplaceOne
+from facades.bulk import BulkWriter
+# see __init__.py for these definitions
+from flask_rest_service import app, mongo, metadata
+
+# Every game two managers have ever played against each other, and their records, saved in the
+# head_to_head collection with one record per pair, so the head-to-head history is one read:
+#
+# {
+#     '_id': 'Joel|Walker',    # see pair_key
+#     'managers': [ 'Joel', 'Walker' ],
+#     'games': [ { 'year': 2021, 'week': 3, 'winner': 'Walker', 'loser': 'Joel', 'playoffs': False, ... }, ... ],
+#     # every record below lines up with 'managers', so Joel is 4-6 against Walker in the regular season
+#     'regular_season': [ 4, 6 ],
+#     'playoffs': [ 1, 0 ],
+#     'consolation': [ 0, 1 ],
+#     # who won the last regular season game(s) between them, and how many in a row
+#     'streak': { 'winner': 'Walker', 'games': 2 },
+#     'playoff_games': [ { 'year': 2019, 'winner': 'Joel', 'detail': ' semifinals' } ],
+#     'consolation_games': [ { 'year': 2022, 'winner': 'Walker', 'detail': ' breckfast bowl' } ],
+# }
+#
+# It's built from scores_per_matchup the first time it's needed (or with `flask rebuild-head-to-head`),
+# and every time the scoreboard saves a week's scores, the pairs that played that week are updated
+# (see update_head_to_head_week).
+
+# names are in order, so both managers find the same record
+def pair_key(manager_one, manager_two):
+    return '|'.join(sorted([manager_one, manager_two]))
+
+# co-owners are stored as an array of names, and a game counts for each of them
+def as_names(manager):
+    return manager if isinstance(manager, list) else [manager]
+
+def playoff_detail(game):
+    if game['quarterfinals']:
+        return " quarterfinals"
+    elif game['semifinals']:
+        return " semifinals"
+    elif game['finals']:
+        if game.get('championship'):
+            return " championship"
+        if game.get('third_place'):
+            return " third place game"
+        return ""
+    else:
+        return ""
+
+def consolation_detail(game):
+    return " breckfast bowl" if game['finals'] else ""
+
+# one game per pair of managers, from a scores_per_matchup record (or something shaped like one)
+def games_from_matchup(matchup):
+    for winner in as_names(matchup['winner']):
+        for loser in as_names(matchup['loser']):
+            if winner == loser:
+                continue
+            yield {
+                'year': int(matchup['year']),
+                'week': int(matchup['week']),
+                'winner': winner,
+                'loser': loser,
+                'playoffs': bool(matchup.get('playoffs')),
+                'consolation': bool(matchup.get('consolation')),
+                'quarterfinals': bool(matchup.get('quarterfinals')),
+                'semifinals': bool(matchup.get('semifinals')),
+                'finals': bool(matchup.get('finals')),
+                'championship': bool(matchup.get('championship')),
+                'third_place': bool(matchup.get('third_place')),
+            }
+
+def build_pair(managers, games):
+    managers = sorted(managers)
+    games = sorted(games, key=lambda g: (g['year'], g['week']))
+    regular_season = [g for g in games if not g['playoffs']]
+    playoffs = [g for g in games if g['playoffs'] and not g['consolation']]
+    consolation = [g for g in games if g['playoffs'] and g['consolation']]
+    wins = lambda games_played: [sum(1 for g in games_played if g['winner'] == m) for m in managers]
+
+    # loop backwards through time to track winning streak
+    streak = None
+    for g in reversed(regular_season):
+        if streak is None:
+            streak = { 'winner': g['winner'], 'games': 0 }
+        if g['winner'] != streak['winner']:
+            break
+        streak['games'] += 1
+
+    return {
+        '_id': pair_key(*managers),
+        'managers': managers,
+        'games': games,
+        'regular_season': wins(regular_season),
+        'playoffs': wins(playoffs),
+        'consolation': wins(consolation),
+        'streak': streak,
+        'playoff_games': [{ 'year': g['year'], 'week': g['week'], 'winner': g['winner'], 'detail': playoff_detail(g) }
+            for g in playoffs],
+        'consolation_games': [{ 'year': g['year'], 'week': g['week'], 'winner': g['winner'], 'detail': consolation_detail(g) }
+            for g in consolation],
+    }
+
+# for two managers who've never played each other
+def empty_pair(manager_one, manager_two):
+    return build_pair([manager_one, manager_two], [])
+
+# one $in read for every pair
+def find_pairs(pairs_of_managers):
+    ensure_head_to_head()
+    keys = [pair_key(*managers) for managers in pairs_of_managers]
+    return { p['_id']: p for p in mongo.db.head_to_head.find({ '_id': { '$in': keys } }) }
+
+# Called with a week's scores (just like the scores collection saves them, with player IDs),
+# whenever the scoreboard saves them; live scores get saved too, so this replaces whatever
+# we had for those pairs that week rather than adding to it.
+def update_head_to_head_week(scores):
+    week_games = []
+    for matchup in scores['matchups']:
+        week_games += games_from_matchup(dict(matchup,
+            year=scores['year'],
+            week=scores['week'],
+            playoffs=scores['playoffs'],
+            quarterfinals=scores['quarterfinals'],
+            semifinals=scores['semifinals'],
+            finals=scores['finals'],
+            winner=metadata.player_lookup_by_id[matchup['winner']].display_name,
+            loser=metadata.player_lookup_by_id[matchup['loser']].display_name))
+
+    saved_pairs = find_pairs([(g['winner'], g['loser']) for g in week_games])
+    with BulkWriter(app, mongo.db.head_to_head) as writer:
+        for game in week_games:
+            key = pair_key(game['winner'], game['loser'])
+            saved_pair = saved_pairs.get(key, { 'games': [] })
+            games = [g for g in saved_pair['games'] if (g['year'], g['week']) != (game['year'], game['week'])]
+            writer.add(ReplaceOne({ '_id': key }, build_pair([game['winner'], game['loser']], games + [game]), upsert=True))
+    return writer.summary
+
+# so the history works (and the scoreboard's weekly updates land on the whole history, not an
+# empty collection) before anyone's run the rebuild command
+def ensure_head_to_head():
+    if not mongo.db.head_to_head.find_one():
+        rebuild()
+
+def rebuild():
+    games_by_pair = {}
+    for matchup in mongo.db.scores_per_matchup.find():
+        for game in games_from_matchup(matchup):
+            games_by_pair.setdefault(pair_key(game['winner'], game['loser']), []).append(game)
+
+    with BulkWriter(app, mongo.db.head_to_head) as writer:
+        for key, games in games_by_pair.items():
+            writer.add(ReplaceOne({ '_id': key }, build_pair([games[0]['winner'], games[0]['loser']], games), upsert=True))
+        # and drop any pair that's no longer in the history at all
+        writer.add(DeleteMany({ '_id': { '$nin': list(games_by_pair) } }))
+    return games_by_pair
+
+# Rebuilds every pair from scratch. Run it with `flask rebuild-head-to-head`, see the readme.
+@app.cli.command('rebuild-head-to-head')
+def rebuild_head_to_head():
+    games_by_pair = rebuild()
+    click.echo('Rebuilt head-to-head history for ' + str(len(games_by_pair)) + ' pairs of managers.')
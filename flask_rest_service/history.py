@@ -11,11 +11,16 @@ from datetime import datetime
 from espn_api.football import League
 from flask import request, abort, Response
 import flask_restful as restful
+from pymongo import UpdateOne
+from facades.bulk import BulkWriter
 # see __init__.py for these definitions
-from flask_rest_service import app, api, mongo, metadata, post_to_slack, open_dialog, update_message
+from flask_rest_service import app, api, mongo, metadata, post_to_slack, open_dialog, update_message, deferred
+from flask_rest_service.head_to_head import find_pairs, pair_key, empty_pair
+from flask_rest_service.season_summaries import find_season_summaries, ensure_season_summaries
 
 @api.route('/history/headtohead/')
 class HeadToHeadHistory(restful.Resource):
+    @deferred('head_to_head_history')
     def post(self):
         message = {
             'response_type': 'in_channel',
@@ -23,28 +28,22 @@ class HeadToHeadHistory(restful.Resource):
             'attachments': []
         }
 
+        # every pair playing this week, in one read; see head_to_head.py
+        pairs = find_pairs([(m['team_one'], m['team_two']) for m in metadata.matchups])
+
         for index, matchup in enumerate(metadata.matchups):
             manager_one = matchup['team_one']
             manager_two = matchup['team_two']
+            pair = pairs.get(pair_key(manager_one, manager_two)) or empty_pair(manager_one, manager_two)
+            # records line up with the pair's managers, which are in alphabetical order
+            one, two = pair['managers'].index(manager_one), pair['managers'].index(manager_two)
 
-            # this matches co-owners stored as an array, too
-            manager_one_query = mongo.db.scores_per_matchup.find({ 'winner': manager_one, 'loser': manager_two })
-            manager_one_list = list(manager_one_query)
-            manager_one_reg_season_list = [m for m in manager_one_list if not m['playoffs']]
-            manager_one_reg_season_wins = len(manager_one_reg_season_list)
-            manager_one_playoff_list = [m for m in manager_one_list if m['playoffs'] and not m['consolation']]
-            manager_one_playoff_wins = len(manager_one_playoff_list)
-            manager_one_consolation_list = [m for m in manager_one_list if m['playoffs'] and m['consolation']]
-            manager_one_consolation_wins = len(manager_one_consolation_list)
-
-            manager_two_query = mongo.db.scores_per_matchup.find({ 'winner': manager_two, 'loser': manager_one })
-            manager_two_list = list(manager_two_query)
-            manager_two_reg_season_list = [m for m in manager_two_list if not m['playoffs']]
-            manager_two_reg_season_wins = len(manager_two_reg_season_list)
-            manager_two_playoff_list = [m for m in manager_two_list if m['playoffs'] and not m['consolation']]
-            manager_two_playoff_wins = len(manager_two_playoff_list)
-            manager_two_consolation_list = [m for m in manager_two_list if m['playoffs'] and m['consolation']]
-            manager_two_consolation_wins = len(manager_two_consolation_list)
+            manager_one_reg_season_wins = pair['regular_season'][one]
+            manager_one_playoff_wins = pair['playoffs'][one]
+            manager_one_consolation_wins = pair['consolation'][one]
+            manager_two_reg_season_wins = pair['regular_season'][two]
+            manager_two_playoff_wins = pair['playoffs'][two]
+            manager_two_consolation_wins = pair['consolation'][two]
 
             matchup_string = ''
 
@@ -53,29 +52,13 @@ class HeadToHeadHistory(restful.Resource):
             else:
                 matchup_string += manager_two + ' ' + str(manager_two_reg_season_wins) + '-' + str(manager_one_reg_season_wins) + ' ' + manager_one
 
-            # loop backwards through time to track winning streak
-            if (manager_one_reg_season_wins + manager_two_reg_season_wins) > 0:
-                reg_season_list = manager_one_reg_season_list + manager_two_reg_season_list
-                reg_season_list.sort(key=lambda x: (x['year'], x['week']), reverse=True)
-
-                last_manager_to_win = None
-                number_of_wins_in_streak = 0
-                for m in reg_season_list:
-                    if last_manager_to_win == None:
-                        last_manager_to_win = m['winner']
-                    if m['winner'] != last_manager_to_win:
-                        break
-                    number_of_wins_in_streak += 1
-
-                if (number_of_wins_in_streak == 1):
+            streak = pair['streak']
+            if streak:
+                if (streak['games'] == 1):
                     matchup_string += " (last regular season game won by "
                 else:
-                    matchup_string += " (last " + str(number_of_wins_in_streak) + " regular season games won by "
-
-                if last_manager_to_win == manager_one:
-                    matchup_string += manager_one + ")"
-                else:
-                    matchup_string += manager_two + ")"
+                    matchup_string += " (last " + str(streak['games']) + " regular season games won by "
+                matchup_string += streak['winner'] + ")"
 
             if (manager_one_playoff_wins + manager_two_playoff_wins) > 0:
                 # keep same order as regular season record
@@ -83,8 +66,8 @@ class HeadToHeadHistory(restful.Resource):
                     matchup_string += '\n- ' + str(manager_one_playoff_wins) + '-' + str(manager_two_playoff_wins) + ' in playoffs'
                 else:
                     matchup_string += '\n- ' + str(manager_two_playoff_wins) + '-' + str(manager_one_playoff_wins) + ' in playoffs'
-                playoff_years_list = manager_one_playoff_list + manager_two_playoff_list
-                matchup_string += ' (' + ', '.join(build_playoff_history_string(m) for m in playoff_years_list) + ')'
+                matchup_string += ' (' + ', '.join(build_history_string(g)
+                    for g in games_won_by(pair['playoff_games'], manager_one, manager_two)) + ')'
 
             if (manager_one_consolation_wins + manager_two_consolation_wins) > 0:
                 # keep same order as regular season record
@@ -92,8 +75,8 @@ class HeadToHeadHistory(restful.Resource):
                     matchup_string += '\n- ' + str(manager_one_consolation_wins) + '-' + str(manager_two_consolation_wins) + ' in consolation'
                 else:
                     matchup_string += '\n- ' + str(manager_two_consolation_wins) + '-' + str(manager_one_consolation_wins) + ' in consolation'
-                consolation_years_list = manager_one_consolation_list + manager_two_consolation_list
-                matchup_string += ' (' + ', '.join(build_consolation_history_string(m) for m in consolation_years_list) + ')'
+                matchup_string += ' (' + ', '.join(build_history_string(g)
+                    for g in games_won_by(pair['consolation_games'], manager_one, manager_two)) + ')'
 
             # one message attachment per matchup
             message['attachments'].append({ 'text': matchup_string })
@@ -102,28 +85,12 @@ class HeadToHeadHistory(restful.Resource):
     def get(self):
         return HeadToHeadHistory.post(self)
 
-def build_playoff_history_string(matchup):
-    return str(matchup['year']) + playoff_detail(matchup)
-
-def playoff_detail(matchup):
-    if matchup['quarterfinals']:
-        return " quarterfinals"
-    elif matchup['semifinals']:
-        return " semifinals"
-    elif matchup['finals']:
-        if matchup['championship']:
-            return " championship"
-        if matchup['third_place']:
-            return " third place game"
-        return ""
-    else:
-        return ""
-
-def build_consolation_history_string(element):
-    return str(element['year']) + consolation_detail(element)
-
-def consolation_detail(element):
-    return " breckfast bowl" if element['finals'] else ""
+# manager one's wins, then manager two's
+def games_won_by(games, manager_one, manager_two):
+    return [g for g in games if g['winner'] == manager_one] + [g for g in games if g['winner'] == manager_two]
+
+def build_history_string(game):
+    return str(game['year']) + game['detail']
 
 @api.route('/history/podium/')
 class Podium(restful.Resource):
@@ -134,19 +101,14 @@ class Podium(restful.Resource):
             'attachments': []
         }
 
-        championship_query = mongo.db.scores_per_matchup.find({ 'consolation': False, 'championship': True, 'third_place': False })
-        championship_list = list(championship_query)
-        third_place_query = mongo.db.scores_per_matchup.find({ 'consolation': False, 'championship': False, 'third_place': True })
-        third_place_list = list(third_place_query)
-        podium_list = championship_list + third_place_list
-
+        # one record per season, latest first; see season_summaries.py
         podium_string = ''
-        for m in sorted(podium_list, key=lambda t: (-t['year'], -t['championship'])):
-            if m['championship']:
-                podium_string += str(m['year']) + ' CHAMPION: ' + m['winner'] + ' (' + str(m['winning_score']) + ')'
-                podium_string += ', 2nd: ' + m['loser'] + ' (' + str(m['losing_score']) + ')'
-            elif m['third_place']:
-                podium_string += ', 3rd: ' + m['winner'] + '\n'
+        for season in find_season_summaries():
+            if 'champion' in season:
+                podium_string += str(season['year']) + ' CHAMPION: ' + season['champion'] + ' (' + str(season['champion_score']) + ')'
+                podium_string += ', 2nd: ' + season['runner_up'] + ' (' + str(season['runner_up_score']) + ')'
+            if 'third_place' in season:
+                podium_string += ', 3rd: ' + season['third_place'] + '\n'
 
         message['attachments'].append({ 'text': podium_string })
         return message
@@ -162,18 +124,136 @@ class LastPlace(restful.Resource):
             'attachments': []
         }
 
-        last_place_query = mongo.db.scores_per_matchup.find({ 'consolation': True, 'championship': True })
-        last_place_list = list(last_place_query)
-
         last_place_string = ''
-        for m in sorted(last_place_list, key=lambda t: -t['year']):
-            last_place_string += str(m['year']) + ': ' + m['loser'] + '\n'
+        for season in find_season_summaries():
+            if 'last_place' in season:
+                last_place_string += str(season['year']) + ': ' + season['last_place'] + '\n'
 
         message['attachments'].append({ 'text': last_place_string })
         return message
     def get(self):
         return LastPlace.post(self)
 
+# What each season paid out, in the payout_rules collection so a new season's payouts are a new
+# record rather than a code change. Seeded with these the first time winnings are asked for; there's
+# one rule per from_year (see facades/indexes.py), and if ranges overlap, the latest from_year wins.
+DEFAULT_PAYOUT_RULES = [
+    { 'from_year': 0, 'to_year': 2013, 'dues': 20, 'champion': 200, 'runner_up': 60, 'third_place': 20, 'fourth_place': 0 },
+    { 'from_year': 2014, 'to_year': 2018, 'dues': 30, 'champion': 300, 'runner_up': 90, 'third_place': 30, 'fourth_place': 0 },
+    { 'from_year': 2019, 'to_year': 2019, 'dues': 50, 'champion': 500, 'runner_up': 150, 'third_place': 50, 'fourth_place': 0 },
+    { 'from_year': 2020, 'to_year': 2020, 'dues': 50, 'champion': 350, 'runner_up': 100, 'third_place': 50, 'fourth_place': 0 },
+    { 'from_year': 2021, 'to_year': 2021, 'dues': 50, 'champion': 450, 'runner_up': 100, 'third_place': 50, 'fourth_place': 0 },
+    # third and fourth split the third place money in 2022
+    { 'from_year': 2022, 'to_year': 2022, 'dues': 50, 'champion': 350, 'runner_up': 100, 'third_place': 25, 'fourth_place': 25 },
+    { 'from_year': 2023, 'to_year': 9999, 'dues': 50, 'champion': 350, 'runner_up': 100, 'third_place': 50, 'fourth_place': 0 },
+]
+
+# upserted by from_year, so two workers seeding at once still end up with one of each
+def ensure_payout_rules():
+    if not mongo.db.payout_rules.find_one():
+        with BulkWriter(app, mongo.db.payout_rules) as writer:
+            for rule in DEFAULT_PAYOUT_RULES:
+                writer.add(UpdateOne({ 'from_year': rule['from_year'] }, { '$setOnInsert': dict(rule) }, upsert=True))
+
+# joins in the payout rules for whatever season year_expression works out to
+def lookup_payout_rule(year_expression):
+    return [
+        { '$lookup': {
+            'from': 'payout_rules',
+            'let': { 'year': year_expression },
+            'pipeline': [
+                { '$match': { '$expr': { '$and': [
+                    { '$lte': [ '$from_year', '$$year' ] },
+                    { '$gte': [ '$to_year', '$$year' ] }
+                ] } } },
+                # one rule per season, or its winnings would be counted once per rule
+                { '$sort': { 'from_year': -1 } },
+                { '$limit': 1 },
+            ],
+            'as': 'rule'
+        } },
+        { '$unwind': '$rule' },
+    ]
+
+# Everyone's winnings and dues paid, in one trip to the database:
+# - winnings come from how each season finished in season_summaries (see season_summaries.py)
+# - dues come from every league year someone was a member in league_metadata
+# $unionWith needs MongoDB 4.4 or later; older servers get the same leaderboard from
+# build_winnings_leaderboard below instead.
+WINNINGS_PIPELINE = [
+    *lookup_payout_rule('$year'),
+    { '$project': { 'payouts': [
+        { 'player': '$champion', 'winnings': '$rule.champion' },
+        { 'player': '$runner_up', 'winnings': '$rule.runner_up' },
+        { 'player': '$third_place', 'winnings': '$rule.third_place' },
+        { 'player': '$fourth_place', 'winnings': '$rule.fourth_place' },
+    ] } },
+    { '$unwind': '$payouts' },
+    # a season that's still being played doesn't have everyone yet
+    { '$match': { 'payouts.player': { '$exists': True } } },
+    { '$project': { '_id': 0, 'player': '$payouts.player', 'winnings': '$payouts.winnings', 'dues': { '$literal': 0 } } },
+    { '$unionWith': { 'coll': 'league_metadata', 'pipeline': [
+        { '$unwind': '$members' },
+        # years are strings in league_metadata, and we only count a year once per member
+        { '$group': { '_id': { 'player': '$members.display_name', 'year': { '$toInt': '$year' } } } },
+        *lookup_payout_rule('$_id.year'),
+        { '$project': { '_id': 0, 'player': '$_id.player', 'winnings': { '$literal': 0 }, 'dues': '$rule.dues' } },
+    ] } },
+    { '$group': { '_id': '$player', 'winnings': { '$sum': '$winnings' }, 'dues': { '$sum': '$dues' } } },
+    # only people who've won something make the leaderboard
+    { '$match': { 'winnings': { '$gt': 0 } } },
+    { '$sort': { 'winnings': -1, '_id': 1 } },
+]
+
+UNION_WITH_VERSION = [4, 4]
+
+def find_payout_rule(rules, year):
+    matching = [r for r in rules if r['from_year'] <= year <= r['to_year']]
+    return max(matching, key=lambda r: r['from_year']) if matching else None
+
+# The same leaderboard as WINNINGS_PIPELINE (same shape, same order), added up here instead, for
+# servers too old for $unionWith
+def build_winnings_leaderboard():
+    rules = list(mongo.db.payout_rules.find())
+    standings = defaultdict(lambda: { 'winnings': 0, 'dues': 0 })
+    for summary in mongo.db.season_summaries.find():
+        rule = find_payout_rule(rules, summary['year'])
+        if rule is None:
+            continue
+        for place in [ 'champion', 'runner_up', 'third_place', 'fourth_place' ]:
+            if place in summary:
+                standings[summary[place]]['winnings'] += rule[place]
+
+    # years are strings in league_metadata, and we only count a year once per member
+    member_years = { (member['display_name'], int(league['year']))
+        for league in mongo.db.league_metadata.find({}, { 'year': 1, 'members.display_name': 1 })
+        for member in league.get('members', []) }
+    for player, year in member_years:
+        rule = find_payout_rule(rules, year)
+        if rule is not None:
+            standings[player]['dues'] += rule['dues']
+
+    # only people who've won something make the leaderboard
+    return sorted(({ '_id': player, **totals } for player, totals in standings.items() if totals['winnings'] > 0),
+        key=lambda standing: (-standing['winnings'], standing['_id']))
+
+# the leaderboard only changes when a season's finals are saved, see Metadata.cache_version
+winnings_cache = { 'version': None, 'leaderboard': None, 'server_version': None }
+
+def get_winnings_leaderboard():
+    version = metadata.cache_version('finals')
+    if winnings_cache['leaderboard'] is None or version is None or winnings_cache['version'] != version:
+        ensure_payout_rules()
+        ensure_season_summaries()
+        if winnings_cache['server_version'] is None:
+            winnings_cache['server_version'] = mongo.db.client.server_info()['versionArray']
+        if winnings_cache['server_version'][:2] >= UNION_WITH_VERSION:
+            leaderboard = list(mongo.db.season_summaries.aggregate(WINNINGS_PIPELINE))
+        else:
+            leaderboard = build_winnings_leaderboard()
+        winnings_cache.update(version=version, leaderboard=leaderboard)
+    return winnings_cache['leaderboard']
+
 @api.route('/history/winnings/')
 class Winnings(restful.Resource):
     def post(self):
@@ -183,60 +263,9 @@ class Winnings(restful.Resource):
             'attachments': []
         }
 
-        championship_query = mongo.db.scores_per_matchup.find({ 'consolation': False, 'championship': True, 'third_place': False })
-        championship_list = list(championship_query)
-        third_place_query = mongo.db.scores_per_matchup.find({ 'consolation': False, 'championship': False, 'third_place': True })
-        third_place_list = list(third_place_query)
-        podium_list = championship_list + third_place_list
-
-        standings = defaultdict(int)
-        for m in podium_list:
-            dues_per_member = 20
-            if m['year'] > 2013:
-                dues_per_member = 30
-            if m['year'] > 2018:
-                dues_per_member = 50
-
-            # TODO - base members off mongo.db.league_metadata.members
-            members = 14
-            if m['year'] > 2019:
-                members = 10
-            if m['year'] == 2021:
-                members = 12
-
-            if m['championship']:
-                champ = m['winner']
-                if m['year'] > 2019:
-                    standings[champ] += dues_per_member * (members - 3)
-                else:
-                    standings[champ] += dues_per_member * (members - 4)
-
-                runner_up = m['loser']
-                if m['year'] > 2019:
-                    standings[runner_up] += dues_per_member * 2
-                else:
-                    standings[runner_up] += dues_per_member * 3
-            elif m['third_place']:
-                third = m['winner']
-                if m['year'] == 2022:
-                    fourth = m['loser']
-                    standings[third] += 25
-                    standings[fourth] += 25
-                else:
-                    standings[third] += dues_per_member
-
         winnings_string = ''
-        for player, money in sorted(standings.items(), key=lambda item: -item[1]):
-            years_in_league = mongo.db.league_metadata.distinct('year', { 'members': { '$elemMatch': { 'display_name': player } } })
-            dues = 0
-            for y in years_in_league:
-                year = int(y)
-                if year > 2018:
-                    dues += 50
-                elif year > 2013:
-                    dues += 30
-                else:
-                    dues += 20
+        for standing in get_winnings_leaderboard():
+            player, money, dues = standing['_id'], standing['winnings'], standing['dues']
             winnings_string += player + ': $' + str(money) + ' ($' + str(dues) + ' dues paid, $' + str(money - dues) + ' net winnings)\n'
 
         message['attachments'].append({ 'text': winnings_string })
@@ -0,0 +1,247 @@
+import copy
+import hashlib
+import json
+import threading
+
+# Everything about the shape of the prediction form lives here: building it, reading picks out of it,
+# and putting picks back into it. See the comment at the top of predictions.py for how the form
+# goes back and forth with Slack. The form for a week is built once and cached (see
+# get_prediction_form_template at the bottom), so use that rather than building forms by hand.
+#
+# We used to save the whole form (exactly what the user saw) for every prediction; now we save just
+# the picks, in this shape, and rebuild the form from them when we need it:
+#
+# 'picks': {
+#     'winners': { '0': 'Walker', '1': 'Renato', ... },   # keyed by matchup index, see 'winner' + index below
+#     'blowout': 'Walker versus Renato',
+#     'closest': 'Cathy versus Joel',
+#     'highest': 'Tom',
+#     'lowest': 'Cathy',
+#     'high_score': '133',
+#     'low_score': '71',
+# }
+#
+# Any of these can be missing if the user hasn't picked it yet.
+
+# the dropdowns, in the order they show up on the form; the label doubles as the 'fallback' on the form
+DROPDOWNS = [
+    { 'name': 'blowout', 'label': 'Blowout', 'question': 'Which matchup will have the biggest blowout?' },
+    { 'name': 'closest', 'label': 'Closest', 'question': 'Which matchup will have the closest score?' },
+    { 'name': 'highest', 'label': 'Highest', 'question': 'Who will be the highest scorer?' },
+    { 'name': 'lowest', 'label': 'Lowest', 'question': 'Who will be the lowest scorer?' },
+]
+DROPDOWN_NAMES = [d['name'] for d in DROPDOWNS]
+
+NO_SCORES_TEXT = ':x: No submission for high/low score yet'
+
+def build_score_text(high_score, low_score):
+    return ':heavy_check_mark: High score: ' + high_score + ', Low score: ' + low_score
+
+def matchup_string(matchup):
+    return matchup['team_one'] + ' versus ' + matchup['team_two']
+
+# This is how the sausage is made. This code is pretty boring, but it lays out pretty explicitly
+# the JSON that makes up the prediction form. See the "interactive message" docs for more details:
+# https://api.slack.com/interactive-messages
+def build_prediction_form(year, week, matchups, deadline_string, eligible_members):
+    message = {
+        'text': 'Make your predictions for week ' + week + ' matchups below by ' + deadline_string + ':',
+        'attachments': []
+    }
+    # seemed like the best way to store the year and week inside the prediction form
+    callback_id = year + '-' + week
+
+    for index, matchup in enumerate(matchups):
+        message['attachments'].append({
+            'text': matchup_string(matchup),
+            'attachment_type': 'default',
+            'callback_id': callback_id,
+            'actions': [
+                {
+                    # buttons in the same form group need to match on name to be styled properly
+                    'name': 'winner' + str(index),
+                    'text': matchup['team_one'],
+                    'type': 'button',
+                    'value': matchup['team_one']
+                },
+                {
+                    'name': 'winner' + str(index),
+                    'text': matchup['team_two'],
+                    'type': 'button',
+                    'value': matchup['team_two']
+                }
+            ]
+        })
+
+    # blowout/closest dropdowns list matchups, highest/lowest dropdowns list teams
+    matchup_options = [ { 'text': matchup_string(m), 'value': matchup_string(m) } for m in matchups ]
+    member_options = [ { 'text': name, 'value': name } for name in eligible_members ]
+
+    for dropdown in DROPDOWNS:
+        is_matchup_dropdown = dropdown['name'] in [ 'blowout', 'closest' ]
+        message['attachments'].append({
+            'text': dropdown['question'],
+            # the intent of 'fallback' seems to be to provide some screenreader/accesibility support,
+            # but it also works to support what we display when we report everyone's predictions
+            # for the week, so this is coupled to the functionality in GetSubmittedPredictions
+            'fallback': dropdown['label'],
+            'attachment_type': 'default',
+            'callback_id': callback_id,
+            'actions': [
+                {
+                    'name': dropdown['name'],
+                    'text': 'Pick a matchup...' if is_matchup_dropdown else 'Pick a team...',
+                    'type': 'select',
+                    'options': copy.deepcopy(matchup_options if is_matchup_dropdown else member_options)
+                }
+            ]
+        })
+
+    message['attachments'].append({
+        'text': NO_SCORES_TEXT,
+        'attachment_type': 'default',
+        'callback_id': callback_id,
+        'actions': [
+            {
+                'name': 'score_submission',
+                'text': 'Enter Scores',
+                'type': 'button',
+                'value': 'score_submission'
+            }
+        ]
+    })
+
+    return message
+
+# Reads the picks back out of a saved form, for predictions saved before we stored picks;
+# see the backfill-picks command in predictions.py
+def picks_from_message(message):
+    picks = { 'winners': {} }
+    for form_group in message['attachments']:
+        for element in form_group['actions']:
+            name = element['name']
+            if element['type'] == 'button' and name.startswith('winner') and element.get('style') == 'primary':
+                picks['winners'][name[len('winner'):]] = element['text']
+            elif element['type'] == 'select' and name in DROPDOWN_NAMES and element.get('selected_options'):
+                picks[name] = element['selected_options'][0]['text']
+    return picks
+
+# The picks for a saved prediction, whether it was saved with picks, as a whole form, or (if someone
+# was halfway through their form when we switched over) a bit of both. Picks win over the old form.
+def get_picks(prediction):
+    picks = { 'winners': {} }
+    if 'message' in prediction:
+        picks = picks_from_message(prediction['message'])
+        for score in [ 'high_score', 'low_score' ]:
+            if score in prediction:
+                picks[score] = prediction[score]
+
+    saved_picks = prediction.get('picks', {})
+    picks['winners'].update(saved_picks.get('winners', {}))
+    picks.update({ name: value for name, value in saved_picks.items() if name != 'winners' })
+    return picks
+
+# the update that moves an old prediction over to picks, see the backfill-picks command in predictions.py
+def picks_migration(prediction, keep_message=False):
+    update = { '$set': { 'picks': get_picks(prediction) } }
+    if not keep_message:
+        update['$unset'] = { 'message': '', 'high_score': '', 'low_score': '' }
+    return update
+
+# predicted winners, in matchup order
+def get_predicted_winners(picks):
+    return [picks['winners'][index] for index in sorted(picks['winners'], key=int)]
+
+# A week's prediction form, built once, plus everything the form allows someone to pick.
+# The message itself is shared, so never change it; copy() or render() a form to send instead.
+class PredictionFormTemplate:
+    def __init__(self, message):
+        self.message = message
+        # every pick the form allows, by action name, like { 'winner0': { 'Walker', 'Renato' }, 'blowout': { ... } }
+        self.choices = {}
+        for form_group in message['attachments']:
+            for element in form_group['actions']:
+                name = element['name']
+                if element['type'] == 'button' and name.startswith('winner'):
+                    self.choices.setdefault(name, set()).add(element['value'])
+                elif element['type'] == 'select' and name in DROPDOWN_NAMES:
+                    self.choices[name] = { option['value'] for option in element['options'] }
+
+    # a copy that's safe to style; the options lists are still shared, since nothing changes those
+    def copy(self):
+        return {
+            'text': self.message['text'],
+            'attachments': [dict(form_group, actions=[dict(element) for element in form_group['actions']])
+                for form_group in self.message['attachments']]
+        }
+
+    # whether an action from a form click is something on this week's form (the score button isn't a pick)
+    def is_pick(self, action):
+        return action['name'] in self.choices
+
+    def is_valid_pick(self, action):
+        return self.picked_value(action) in self.choices.get(action['name'], ())
+
+    def picked_value(self, action):
+        if action['name'].startswith('winner'):
+            return action.get('value')
+        if action.get('selected_options'):
+            # I guess Slack supports multiple dropdown selections, but just get the "first" selection
+            return action['selected_options'][0]['value']
+        return None
+
+    # turns the actions from one form click into the targeted $set for the prediction record;
+    # anything that isn't on this week's form is left out
+    def picks_update(self, actions):
+        update = {}
+        for action in actions:
+            if not self.is_valid_pick(action):
+                continue
+            name = action['name']
+            if name.startswith('winner'):
+                update['picks.winners.' + name[len('winner'):]] = self.picked_value(action)
+            else:
+                update['picks.' + name] = self.picked_value(action)
+        return update
+
+    # the form, styled like the user left it
+    def render(self, picks):
+        message = self.copy()
+        for form_group in message['attachments']:
+            for element in form_group['actions']:
+                name = element['name']
+                if name.startswith('winner') and name[len('winner'):] in picks['winners']:
+                    # color that portion of the form to show it was changed
+                    form_group['color'] = 'good'
+                    # color the button green to show it's selected
+                    element['style'] = 'primary' if element['value'] == picks['winners'][name[len('winner'):]] else None
+                elif name in DROPDOWN_NAMES and picks.get(name):
+                    form_group['color'] = 'good'
+                    # for a dropdown element, this is how you mark something as selected
+                    element['selected_options'] = [option
+                        for option in element['options'] if option['value'] == picks[name]]
+                elif name == 'score_submission' and picks.get('high_score') is not None and picks.get('low_score') is not None:
+                    form_group['text'] = build_score_text(picks['high_score'], picks['low_score'])
+        return message
+
+# (year, week) -> (hash of what went into the form, the template)
+TEMPLATES = {}
+TEMPLATES_LOCK = threading.Lock()
+
+# The form only changes if the matchups (or the deadline, or who's in the league) do, so it's only
+# built again when they have; only the latest week or two are kept around.
+def get_prediction_form_template(year, week, matchups, deadline_string, eligible_members):
+    form_hash = hashlib.sha1(json.dumps([matchups, deadline_string, list(eligible_members)],
+        sort_keys=True, default=str).encode()).hexdigest()
+    with TEMPLATES_LOCK:
+        cached = TEMPLATES.get((year, week))
+        if cached and cached[0] == form_hash:
+            return cached[1]
+
+    template = PredictionFormTemplate(build_prediction_form(year, week, matchups, deadline_string, eligible_members))
+    with TEMPLATES_LOCK:
+        TEMPLATES[(year, week)] = (form_hash, template)
+        # years and weeks are strings, so sort them as numbers or week 10 comes before week 8
+        for key in sorted(TEMPLATES, key=lambda k: (int(k[0]), int(k[1])))[:-2]:
+            del TEMPLATES[key]
+    return template
@@ -0,0 +1,170 @@
+import numpy as np
+from decimal import Decimal, InvalidOperation
+
+# Scores a whole week of predictions at once. Instead of walking each user's picks one at a time,
+# the week is laid out in columns (one row per user) and every category is scored for everyone in
+# one go; see score_week at the bottom for the entry point.
+#
+# The rules are the same as ever (see build_bonus_string in predictions.py for how they're explained):
+# - a point for each matchup winner picked
+# - a point for the biggest blowout, but only if you also picked the blowout's winner
+# - a point for the matchup with the closest margin
+# - a point each for the highest and lowest scorer, then an extra point for whoever's score was
+#   closest to the pin (ties all get it), and a third point for anyone within a point of it
+
+CATEGORIES = [ 'blowout', 'closest', 'highest', 'lowest' ]
+
+# we gotta reuse this formula in several spots, so defining it here
+PREDICTION_FORMULA = lambda x: x['matchup_total'] + x['blowout_bonus'] + x['closest_bonus'] + x['highest_bonus'] + x['lowest_bonus']
+
+# Scores like '133.52' are turned into exact integers ('13352', with a scale of 100) so the
+# closest-to-pin math is exact, same as comparing them as Decimals.
+def parse_decimal(score):
+    if score is None:
+        return None
+    try:
+        value = Decimal(score)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    # 'NaN' or 'Infinity' can't be closest to anything
+    return value if value.is_finite() else None
+
+def scale_for(values):
+    return 10 ** max([0] + [-v.as_tuple().exponent for v in values if v is not None])
+
+def to_scaled_array(values, scale):
+    scaled = [int(v * scale) if v is not None else 0 for v in values]
+    try:
+        return np.array(scaled, dtype=np.int64)
+    # absurdly precise (or large) scores; Python ints are slower, but still exact
+    except OverflowError:
+        return np.array(scaled, dtype=object)
+
+class WeekPicks:
+    def __init__(self, usernames, picks):
+        self.usernames = usernames
+        # predicted winners for each user, in matchup order
+        self.winners = [[p['winners'][index] for index in sorted(p['winners'], key=int)] for p in picks]
+        # one column per dropdown, '' if it wasn't picked
+        self.categories = { name: np.array([p.get(name) or '' for p in picks], dtype=str) for name in CATEGORIES }
+        # the scores as they were typed in, which is how they're reported back
+        self.high_scores = [p.get('high_score') for p in picks]
+        self.low_scores = [p.get('low_score') for p in picks]
+
+    @classmethod
+    def from_predictions(cls, predictions, get_picks):
+        predictions = list(predictions)
+        return cls([p['username'] for p in predictions], [get_picks(p) for p in predictions])
+
+    def __len__(self):
+        return len(self.usernames)
+
+    # users × names: whether each user picked each name to win a matchup
+    def picked_winner_matrix(self, names):
+        column_by_name = { name: column for column, name in enumerate(names) }
+        matrix = np.zeros((len(self), len(names)), dtype=bool)
+        for row, winners in enumerate(self.winners):
+            columns = [column_by_name[w] for w in winners if w in column_by_name]
+            matrix[row, columns] = True
+        return matrix
+
+    # whether each user's dropdown pick includes what actually happened;
+    # matchup dropdowns are strings like 'Walker versus Renato', so a name in it counts
+    def picked(self, name, actual):
+        column = self.categories[name]
+        if not len(column):
+            return np.zeros(0, dtype=bool)
+        return (column != '') & (np.char.find(column, actual) >= 0)
+
+def closest_to_pin(usernames, candidates, scores, actual_score):
+    values = [parse_decimal(s) if c else None for s, c in zip(scores, candidates)]
+    actual_score = parse_decimal(actual_score)
+    scale = scale_for(values + [actual_score])
+    candidates = candidates & np.array([v is not None for v in values], dtype=bool)
+    if not candidates.any():
+        return [], '', []
+
+    distance = np.abs(to_scaled_array(values, scale) - int(actual_score * scale))
+    closest = distance[candidates].min()
+    pin_winners = candidates & (distance == closest)
+    within_one_point = candidates & (distance <= scale)
+
+    # the pin score is the first winner's guess, as they typed it
+    first_winner = int(np.flatnonzero(pin_winners)[0])
+    return ([usernames[i] for i in np.flatnonzero(pin_winners)], scores[first_winner],
+        [usernames[i] for i in np.flatnonzero(within_one_point)])
+
+# Returns the same (formula_by_user, winners, stats) build_prediction_stats always has;
+# formula_by_user already includes the closest-to-pin points.
+def score_week(week_picks, result):
+    usernames = week_picks.usernames
+    user_count = len(week_picks)
+
+    # every name we need to know whether someone picked, the blowout winner included
+    names = list(dict.fromkeys(list(result['winners']) + [result['blowout']]))
+    picked_winners = week_picks.picked_winner_matrix(names)
+    actual_winner_columns = [column for column, name in enumerate(names) if name in set(result['winners'])]
+    matchup_total = picked_winners[:, actual_winner_columns].sum(axis=1)
+
+    hits = { name: week_picks.picked(name, result[name]) for name in CATEGORIES }
+    hits['blowout'] = hits['blowout'] & picked_winners[:, names.index(result['blowout'])]
+
+    highest_pin_winners, highest_pin_score, highest_within_one_point = closest_to_pin(usernames,
+        hits['highest'], week_picks.high_scores, result['high_score'])
+    lowest_pin_winners, lowest_pin_score, lowest_within_one_point = closest_to_pin(usernames,
+        hits['lowest'], week_picks.low_scores, result['low_score'])
+
+    highest_bonus = hits['highest'].astype(int)
+    lowest_bonus = hits['lowest'].astype(int)
+    for pin_usernames, bonus in [ (highest_pin_winners, highest_bonus), (highest_within_one_point, highest_bonus),
+            (lowest_pin_winners, lowest_bonus), (lowest_within_one_point, lowest_bonus) ]:
+        bonus[[usernames.index(u) for u in pin_usernames]] += 1
+
+    formula_by_user = {}
+    for i in range(user_count):
+        formula_by_user[usernames[i]] = {
+            'username': usernames[i],
+            'matchup_total': int(matchup_total[i]),
+            'blowout_bonus': int(hits['blowout'][i]),
+            'closest_bonus': int(hits['closest'][i]),
+            'highest_bonus': int(highest_bonus[i]),
+            'lowest_bonus': int(lowest_bonus[i])
+        }
+
+    winners = { name: [usernames[i] for i in np.flatnonzero(hits[name])] for name in CATEGORIES }
+    stats = {
+        # older seasons' results don't have these, and they're only for display anyway
+        'blowout_matchup': result.get('blowout_matchup', ''),
+        'closest_matchup': result.get('closest_matchup', ''),
+        'highest_pin_winners': highest_pin_winners,
+        'highest_pin_score': highest_pin_score,
+        'highest_within_one_point': highest_within_one_point,
+        'lowest_pin_winners': lowest_pin_winners,
+        'lowest_pin_score': lowest_pin_score,
+        'lowest_within_one_point': lowest_within_one_point
+    }
+    return (formula_by_user, winners, stats)
+
+# The draft selection standings after a week, as { username: total }. The first week starts
+# everyone in the league at zero (VERY IMPORTANT, cause we assume every league member has a row),
+# and every week after that is the week before plus whatever they scored this week.
+def cumulative_totals(week, formula_by_user, previous_totals, usernames):
+    if int(week) == 1:
+        totals = { username: 0 for username in usernames }
+        totals.update({ username: PREDICTION_FORMULA(f) for username, f in formula_by_user.items() })
+        return totals
+    return { username: total + (PREDICTION_FORMULA(formula_by_user[username]) if username in formula_by_user else 0)
+        for username, total in previous_totals.items() }
+
+# Replays a whole season, yielding (week, totals) for every week from the first until we run out
+# of results, same as running the prediction calculations every week would have;
+# predictions_by_week and results_by_week are keyed by week (a string, like everywhere else)
+def score_season(usernames, predictions_by_week, results_by_week, get_picks):
+    totals = {}
+    week = 1
+    while str(week) in results_by_week:
+        predictions = predictions_by_week.get(str(week), [])
+        formula_by_user, _, _ = score_week(WeekPicks.from_predictions(predictions, get_picks), results_by_week[str(week)])
+        totals = cumulative_totals(week, formula_by_user, totals, usernames)
+        yield str(week), totals
+        week += 1
@@ -2,23 +2,27 @@ import os
 import json
 import requests
 import traceback
-import copy
+import click
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
 from datetime import datetime
 from flask import request, abort, Response
+from pymongo import MongoClient, UpdateOne
 import flask_restful as restful
 # see __init__.py for these definitions
-from flask_rest_service import app, api, mongo, metadata, post_to_slack, open_dialog, update_message
-
-# we gotta reuse this formula in several spots, so defining it here
-PREDICTION_FORMULA = lambda x: x['matchup_total'] + x['blowout_bonus'] + x['closest_bonus'] + x['highest_bonus'] + x['lowest_bonus']
+from facades.bulk import BulkWriter
+from flask_rest_service import app, api, mongo, metadata, post_to_slack, open_dialog, update_message, deferred, prediction_writes
+from flask_rest_service.prediction_form import (get_prediction_form_template, build_score_text,
+    picks_migration, get_picks, get_predicted_winners, DROPDOWNS)
+from flask_rest_service.prediction_scoring import WeekPicks, score_week, score_season, cumulative_totals, PREDICTION_FORMULA
 
 # FIRST TIME LOOKING AT THIS CODE??? Good. Start looking here.
 # Understanding the JSON structure sent back and forth to Slack is key to understanding this code.
 
 # First, we send an "interactive message" to slack, which ends up looking like the prediction form:
 # - https://api.slack.com/interactive-messages
-# - See the send_prediction_form function for more details on how this JSON structure is built
+# - See build_prediction_form in prediction_form.py for more details on how this JSON structure is built
 # - See the post_to_slack function in __init__.py for details on how this is sent to people in Slack
 
 # Second, when someone clicks on a button in this prediction form, the response is sent to this
@@ -29,8 +33,8 @@ PREDICTION_FORMULA = lambda x: x['matchup_total'] + x['blowout_bonus'] + x['clos
 # Finally, the JSON we just changed in little ways is sent back to Slack, where it replaces the
 # previous prediction form. This is crucial because:
 # - the form appears to change in place
-# - we literally save exactly what the user sees, so problems are immediately obvious
 # - if the POST errors, the form isn't replaced, and the user sees their selection wasn't made
+# We only save the picks themselves though, not the whole form; see prediction_form.py for what's saved.
 @api.route('/prediction/')
 class SavePredictionFromSlack(restful.Resource):
     def post(self):
@@ -57,9 +61,16 @@ class SavePredictionFromSlack(restful.Resource):
         elif any(a['name'] == 'score_submission' for a in actions):
             handle_dialog_display(payload)
 
+        # the form this week's template would have sent is the only thing we'll accept picks from;
+        # anything else (like a stale form from before the matchups were reset) is left unchanged
+        template = get_current_prediction_form_template()
+        if any(template.is_pick(a) and not template.is_valid_pick(a) for a in actions):
+            app.logger.warning('ignoring prediction form picks not on this week\'s form: %s', actions)
+            return Response()
+
         add_styling_to_prediction_form(payload)
 
-        save_form_to_database(payload)
+        save_picks_to_database(payload, template.picks_update(actions))
 
         # Slack replaces old prediction form with any immediate response,
         # so return the form again with any selected buttons styled
@@ -106,23 +117,24 @@ def style_element_with_action(element, action, form_group):
 
 def handle_dialog_submission(payload):
     user_id = payload['user']['id']
-    prediction_cursor = get_form_from_database(payload)
-    prediction = next(prediction_cursor)
-    message = prediction['message']
-    score_button = get_score_button(message)
     high_score = payload['submission']['high_score']
     low_score = payload['submission']['low_score']
 
     try:
         high_decimal = Decimal(high_score)
         low_decimal = Decimal(low_score)
-
-        score_button['text'] = ':heavy_check_mark: High score: ' + high_score + ', Low score: ' + low_score
-        save_scores_to_database(payload, message, high_score, low_score)
+        score_text = build_score_text(high_score, low_score)
     # TODO - Catch explicit exceptions for Decimal parsing
     except:
-        score_button['text'] = ':x: Type in valid decimal numbers next time. No score predictions currently saved.'
-        save_scores_to_database(payload, message, None, None)
+        high_score, low_score = None, None
+        score_text = ':x: Type in valid decimal numbers next time. No score predictions currently saved.'
+    save_picks_to_database(payload, { 'picks.high_score': high_score, 'picks.low_score': low_score })
+
+    # rebuild the form the user's looking at from their picks, including any clicks still buffered
+    prediction = get_prediction_from_database(payload)
+    message = get_current_prediction_form_template().render(get_picks(prediction))
+    score_button = get_score_button(message)
+    score_button['text'] = score_text
 
     # defined in __init__.py
     update_message({
@@ -139,43 +151,36 @@ def get_score_button(message):
     # HACK - this code assumes the scores button is at the bottom of the form
     return attachments[-1] if attachments else ''
 
-def get_form_from_database(payload):
+def get_prediction_from_database(payload):
     username = payload['user']['name']
     # seemed like the best way to store the year and week inside the prediction form
     year, week = payload['callback_id'].split("-")
     database_key = { 'username': username, 'year': year, 'week': week }
-    return mongo.db.predictions.find(database_key)
+    # their last few clicks could still be buffered
+    prediction_writes.flush(database_key)
+    return mongo.db.predictions.find_one(database_key)
 
-def save_form_to_database(payload):
-    message = payload['original_message']
+# picks_update is a $set of just the picks that changed, like { 'picks.winners.2': 'Walker' }
+def save_picks_to_database(payload, picks_update):
     username = payload['user']['name']
     # seemed like the best way to store the year and week inside the prediction form
     year, week = payload['callback_id'].split("-")
     database_key = { 'username': username, 'year': year, 'week': week }
 
-    # guarantee one record per user and year/week
-    mongo.db.predictions.update_one(database_key, {
-        '$set': {
-            'message': message,
-            'last_modified': datetime.now()
-        },
-    }, upsert=True)
-
-def save_scores_to_database(payload, message, high_score, low_score):
-    username = payload['user']['name']
-    # seemed like the best way to store the year and week inside the prediction form
-    year, week = payload['callback_id'].split("-")
-    database_key = { 'username': username, 'year': year, 'week': week }
-
-    # guarantee one record per user and year/week
-    mongo.db.predictions.update_one(database_key, {
-        '$set': {
-            'message': message,
-            'high_score': high_score,
-            'low_score': low_score,
-            'last_modified': datetime.now()
-        },
-    }, upsert=True)
+    # guarantee one record per user and year/week; clicks come fast right before the deadline,
+    # so they're merged and written a moment later, and only if nothing newer was saved in the
+    # meantime by another worker (see facades/write_behind.py)
+    prediction_writes.set(database_key, picks_update, flush_by=metadata.deadline_time)
+
+# Predictions used to save the whole prediction form; this moves them over to just the picks.
+# Safe to run more than once. Run it with `flask backfill-picks`, see the readme.
+@app.cli.command('backfill-picks')
+@click.option('--keep-messages', is_flag=True, help='Keep the old prediction forms around after copying the picks out.')
+def backfill_picks(keep_messages):
+    with BulkWriter(app, mongo.db.predictions) as writer:
+        for prediction in mongo.db.predictions.find({ 'message': { '$exists': True } }):
+            writer.add(UpdateOne({ '_id': prediction['_id'] }, picks_migration(prediction, keep_messages)))
+    click.echo('Backfilled picks for ' + str(writer.summary['requests']) + ' predictions.')
 
 # This endpoint loops through any saved predictions for the current week and posts them
 # in response to whoever ran the command in Slack. It's also a good way to understand the
@@ -183,11 +188,11 @@ def save_scores_to_database(payload, message, high_score, low_score):
 @api.route('/prediction/submissions/')
 class GetSubmittedPredictions(restful.Resource):
     def post(self):
-        metadata.invalidate_cached_week()
-
         # since it's a direct Slack command, you'll need to respond with an error message
         if datetime.now() < metadata.deadline_time:
             return Response('Submitted predictions are not visible until the submission deadline has passed.')
+        # everything's flushed by the deadline anyway, unless it's only just passed
+        prediction_writes.flush()
 
         message = {
             'response_type': 'in_channel',
@@ -198,15 +203,13 @@ class GetSubmittedPredictions(restful.Resource):
         # for each submitted prediction that week
         for prediction in mongo.db.predictions.find({ 'year': metadata.league_year, 'week': metadata.league_week }):
             username = prediction['username']
-            form_groups = prediction['message']['attachments']
+            picks = get_picks(prediction)
             prediction_string = username + ' picks: '
 
-            predicted_winners = [element['text']
-                for g in form_groups for element in g['actions'] if is_button_selected(element)]
-            prediction_string += ', '.join(predicted_winners) + '\n'
+            prediction_string += ', '.join(get_predicted_winners(picks)) + '\n'
 
-            dropdown_selections = [format_dropdown_selection(element, g, prediction)
-                for g in form_groups for element in g['actions'] if is_dropdown_selected(element)]
+            dropdown_selections = [format_dropdown_selection(dropdown, picks)
+                for dropdown in DROPDOWNS if picks.get(dropdown['name'])]
             prediction_string += ' | '.join(dropdown_selections)
 
             # one message attachment per user
@@ -216,25 +219,16 @@ class GetSubmittedPredictions(restful.Resource):
     def get(self):
         return GetSubmittedPredictions.post(self)
 
-def is_button_selected(element):
-    return (element['type'] == 'button' and 'style' in element and element['style'] == 'primary'
-            and element['name'] != 'score_submission')
-
-def is_dropdown_selected(element):
-    return element['type'] == 'select' and 'selected_options' in element
-
-def format_dropdown_selection(element, form_group, prediction):
-    selected = element['selected_options'][0]
-    # I'm counting on the fallback key holding the name of the dropdown,
-    # so prepend the selection with this name
-    selected_string = form_group['fallback'] + ': ' + selected['text']
+def format_dropdown_selection(dropdown, picks):
+    # prepend the selection with the name of the dropdown
+    selected_string = dropdown['label'] + ': ' + picks[dropdown['name']]
 
     # if there's a score prediction, add that too
-    if 'high_score' in prediction and 'low_score' in prediction:
-        if "highest" in form_group['text']:
-            selected_string += ', ' + prediction['high_score']
-        elif "lowest" in form_group['text']:
-            selected_string += ', ' + prediction['low_score']
+    if picks.get('high_score') is not None and picks.get('low_score') is not None:
+        if dropdown['name'] == 'highest':
+            selected_string += ', ' + picks['high_score']
+        elif dropdown['name'] == 'lowest':
+            selected_string += ', ' + picks['low_score']
 
     return selected_string
 
@@ -262,11 +256,15 @@ def build_dialog(payload):
         ]
     }
 
-# This is how the sausage is made. This code is pretty boring, but it lays out pretty explicitly
-# the JSON that makes up the prediction form. See the "interactive message" docs for more details:
-# https://api.slack.com/interactive-messages
+def get_current_prediction_form_template():
+    return get_prediction_form_template(metadata.league_year, metadata.league_week, metadata.matchups,
+        metadata.deadline_string, metadata.prediction_eligible_members)
+
+# See prediction_form.py for how the form itself is built.
 @api.route('/prediction/form/')
 class SendPredictionForm(restful.Resource):
+    # every DM can wait out Slack's rate limits, which takes longer than Slack waits for a command
+    @deferred('send_prediction_form')
     def post(self):
         # since it's a direct Slack command, you'll need to respond with an error message
         if datetime.now() > metadata.deadline_time:
@@ -277,99 +275,17 @@ class SendPredictionForm(restful.Resource):
         if list(mongo.db.predictions.find({ 'year': metadata.league_year, 'week': metadata.league_week })):
             return Response('Prediction forms cannot be sent after a prediction has been submitted this week.')
 
-        message = {
-            'text': 'Make your predictions for week ' + metadata.league_week + ' matchups below by ' + metadata.deadline_string + ':',
-            'attachments': []
-        }
-        # seemed like the best way to store the year and week inside the prediction form
-        callback_id = metadata.league_year + '-' + metadata.league_week
-
-        for index, matchup in enumerate(metadata.matchups):
-            message['attachments'].append({
-                'text': matchup['team_one'] + ' versus ' + matchup['team_two'],
-                'attachment_type': 'default',
-                'callback_id': callback_id,
-                'actions': [
-                    {
-                        # buttons in the same form group need to match on name to be styled properly
-                        'name': 'winner' + str(index),
-                        'text': matchup['team_one'],
-                        'type': 'button',
-                        'value': matchup['team_one']
-                    },
-                    {
-                        'name': 'winner' + str(index),
-                        'text': matchup['team_two'],
-                        'type': 'button',
-                        'value': matchup['team_two']
-                    }
-                ]
-            })
-
-        matchup_dropdown_template = {
-            'text': 'Which matchup will have the biggest blowout?',
-            # the intent of 'fallback' seems to be to provide some screenreader/accesibility support,
-            # but it also works to support what we display when we report everyone's predictions
-            # for the week, so this is coupled to the functionality in GetSubmittedPredictions
-            'fallback': 'Blowout',
-            'attachment_type': 'default',
-            'callback_id': callback_id,
-            'actions': [
-                {
-                    'name': 'blowout',
-                    'text': 'Pick a matchup...',
-                    'type': 'select',
-                    'options': []
-                }
-            ]
-        }
-        for matchup in metadata.matchups:
-            matchup_dropdown_template['actions'][0]['options'].append({
-                'text': matchup['team_one'] + ' versus ' + matchup['team_two'],
-                'value': matchup['team_one'] + ' versus ' + matchup['team_two']
-            })
-        message['attachments'].append(matchup_dropdown_template)
-
-        # reuse our existing dropdown object for the rest
-        dropdown = copy.deepcopy(matchup_dropdown_template)
-        dropdown['text'] = 'Which matchup will have the closest score?'
-        dropdown['fallback'] = 'Closest'
-        dropdown['actions'][0]['name'] = 'closest'
-        message['attachments'].append(dropdown)
-
-        # highest/lowest dropdowns should list teams, not matchups
-        member_dropdown_template = copy.deepcopy(matchup_dropdown_template)
-        member_dropdown_template['actions'][0]['text'] = 'Pick a team...'
-        member_dropdown_template['actions'][0]['options'] = [ { 'text': name, 'value': name } for name in metadata.prediction_eligible_members ]
-
-        dropdown = copy.deepcopy(member_dropdown_template)
-        dropdown['text'] = 'Who will be the highest scorer?'
-        dropdown['fallback'] = 'Highest'
-        dropdown['actions'][0]['name'] = 'highest'
-        message['attachments'].append(dropdown)
-
-        dropdown = copy.deepcopy(member_dropdown_template)
-        dropdown['text'] = 'Who will be the lowest scorer?'
-        dropdown['fallback'] = 'Lowest'
-        dropdown['actions'][0]['name'] = 'lowest'
-        message['attachments'].append(dropdown)
-
-        message['attachments'].append({
-            'text': ':x: No submission for high/low score yet',
-            'attachment_type': 'default',
-            'callback_id': callback_id,
-            'actions': [
-                {
-                    'name': 'score_submission',
-                    'text': 'Enter Scores',
-                    'type': 'button',
-                    'value': 'score_submission'
-                }
-            ]
-        })
+        # everyone gets the same form, so one copy does for all of them
+        message = get_current_prediction_form_template().copy()
 
         # defined in __init__.py
-        post_to_slack(message)
+        results = post_to_slack(message)
+
+        # let whoever ran the command know who didn't get a form, so they can resend by hand
+        failed_user_ids = [r['user_id'] for r in results if not r['ok']]
+        if failed_user_ids:
+            failed_members = [m['display_name'] for m in metadata.league['members'] if m['slack_user_id'] in failed_user_ids]
+            return Response('Prediction form could not be sent to: ' + ', '.join(failed_members))
 
         return
     def get(self):
@@ -378,9 +294,8 @@ class SendPredictionForm(restful.Resource):
 # WARNING - I saved the most complicated code for the end. Don't skip the comment at the top!
 @api.route('/prediction/calculations/')
 class CalculatePredictions(restful.Resource):
+    @deferred('prediction_calculations')
     def post(self):
-        metadata.invalidate_cached_week()
-
         # since it's a direct Slack command, you'll need to respond with an error message
         # can't calculate predictions for the week before in the first week
         # in practice, __init__.py checks for the latest week to start
@@ -395,20 +310,30 @@ class CalculatePredictions(restful.Resource):
         # we currently store ESPN matchup results by triggering a Slack command;
         # see scoreboard.py and the '/scoreboard/matchupresults/' endpoint for more details
         matchup_result = mongo.db.matchup_results.find_one({ 'year': metadata.league_year, 'week': metadata.last_league_week })
-        formula_by_user, prediction_winners, closest_to_pin_stats = build_prediction_stats(matchup_result)
-
-        message['attachments'].append({ 'text': build_results_string(matchup_result, closest_to_pin_stats) })
-        message['attachments'].append({ 'text': build_bonus_string(prediction_winners, closest_to_pin_stats, formula_by_user) })
-        message['attachments'].append({ 'text': build_formula_string(formula_by_user) })
-
-        # first update the standings, then print the results
-        update_prediction_standings(formula_by_user)
-        message['attachments'].append({ 'text': build_standings_string() })
+        week = int(metadata.last_league_week)
+        previous_totals = find_prediction_totals(metadata.league_year, week - 1) if week > 1 else {}
+        message['attachments'], totals = calculate_predictions(metadata.league_year, week, matchup_result, previous_totals)
 
         return message
     def get(self):
         return CalculatePredictions.post(self)
 
+# Scores a week's predictions against its matchup result, and saves everyone's standings for the season
+# so far, given the standings from the week before; returns the attachments to show, and the new standings.
+def calculate_predictions(year, week, matchup_result, previous_totals):
+    formula_by_user, prediction_winners, closest_to_pin_stats = build_prediction_stats(year, week, matchup_result)
+
+    attachments = []
+    attachments.append({ 'text': build_results_string(matchup_result, closest_to_pin_stats) })
+    attachments.append({ 'text': build_bonus_string(prediction_winners, closest_to_pin_stats) })
+    attachments.append({ 'text': build_formula_string(formula_by_user) })
+
+    # first update the standings, then print the results
+    totals = update_prediction_standings(year, week, formula_by_user, previous_totals)
+    attachments.append({ 'text': build_standings_string(totals) })
+
+    return attachments, totals
+
 def build_results_string(result, stats):
     results_string = 'Winners: ' + ', '.join(result['winners']) + '\n'
     results_string += 'Blowout: ' + stats['blowout_matchup']
@@ -417,7 +342,7 @@ def build_results_string(result, stats):
     results_string += 'Lowest: ' + result['lowest'] + ', ' + result['low_score']
     return results_string
 
-def build_bonus_string(winners, stats, formula_by_user):
+def build_bonus_string(winners, stats):
     bonus_string = ''
 
     if not winners['blowout']:
@@ -439,14 +364,10 @@ def build_bonus_string(winners, stats, formula_by_user):
     bonus_string += ' got a point for guessing the highest scorer'
     highest_pin_winners = stats['highest_pin_winners']
     if highest_pin_winners:
-        for winner in highest_pin_winners:
-            formula_by_user[winner]['highest_bonus'] += 1
         bonus_string += ', with ' + ', '.join(highest_pin_winners[:-2] + [' and '.join(highest_pin_winners[-2:])])
         bonus_string += ' getting an extra point for guessing the highest score'
     winners_within_one_point = stats['highest_within_one_point'];
     if winners_within_one_point:
-        for winner in winners_within_one_point:
-            formula_by_user[winner]['highest_bonus'] += 1
         bonus_string += '. ' + ', '.join(winners_within_one_point[:-2] + [' and '.join(winners_within_one_point[-2:])])
         bonus_string += ' got a third point for guessing the score within a point'
     bonus_string += '.\n'
@@ -458,14 +379,10 @@ def build_bonus_string(winners, stats, formula_by_user):
     bonus_string += ' got a point for guessing the lowest scorer'
     lowest_pin_winners = stats['lowest_pin_winners']
     if lowest_pin_winners:
-        for winner in lowest_pin_winners:
-            formula_by_user[winner]['lowest_bonus'] += 1
         bonus_string += ', with ' + ', '.join(lowest_pin_winners[:-2] + [' and '.join(lowest_pin_winners[-2:])])
         bonus_string += ' getting an extra point for guessing the lowest score'
     winners_within_one_point = stats['lowest_within_one_point'];
     if winners_within_one_point:
-        for winner in winners_within_one_point:
-            formula_by_user[winner]['lowest_bonus'] += 1
         bonus_string += '. ' + ', '.join(winners_within_one_point[:-2] + [' and '.join(winners_within_one_point[-2:])])
         bonus_string += ' got a third point for guessing the score within a point'
     bonus_string += '.\n'
@@ -486,185 +403,84 @@ def build_formula_string(formula_by_user):
             ' + ' + str(user_formula['lowest_bonus']) + '\n'
     return formula_string
 
-def build_standings_string():
-    standings = mongo.db.prediction_standings.find({ 'year': metadata.league_year, 'week': metadata.last_league_week }).sort(
-        # see scoreboard.py and the '/scoreboard/tiebreakers/' for a command
-        # that factors in tiebreakers when sorting waiver order standings
-        [('total', -1)])
+def build_standings_string(totals):
     standings_string = 'Draft selection standings for the season so far:\n'
-    for prediction_record in standings:
-        standings_string += prediction_record['username'] + ' - ' + str(prediction_record['total']) + '\n'
+    # see scoreboard.py and the '/scoreboard/tiebreakers/' for a command
+    # that factors in tiebreakers when sorting waiver order standings
+    for username, total in sorted(totals.items(), key=lambda t: -t[1]):
+        standings_string += username + ' - ' + str(total) + '\n'
     return standings_string
 
-def build_prediction_stats(result):
-    formula_by_user = {}
-    winners = {
-        'matchup': [],
-        'blowout': [],
-        'closest': [],
-        'highest': [],
-        'lowest': []
-    }
-    stats = {
-        'blowout_matchup': result['blowout_matchup'],
-        'closest_matchup': result['closest_matchup'],
-        'highest_pin_winners': [],
-        'highest_pin_score': '',
-        'highest_within_one_point': [],
-        'lowest_pin_winners': [],
-        'lowest_pin_score': '',
-        'lowest_within_one_point': []
-    }
-    actual_winners = result['winners']
-    for prediction in mongo.db.predictions.find({ 'year': metadata.league_year, 'week': metadata.last_league_week }):
-        username = prediction['username']
-        form_groups = prediction['message']['attachments']
-        user_formula = {
-            'username': username,
-            'matchup_total': 0,
-            'blowout_bonus': 0,
-            'closest_bonus': 0,
-            'highest_bonus': 0,
-            'lowest_bonus': 0
-        }
+# see prediction_scoring.py; the closest-to-pin points are already in formula_by_user
+def build_prediction_stats(year, week, result):
+    predictions = mongo.db.predictions.find({ 'year': str(year), 'week': str(week) })
+    return score_week(WeekPicks.from_predictions(predictions, get_picks), result)
+
+# everyone's draft selection standings for a week, like { 'walker': 37, ... }
+def find_prediction_totals(year, week):
+    return { r['username']: r['total']
+        for r in mongo.db.prediction_standings.find({ 'year': str(year), 'week': str(week) }, { 'username': 1, 'total': 1 }) }
+
+def update_prediction_standings(year, week, formula_by_user, previous_totals):
+    totals = cumulative_totals(week, formula_by_user, previous_totals, metadata.usernames)
+    with BulkWriter(app, mongo.db.prediction_standings) as writer:
+        for username, total in totals.items():
+            database_key = { 'username': username, 'year': str(year), 'week': str(week) }
+            writer.upsert(database_key, { 'total': total })
+    return totals
+
+# If a past week's matchup results get fixed, every week's standings after it are wrong too, since
+# each week builds on the last. This replays whole seasons from the predictions and matchup results
+# and rewrites their standings. Run it with `flask rescore-predictions`, see the readme.
+@app.cli.command('rescore-predictions')
+@click.option('--year', 'years', multiple=True, help='Season to rescore; repeat for more than one.')
+@click.option('--all', 'all_years', is_flag=True, help='Rescore every season, older rules and all (see the readme).')
+@click.option('--workers', default=4, help='How many seasons to rescore at once.')
+@click.option('--dry-run', is_flag=True, help='Report how many standings would change without writing them.')
+def rescore_predictions(years, all_years, workers, dry_run):
+    # old seasons come out different under today's rules, so rewriting all of them has to be asked for
+    if bool(years) == all_years:
+        raise click.UsageError('Pass --year (more than once for more seasons), or --all for every season.')
+    years = list(years) or sorted(mongo.db.matchup_results.distinct('year'))
+    if not years:
+        click.echo('No matchup results to rescore.')
+        return
 
-        # under this logic, that button text better match what's listed in the matchup_results table
-        # TODO - Maybe not store matchup_results using names like "Freddy" or "Walker"
-        # TODO - Also note the button's text and value can be different things, could use this
-        winners['matchup'] = [element['text']
-            for g in form_groups for element in g['actions'] if is_button_selected(element)]
-        # find intersection of predicted and actual winners, and add that count to the total
-        user_formula['matchup_total'] += len(set(winners['matchup']) & set(actual_winners))
-
-        winners['blowout'] += [username
-            for g in form_groups for element in g['actions']
-            if is_blowout_winner_predicted(element, g, result, winners['matchup'])]
-        if username in winners['blowout']:
-            user_formula['blowout_bonus'] += 1
-
-        winners['closest'] += [username
-            for g in form_groups for element in g['actions']
-            if is_closest_predicted(element, g, result)]
-        if username in winners['closest']:
-            user_formula['closest_bonus'] += 1
-
-        winners['highest'] += [username
-            for g in form_groups for element in g['actions']
-            if is_highest_predicted(element, g, result)]
-        if username in winners['highest']:
-            user_formula['highest_bonus'] += 1
-            if 'high_score' in prediction:
-                stats['highest_pin_winners'], stats['highest_pin_score'], stats['highest_within_one_point'] = (
-                    set_closest_to_pin_variables(username, prediction['high_score'], result['high_score'], stats['highest_pin_winners'], stats['highest_pin_score'], stats['highest_within_one_point']))
-
-        winners['lowest'] += [username
-            for g in form_groups for element in g['actions']
-            if is_lowest_predicted(element, g, result)]
-        if username in winners['lowest']:
-            user_formula['lowest_bonus'] += 1
-            if 'low_score' in prediction:
-                stats['lowest_pin_winners'], stats['lowest_pin_score'], stats['lowest_within_one_point'] = (
-                    set_closest_to_pin_variables(username, prediction['low_score'], result['low_score'], stats['lowest_pin_winners'], stats['lowest_pin_score'], stats['lowest_within_one_point']))
-
-        # after processing all this user's selections
-        formula_by_user[username] = user_formula
-    return (formula_by_user, winners, stats)
-
-def is_blowout_selected(element, form_group):
-    return element['type'] == 'select' and 'blowout' in form_group['text'] and 'selected_options' in element
-
-def is_blowout_winner_predicted(element, form_group, result, winners):
-    if is_blowout_selected(element, form_group):
-        selected = element['selected_options'][0]
-        return result['blowout'] in selected['text'] and result['blowout'] in winners
-    return False
-
-def is_closest_selected(element, form_group):
-    return element['type'] == 'select' and 'closest' in form_group['text'] and 'selected_options' in element
-
-def is_closest_predicted(element, form_group, result):
-    if is_closest_selected(element, form_group):
-        selected = element['selected_options'][0]
-        return result['closest'] in selected['text']
-    return False
-
-def is_highest_selected(element, form_group):
-    return element['type'] == 'select' and 'highest' in form_group['text'] and 'selected_options' in element
-
-def is_highest_predicted(element, form_group, result):
-    if is_highest_selected(element, form_group):
-        selected = element['selected_options'][0]
-        return result['highest'] in selected['text']
-    return False
-
-def is_lowest_selected(element, form_group):
-    return element['type'] == 'select' and 'lowest' in form_group['text'] and 'selected_options' in element
-
-def is_lowest_predicted(element, form_group, result):
-    if is_lowest_selected(element, form_group):
-        selected = element['selected_options'][0]
-        return result['lowest'] in selected['text']
-    return False
-
-def set_closest_to_pin_variables(candidate_winner, candidate_score, actual_score, current_winners, current_closest_score, current_winners_within_one_point):
-    candidate_score_decimal = Decimal(candidate_score)
-    actual_score_decimal = Decimal(actual_score)
-    candidate_distance_to_pin = abs(candidate_score_decimal - actual_score_decimal)
-    if candidate_distance_to_pin <= 1:
-        current_winners_within_one_point.append(candidate_winner)
-
-    if current_winners and current_closest_score:
-        current_closest_decimal = Decimal(current_closest_score)
-        current_distance_to_pin = abs(current_closest_decimal - actual_score_decimal)
-        # rules conference says we should support ties, make it so
-        if current_distance_to_pin == candidate_distance_to_pin:
-            current_winners.append(candidate_winner)
-            return (current_winners, current_closest_score, current_winners_within_one_point)
-        elif current_distance_to_pin > candidate_distance_to_pin:
-            return ([candidate_winner], candidate_score, current_winners_within_one_point)
-        else:
-            return (current_winners, current_closest_score, current_winners_within_one_point)
-    # no highest/lowest recorded so far? you're the winner by default
-    return ([candidate_winner], candidate_score, current_winners_within_one_point)
-
-def update_prediction_standings(formula_by_user):
-    if int(metadata.last_league_week) == 1:
-        # put zeroes there for anyone who missed the first prediction
-        # VERY IMPORTANT, cause we assume every league member has a row in this table
-        users_without_predictions = list(set(metadata.usernames) - set(formula_by_user.keys()))
-        for username in users_without_predictions:
-            database_key = { 'username': username, 'year': metadata.league_year, 'week': metadata.last_league_week }
-            mongo.db.prediction_standings.update_one(database_key, {
-                '$set': {
-                    'total': 0
-                },
-            }, upsert=True)
-        # loop through everyone who submitted a prediction this week
-        for user_formula in formula_by_user.values():
-            formula_total = PREDICTION_FORMULA(user_formula)
-            database_key = { 'username': user_formula['username'], 'year': metadata.league_year, 'week': metadata.last_league_week }
-            # standings on the first week is trivial and exactly the same as waiver order standings
-            mongo.db.prediction_standings.update_one(database_key, {
-                '$set': {
-                    'total': formula_total
-                },
-            }, upsert=True)
-
-    if int(metadata.last_league_week) > 1:
-        week_before = str(int(metadata.last_league_week) - 1)
-        week_before_standings = mongo.db.prediction_standings.find({ 'year': metadata.league_year, 'week': week_before })
-        for prediction_record in week_before_standings:
-            username = prediction_record['username']
-            database_key = { 'username': username, 'year': metadata.league_year, 'week': metadata.last_league_week }
-
-            if username in formula_by_user:
-                formula_total = PREDICTION_FORMULA(formula_by_user[username])
-            else:
-                formula_total = 0
-
-            mongo.db.prediction_standings.update_one(database_key, {
-                '$set': {
-                    'total': prediction_record['total'] + formula_total
-                },
-            }, upsert=True)
-    return
+    # seasons don't depend on each other, so each one gets its own process (and database connection);
+    # spawned, not forked, since forking a process with threads running (see __init__.py) can copy a
+    # lock one of them was holding, and the child would wait on it forever
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(years))), mp_context=multiprocessing.get_context('spawn')) as executor:
+        for year, weeks, changed in executor.map(rescore_season, [app.config['MONGO_URI']] * len(years), years, [dry_run] * len(years)):
+            click.echo('Rescored ' + year + ': ' + str(weeks) + ' weeks, ' + str(changed) + ' standings '
+                + ('would change.' if dry_run else 'changed.'))
+
+# runs in its own process, so it can't use the app's connection
+def rescore_season(mongo_uri, year, dry_run=False):
+    client = MongoClient(mongo_uri)
+    try:
+        db = client.get_default_database()
+        league = db.league_metadata.find_one({ 'year': year })
+        usernames = [m['slack_username'] for m in league['members']] if league else []
+
+        results_by_week = { r['week']: r for r in db.matchup_results.find({ 'year': year }) }
+        predictions_by_week = {}
+        for prediction in db.predictions.find({ 'year': year }, { 'last_modified': 0, 'set_at': 0 }):
+            predictions_by_week.setdefault(prediction['week'], []).append(prediction)
+
+        # only write the standings that actually change
+        saved_totals = { (s['username'], s['week']): s.get('total')
+            for s in db.prediction_standings.find({ 'year': year }, { 'username': 1, 'week': 1, 'total': 1 }) }
+
+        weeks, changed = 0, 0
+        writer = BulkWriter(app, db.prediction_standings)
+        for week, totals in score_season(usernames, predictions_by_week, results_by_week, get_picks):
+            weeks += 1
+            for username, total in totals.items():
+                if saved_totals.get((username, week)) != total:
+                    changed += 1
+                    writer.upsert({ 'username': username, 'year': year, 'week': week }, { 'total': total })
+        if not dry_run:
+            writer.flush()
+        return year, weeks, changed
+    finally:
+        client.close()
@@ -0,0 +1,91 @@
+import random
+from collections import Counter
+from datetime import datetime
+# see __init__.py for these definitions
+from flask_rest_service import app, mongo
+
+# Ranks standings by a list of tiebreaks, in order, like "most total, then fewest wins, then fewest
+# points, then a coin flip". Every standings command (waivers, draft order, playoff seeding) should
+# rank this way, so they all break ties the same way and say how they did it:
+#
+#   ranked = rank_with_coin_flip(standings, [ Tiebreak('total', descending=True), Tiebreak('wins') ],
+#       'waivers', year, week)
+#
+# Each ranked row is a copy of the row passed in, plus:
+# - 'tied_on', the tiebreaks it was still tied with someone after (empty if it wasn't tied at all)
+# - 'decided_by', the tiebreak that finally separated it from everyone else, COIN_FLIP if it took
+#   a coin flip, or None if it's still tied after everything (and there's no coin flip)
+
+COIN_FLIP = 'coin flip'
+
+# one level of tiebreaking: the field it compares, and whether more is better
+class Tiebreak:
+    def __init__(self, field, descending=False):
+        self.field = field
+        self.descending = descending
+
+    def sort_value(self, row):
+        return -row[self.field] if self.descending else row[self.field]
+
+# With a coin_flip_seed, anyone tied after every tiebreak is ordered by a coin flip from that seed;
+# the flips are drawn in order of identity (not the order of rows), so the same seed and the same
+# people always flip the same way. Without one, ties stay in the order the rows came in.
+def rank(rows, tiebreaks, coin_flip_seed=None, identity='username'):
+    rows = list(rows)
+    keys = [tuple(t.sort_value(row) for t in tiebreaks) for row in rows]
+
+    if coin_flip_seed is not None:
+        coin = random.Random(coin_flip_seed)
+        flips = { name: coin.random() for name in sorted(row[identity] for row in rows) }
+        keys = [key + (flips[row[identity]],) for key, row in zip(keys, rows)]
+
+    # how many rows share each key, level by level, so finding ties is a lookup rather than a scan
+    levels = len(tiebreaks) + (coin_flip_seed is not None)
+    names = [t.field for t in tiebreaks] + [COIN_FLIP]
+    counts = [Counter(key[:level + 1] for key in keys) for level in range(levels)]
+
+    ranked = []
+    for key, row in sorted(zip(keys, rows), key=lambda pair: pair[0]):
+        tied_on = []
+        decided_by = None
+        for level in range(levels):
+            if counts[level][key[:level + 1]] == 1:
+                decided_by = names[level]
+                break
+            tied_on.append(names[level])
+        ranked.append(dict(row, tied_on=tied_on, decided_by=decided_by))
+    return ranked
+
+# Ranks by the tiebreaks, and if anyone's still tied after all of them, by a coin flip from that
+# week's seed; the seed's only drawn (and saved) if there's a tie to break. week is the week that
+# was just played, for every kind of standings, so a week's seeds all line up.
+def rank_with_coin_flip(rows, tiebreaks, kind, year, week):
+    rows = list(rows)
+    ranked = rank(rows, tiebreaks)
+    if all(row['decided_by'] for row in ranked):
+        return ranked
+
+    seed = coin_flip_seed(kind, year, week)
+    ranked = rank(rows, tiebreaks, coin_flip_seed=seed)
+    log_coin_flips(kind, year, week, ranked, seed)
+    return ranked
+
+# The seed for a week's coin flips, saved in the coin_flips collection the first time it's needed,
+# so asking for the same standings again gives the same answer (and anyone can check it later).
+def coin_flip_seed(kind, year, week):
+    with app.app_context():
+        record = mongo.db.coin_flips.find_one_and_update({ '_id': kind + '-' + str(year) + '-' + str(week) }, {
+            '$setOnInsert': {
+                'kind': kind,
+                'year': str(year),
+                'week': str(week),
+                'seed': random.randrange(2 ** 32),
+                'created_at': datetime.now(),
+            }
+        }, upsert=True, return_document=True)
+    return record['seed']
+
+def log_coin_flips(kind, year, week, ranked, seed):
+    flipped = [r['username'] for r in ranked if r['decided_by'] == COIN_FLIP]
+    if flipped:
+        app.logger.info('coin flip applied kind=%s year=%s week=%s seed=%s usernames=%s', kind, year, week, seed, ','.join(flipped))
@@ -6,16 +6,23 @@ import pprint
 import random
 import requests
 from decimal import Decimal
+from facades.bulk import BulkWriter
 from datetime import datetime, time, timedelta
 from flask import request, abort, Response
 import flask_restful as restful
 # see __init__.py for these definitions
-from flask_rest_service import app, api, mongo, metadata, post_to_slack, open_dialog, update_message
+from flask_rest_service import app, api, mongo, metadata, post_to_slack, open_dialog, update_message, deferred
+from flask_rest_service.head_to_head import update_head_to_head_week
+from flask_rest_service.season_summaries import update_season_summary
+from flask_rest_service.ranking import Tiebreak, rank, rank_with_coin_flip, COIN_FLIP
+from flask_rest_service.standings import team_standings, espn_team_standings
+from flask_rest_service.predictions import find_prediction_totals
 
 # These endpoints encapsulate interactions with the ESPN API:
 # https://github.com/cwendt94/espn-api/wiki/Football-Intro
 @api.route('/scoreboard/')
 class Scoreboard(restful.Resource):
+    @deferred('scoreboard')
     def post(self):
         # for direct Slack commands, you don't get a payload like an interactive message action,
         # you have to parse the text of the parameters
@@ -37,132 +44,143 @@ class Scoreboard(restful.Resource):
         if datetime.now() > metadata.deadline_time:
             week_shown = metadata.league_week
 
-        matchups = []
         week = int(week_shown)
         box_scores = metadata.espn.box_scores(week)
+        scores, message['attachments'] = build_scores(metadata.league_year, week, box_scores)
 
-        last_week_of_regular_season = metadata.espn.weeks_in_regular_season
-        number_of_teams_in_league = metadata.espn.number_of_teams
-        number_of_playoff_teams = metadata.espn.number_of_playoff_teams
-
-        is_playoff = week > last_week_of_regular_season
-        is_round_one = last_week_of_regular_season + 1 == week
-        is_round_two = last_week_of_regular_season + 2 == week
-        is_round_three = last_week_of_regular_season + 3 == week
-        is_quarterfinals = number_of_playoff_teams > 4 and is_round_one
-        is_semifinals = is_round_two if (number_of_playoff_teams > 4) else is_round_one
-        is_finals = is_round_three if (number_of_playoff_teams > 4) else is_round_two
-        is_consolation_finals = is_semifinals if (number_of_teams_in_league < 12 and number_of_playoff_teams > 4) else is_finals
-        is_consolation_over = is_round_three and not is_consolation_finals
-
-        for s in box_scores:
-            if not hasattr(s.home_team, 'owners') or not hasattr(s.away_team, 'owners'):
-                continue
-
-            # TODO - This should support inserting co-owners
-            home_espn_id = s.home_team.owners[0]['id']
-            winner = metadata.player_lookup_by_espn_owner_id[home_espn_id]['player_id']
-            away_espn_id = s.away_team.owners[0]['id']
-            loser = metadata.player_lookup_by_espn_owner_id[away_espn_id]['player_id']
-            winning_score = s.home_score
-            losing_score = s.away_score
-            winning_team = s.home_team
-            losing_team = s.away_team
-            if (s.away_score > s.home_score):
-                winner = metadata.player_lookup_by_espn_owner_id[away_espn_id]['player_id']
-                loser = metadata.player_lookup_by_espn_owner_id[home_espn_id]['player_id']
-                winning_score = s.away_score
-                losing_score = s.home_score
-                winning_team = s.away_team
-                losing_team = s.home_team
+        # scores can be a minute or two old (or older, if ESPN is having a bad day), so say so
+        if not box_scores.is_final:
+            message['text'] = 'Live scores from ESPN ' + build_freshness_string(box_scores.fetched_at) + ':'
 
-            if s.matchup_type == 'WINNERS_CONSOLATION_LADDER':
-                if is_round_three:
-                    index_for_round_two = last_week_of_regular_season + 2 - 1
-                    round_two_winners_game = winning_team.outcomes[index_for_round_two]
-                    round_two_losers_game = losing_team.outcomes[index_for_round_two]
-                    # if either team won the last game, this isn't the third place game
-                    if round_two_winners_game == 'W' or round_two_losers_game == 'W':
-                        continue
-                else:
-                    continue
-
-            if s.matchup_type == 'LOSERS_CONSOLATION_LADDER':
-                if is_consolation_over:
-                   continue
-
-                # HACK - if they won any completed consolation game, ignore the box score
-                index_for_round_two = last_week_of_regular_season + 2 - 1
-                if is_round_three:
-                    round_two_winners_game = winning_team.outcomes[index_for_round_two]
-                    round_two_losers_game = losing_team.outcomes[index_for_round_two]
-                    if round_two_winners_game == 'W' or round_two_losers_game == 'W':
-                        continue
-
-                index_for_round_one = last_week_of_regular_season + 1 - 1
-                if not is_round_one:
-                    round_one_winners_game = winning_team.outcomes[index_for_round_one]
-                    round_one_losers_game = losing_team.outcomes[index_for_round_one]
-                    if round_one_winners_game == 'W' or round_one_losers_game == 'W':
-                        continue
-
-            home_name = metadata.player_lookup_by_espn_owner_id[home_espn_id]['display_name']
-            matchup_string = home_name + ' - ' + str(s.home_score)
-            if (s.home_projected != -1 and not math.isclose(s.home_score, s.home_projected, abs_tol=0.01)):
-                matchup_string += ' (' + str(s.home_projected) + ')'
-
-            away_name = metadata.player_lookup_by_espn_owner_id[away_espn_id]['display_name']
-            matchup_string += ' versus ' + away_name + ' - ' + str(s.away_score)
-            if (s.away_projected != -1 and not math.isclose(s.away_score, s.away_projected, abs_tol=0.01)):
-                matchup_string += ' (' + str(s.away_projected) + ')'
-
-            message['attachments'].append({ 'text': matchup_string })
-
-            score_result = {
-                'winner': winner,
-                'loser': loser,
-                'winning_score': winning_score,
-                'losing_score': losing_score
-            }
-
-            if s.is_playoff:
-                score_result['winning_seed'] = winning_team.standing
-                score_result['losing_seed'] = losing_team.standing
-                score_result['consolation'] = s.matchup_type == 'LOSERS_CONSOLATION_LADDER'
-
-            if is_consolation_finals and score_result['consolation']:
-                score_result['championship'] = True
-                score_result['third_place'] = False
-
-            if is_finals and not score_result['consolation']:
-                if s.matchup_type == 'WINNERS_CONSOLATION_LADDER':
-                    score_result['championship'] = False
-                    score_result['third_place'] = True
-                else:
-                    score_result['championship'] = True
-                    score_result['third_place'] = False
-
-            matchups.append(score_result)
-
-        # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
-        database_key = { 'year': int(metadata.league_year), 'week': week }
-        # guarantee one record per year/week
-        mongo.db.scores.update_one(database_key, {
-            '$set': {
-                'year': int(metadata.league_year),
-                'week': week,
-                'matchups': matchups,
-                'playoffs': is_playoff,
-                'quarterfinals': is_quarterfinals,
-                'semifinals': is_semifinals,
-                'finals': is_finals,
-            },
-        }, upsert=True)
+        save_scores(scores, box_scores.is_final)
 
         return message
     def get(self):
         return Scoreboard.post(self)
 
+# A week's scores from ESPN's box scores, shaped like the scores collection saves them, plus one
+# attachment per matchup for the scoreboard; see save_scores for saving them.
+def build_scores(year, week, box_scores):
+    matchups = []
+    attachments = []
+
+    # which playoff round this is, if any, see facades/bracket.py
+    bracket = metadata.espn.bracket
+    playoff_round = bracket.round(week)
+
+    # every team's result, even for the games left off the scoreboard, see standings.py
+    results = []
+    for s in box_scores:
+        if not hasattr(s.home_team, 'owners') or not hasattr(s.away_team, 'owners'):
+            # a playoff bye, which ESPN counts as a win
+            for team, score in [ (s.home_team, s.home_score), (s.away_team, s.away_score) ]:
+                if hasattr(team, 'owners'):
+                    player_id = metadata.player_lookup_by_espn_owner_id[team.owners[0]['id']].player_id
+                    results.append({ 'player_id': player_id, 'points': score, 'outcome': 'BYE' })
+            continue
+
+        # TODO - This should support inserting co-owners
+        home_espn_id = s.home_team.owners[0]['id']
+        winner = metadata.player_lookup_by_espn_owner_id[home_espn_id].player_id
+        away_espn_id = s.away_team.owners[0]['id']
+        loser = metadata.player_lookup_by_espn_owner_id[away_espn_id].player_id
+        winning_score = s.home_score
+        losing_score = s.away_score
+        winning_team = s.home_team
+        losing_team = s.away_team
+        if (s.away_score > s.home_score):
+            winner = metadata.player_lookup_by_espn_owner_id[away_espn_id].player_id
+            loser = metadata.player_lookup_by_espn_owner_id[home_espn_id].player_id
+            winning_score = s.away_score
+            losing_score = s.home_score
+            winning_team = s.away_team
+            losing_team = s.home_team
+
+        is_tie = winning_score == losing_score
+        results.append({ 'player_id': winner, 'points': winning_score, 'outcome': 'T' if is_tie else 'W' })
+        results.append({ 'player_id': loser, 'points': losing_score, 'outcome': 'T' if is_tie else 'L' })
+
+        # leave off consolation games that don't matter anymore
+        if not bracket.counts(s, week):
+            continue
+
+        home_name = metadata.player_lookup_by_espn_owner_id[home_espn_id].display_name
+        matchup_string = home_name + ' - ' + str(s.home_score)
+        if (s.home_projected != -1 and not math.isclose(s.home_score, s.home_projected, abs_tol=0.01)):
+            matchup_string += ' (' + str(s.home_projected) + ')'
+
+        away_name = metadata.player_lookup_by_espn_owner_id[away_espn_id].display_name
+        matchup_string += ' versus ' + away_name + ' - ' + str(s.away_score)
+        if (s.away_projected != -1 and not math.isclose(s.away_score, s.away_projected, abs_tol=0.01)):
+            matchup_string += ' (' + str(s.away_projected) + ')'
+
+        attachments.append({ 'text': matchup_string })
+
+        score_result = {
+            'winner': winner,
+            'loser': loser,
+            'winning_score': winning_score,
+            'losing_score': losing_score
+        }
+
+        if s.is_playoff:
+            score_result['winning_seed'] = winning_team.standing
+            score_result['losing_seed'] = losing_team.standing
+            score_result['consolation'] = s.matchup_type == 'LOSERS_CONSOLATION_LADDER'
+
+        if playoff_round.is_consolation_finals and score_result['consolation']:
+            score_result['championship'] = True
+            score_result['third_place'] = False
+
+        if playoff_round.is_finals and not score_result['consolation']:
+            if s.matchup_type == 'WINNERS_CONSOLATION_LADDER':
+                score_result['championship'] = False
+                score_result['third_place'] = True
+            else:
+                score_result['championship'] = True
+                score_result['third_place'] = False
+
+        matchups.append(score_result)
+
+    scores = {
+        'year': int(year),
+        'week': int(week),
+        'matchups': matchups,
+        'results': results,
+        'playoffs': playoff_round.is_playoff,
+        'quarterfinals': playoff_round.is_quarterfinals,
+        'semifinals': playoff_round.is_semifinals,
+        'finals': playoff_round.is_finals,
+    }
+    return scores, attachments
+
+# Live scores are saved too, so the scoreboard has something to show, but anything built from a
+# week's scores is only built from final ones (see BoxScores.is_final in facades/espn.py).
+def save_scores(scores, is_final):
+    # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
+    database_key = { 'year': scores['year'], 'week': scores['week'] }
+    # guarantee one record per year/week
+    with BulkWriter(app, mongo.db.scores) as writer:
+        writer.upsert(database_key, scores)
+    if not is_final:
+        return writer.summary
+
+    # keep the head-to-head history up to date with this week's games, see head_to_head.py
+    update_head_to_head_week(scores)
+    # the tiebreakers' standings are added up from these, see standings.py; they're only
+    # built again once a week's final, not every time someone checks the live scores
+    metadata.broadcast_invalidation('scores')
+    # the season's podium (and last place) come from these games, so save how the season finished
+    # (see season_summaries.py), and anything built from it has to be built again, in every worker
+    playoff_round = metadata.espn.bracket.round(scores['week'])
+    if playoff_round.is_finals or playoff_round.is_consolation_finals:
+        update_season_summary(scores)
+        metadata.broadcast_invalidation('finals')
+    return writer.summary
+
+def build_freshness_string(fetched_at):
+    return 'as of ' + fetched_at.strftime('%I:%M%p on %A')
+
 @api.route('/scoreboard/matchupresults/')
 class MatchupResults(restful.Resource):
     def post(self):
@@ -175,68 +193,78 @@ class MatchupResults(restful.Resource):
         # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
         scores_result = mongo.db.scores.find_one({ 'year': int(metadata.league_year), 'week': int(metadata.last_league_week) })
 
-        winners = []
-        blowout_matchup_winner, blowout_matchup = '', ''
-        closest_matchup_winner, closest_matchup = '', ''
-        biggest_margin, smallest_margin = 0, 9999
-        highest_scorer, lowest_scorer = '', ''
-        high_score, low_score = 0, 9999
-
-        for matchup in scores_result['matchups']:
-            margin = matchup['winning_score'] - matchup['losing_score']
-            winner_name = metadata.player_lookup_by_id[matchup['winner']]['display_name']
-            loser_name = metadata.player_lookup_by_id[matchup['loser']]['display_name']
-
-            winners.append(winner_name)
-
-            if matchup['winning_score'] > high_score:
-                high_score = matchup['winning_score']
-                highest_scorer = winner_name
+        matchup_result = build_matchup_result(scores_result)
+        save_matchup_result(matchup_result)
 
-            if matchup['losing_score'] < low_score:
-                low_score = matchup['losing_score']
-                lowest_scorer = loser_name
-
-            if margin > biggest_margin:
-                biggest_margin = margin
-                blowout_matchup_winner = winner_name
-                blowout_matchup = winner_name + " versus " + loser_name
-
-            if margin < smallest_margin:
-                smallest_margin = margin
-                closest_matchup_winner = winner_name
-                closest_matchup = winner_name + " versus " + loser_name
-
-        # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
-        database_key = { 'year': metadata.league_year, 'week': metadata.last_league_week }
-        # guarantee one record per year/week
-        mongo.db.matchup_results.update_one(database_key, {
-            '$set': {
-                'winners': winners,
-                'blowout': blowout_matchup_winner,
-                'blowout_matchup': blowout_matchup,
-                'closest': closest_matchup_winner,
-                'closest_matchup': closest_matchup,
-                'highest': highest_scorer,
-                'lowest': lowest_scorer,
-                'high_score': str(high_score),
-                'low_score': str(low_score),
-                'year': metadata.league_year,
-                'week': metadata.last_league_week
-            },
-        }, upsert=True)
-
-        results_string = 'Matchup calculations for week ' + metadata.last_league_week + ' of ' + metadata.league_year + ':\n'
-        results_string += 'Winners: ' + ', '.join(winners) + '\n'
-        results_string += 'Blowout: ' + blowout_matchup
-        results_string += ' | Closest: ' + closest_matchup + '\n'
-        results_string += 'Highest: ' + highest_scorer + ', ' + str(high_score) + ' | '
-        results_string += 'Lowest: ' + lowest_scorer + ', ' + str(low_score)
-
-        return Response(results_string)
+        return Response(build_matchup_result_string(matchup_result))
     def get(self):
         return MatchupResults.post(self)
 
+# the week's winners, blowout, closest matchup, and highest and lowest scorers, from the week's scores
+def build_matchup_result(scores):
+    winners = []
+    blowout_matchup_winner, blowout_matchup = '', ''
+    closest_matchup_winner, closest_matchup = '', ''
+    biggest_margin, smallest_margin = 0, 9999
+    highest_scorer, lowest_scorer = '', ''
+    high_score, low_score = 0, 9999
+
+    for matchup in scores['matchups']:
+        margin = matchup['winning_score'] - matchup['losing_score']
+        winner_name = metadata.player_lookup_by_id[matchup['winner']].display_name
+        loser_name = metadata.player_lookup_by_id[matchup['loser']].display_name
+
+        winners.append(winner_name)
+
+        if matchup['winning_score'] > high_score:
+            high_score = matchup['winning_score']
+            highest_scorer = winner_name
+
+        if matchup['losing_score'] < low_score:
+            low_score = matchup['losing_score']
+            lowest_scorer = loser_name
+
+        if margin > biggest_margin:
+            biggest_margin = margin
+            blowout_matchup_winner = winner_name
+            blowout_matchup = winner_name + " versus " + loser_name
+
+        if margin < smallest_margin:
+            smallest_margin = margin
+            closest_matchup_winner = winner_name
+            closest_matchup = winner_name + " versus " + loser_name
+
+    # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
+    return {
+        'winners': winners,
+        'blowout': blowout_matchup_winner,
+        'blowout_matchup': blowout_matchup,
+        'closest': closest_matchup_winner,
+        'closest_matchup': closest_matchup,
+        'highest': highest_scorer,
+        'lowest': lowest_scorer,
+        'high_score': str(high_score),
+        'low_score': str(low_score),
+        'year': str(scores['year']),
+        'week': str(scores['week'])
+    }
+
+def save_matchup_result(matchup_result):
+    database_key = { 'year': matchup_result['year'], 'week': matchup_result['week'] }
+    # guarantee one record per year/week
+    with BulkWriter(app, mongo.db.matchup_results) as writer:
+        writer.upsert(database_key, matchup_result)
+    return writer.summary
+
+def build_matchup_result_string(matchup_result):
+    results_string = 'Matchup calculations for week ' + matchup_result['week'] + ' of ' + matchup_result['year'] + ':\n'
+    results_string += 'Winners: ' + ', '.join(matchup_result['winners']) + '\n'
+    results_string += 'Blowout: ' + matchup_result['blowout_matchup']
+    results_string += ' | Closest: ' + matchup_result['closest_matchup'] + '\n'
+    results_string += 'Highest: ' + matchup_result['highest'] + ', ' + matchup_result['high_score'] + ' | '
+    results_string += 'Lowest: ' + matchup_result['lowest'] + ', ' + matchup_result['low_score']
+    return results_string
+
 @api.route('/scoreboard/tiebreakers/')
 class Tiebreakers(restful.Resource):
     def post(self):
@@ -253,117 +281,90 @@ class Tiebreakers(restful.Resource):
 
         # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
         week = int(metadata.last_league_week)
-        week_before = week - 1
-        previous_standings = mongo.db.prediction_standings.find({ 'year': metadata.league_year, 'week': str(week_before) }) if week_before > 0 else []
+        previous_totals = find_prediction_totals(metadata.league_year, week - 1) if week > 1 else {}
         # TODO - return error if no prediction standings are found
-        current_standings = mongo.db.prediction_standings.find({ 'year': metadata.league_year, 'week': metadata.last_league_week })
-
-        last_week_of_regular_season = metadata.espn.weeks_in_regular_season
-        number_of_playoff_teams = metadata.espn.number_of_playoff_teams
-
-        is_playoff = week > last_week_of_regular_season
-        is_round_two = last_week_of_regular_season + 2 == week
-        is_round_three = last_week_of_regular_season + 3 == week
-        is_finals = is_round_three if (number_of_playoff_teams > 4) else is_round_two
-
-        previous_standings_lookup_by_username = {}
-        if week_before > 0:
-            for ps in previous_standings:
-                previous_standings_lookup_by_username[ps['username']] = ps
-
-        season_standings_to_sort = []
-        week_standings_to_sort = []
-        for team in current_standings:
-            total = team['total'] or 0
-            username = team['username']
-            espn_owner_id = metadata.player_lookup_by_username[username]['espn_owner_id']
-            espn_team = metadata.team_lookup_by_espn_owner_id[espn_owner_id]
-            team_wins = espn_team.wins
-            team_points = espn_team.points_for
-
-            # ESPN doesn't factor in playoff wins/points, so we have to add those ourselves
-            if is_playoff:
-                if last_week_of_regular_season + 1 <= week:
-                    index = last_week_of_regular_season
-                    outcome = espn_team.outcomes[index]
-                    # (bye weeks count as wins, and bye week points count)
-                    if (outcome == 'W' or outcome == 'U'):
-                        team_wins += 1
-                    team_points += espn_team.scores[index]
-                if last_week_of_regular_season + 2 <= week:
-                    index = last_week_of_regular_season + 1
-                    outcome = espn_team.outcomes[index]
-                    if (outcome == 'W' or outcome == 'U'):
-                        team_wins += 1
-                    team_points += espn_team.scores[index]
-                if last_week_of_regular_season + 3 <= week:
-                    index = last_week_of_regular_season + 2
-                    outcome = espn_team.outcomes[index]
-                    if (outcome == 'W' or outcome == 'U'):
-                        team_wins += 1
-                    team_points += espn_team.scores[index]
+        current_totals = find_prediction_totals(metadata.league_year, week)
+        message['attachments'] = build_tiebreaker_attachments(metadata.league_year, week, current_totals, previous_totals)
 
+        return message
+    def get(self):
+        return Tiebreakers.post(self)
+
+# Waiver order for the week after the given one (or the final draft order, after the finals), from
+# everyone's draft selection standings for the week and the week before, like { 'walker': 37, ... }
+def build_tiebreaker_attachments(year, week, current_totals, previous_totals):
+    attachments = []
+    week = int(week)
+
+    is_finals = metadata.espn.bracket.round(week).is_finals
+
+    # wins and points (playoffs included) from the scores we've saved, or from ESPN if any are missing
+    team_standings_by_id = team_standings(year, week)
+    standings_source = 'saved scores through week ' + str(week)
+    if team_standings_by_id is None:
+        team_standings_by_id = espn_team_standings(list(current_totals), week)
+        standings_source = 'ESPN ' + build_freshness_string(metadata.espn.fetched_at)
+
+    season_standings_to_sort = []
+    week_standings_to_sort = []
+    for username, total in current_totals.items():
+        total = total or 0
+        player = metadata.player_lookup_by_username[username]
+        team_wins = team_standings_by_id[player.player_id]['wins']
+        team_points = team_standings_by_id[player.player_id]['points']
+
+        if is_finals:
             season_standings_to_sort.append({
                     'username': username,
                     'total': total,
-                    'final_standing': espn_team.final_standing
+                    'final_standing': metadata.team_lookup_by_espn_owner_id[player.espn_owner_id].final_standing
                 })
 
-            if week_before > 0:
-                week_total = total - previous_standings_lookup_by_username[username]['total']
-                week_standings_to_sort.append({
-                        'username': username,
-                        'total': week_total,
-                        'wins': team_wins,
-                        'points': Decimal(team_points),
-                        'random': random.randint(0, 100)
-                    })
-            else:
-                week_standings_to_sort.append({
-                        'username': username,
-                        'total': total,
-                        'wins': team_wins,
-                        'points': Decimal(team_points),
-                        'random': random.randint(0, 100)
-                    })
-
-        if is_finals:
-            season_string = 'Final Draft Selection Standings for ' + metadata.league_year + ':\n'
-
-            for team in sorted(season_standings_to_sort, key=lambda t: (-t['total'], t['final_standing'])):
-                season_string += str(team['total']) + ' - ' + team['username']
-                if sum(t['total'] == team['total'] for t in season_standings_to_sort) > 1:
-                    if team['final_standing']:
-                        rank = team['final_standing']
-                        ordinal_suffix = ['th', 'st', 'nd', 'rd', 'th'][min(rank % 10, 4)]
-                        season_string += ' (finished ' + str(rank) + ordinal_suffix + ')'
-                season_string += '\n'
-
-            message['attachments'].append({ 'text': season_string })
-        else:
-            week_string = 'Week ' + metadata.league_week + ' Waiver Order:\n'
-
-            # break ties by least wins, then least points, then coin flip
-            for team in sorted(week_standings_to_sort, key=lambda t: (-t['total'], t['wins'], t['points'], t['random'])):
-                week_string += str(team['total']) + ' - ' + team['username']
-                if sum(t['total'] == team['total'] for t in week_standings_to_sort) > 1:
-                    week_string += ' (' + str(team['wins']) + ' wins'
+        week_standings_to_sort.append({
+                'username': username,
+                'total': total - previous_totals[username] if week > 1 else total,
+                'wins': team_wins,
+                'points': team_points
+            })
+
+    if is_finals:
+        season_string = 'Final Draft Selection Standings for ' + str(year) + ':\n'
+
+        # break ties by final standing in the league
+        for team in rank(season_standings_to_sort, [ Tiebreak('total', descending=True), Tiebreak('final_standing') ]):
+            season_string += str(team['total']) + ' - ' + team['username']
+            if 'total' in team['tied_on']:
+                if team['final_standing']:
+                    rank_in_league = team['final_standing']
+                    ordinal_suffix = ['th', 'st', 'nd', 'rd', 'th'][min(rank_in_league % 10, 4)]
+                    season_string += ' (finished ' + str(rank_in_league) + ordinal_suffix + ')'
+            season_string += '\n'
+
+        attachments.append({ 'text': season_string })
+    else:
+        week_string = 'Week ' + str(week + 1) + ' Waiver Order:\n'
+
+        # break ties by least wins, then least points, then coin flip (see ranking.py)
+        ranked = rank_with_coin_flip(week_standings_to_sort, [ Tiebreak('total', descending=True), Tiebreak('wins'), Tiebreak('points') ],
+            'waivers', year, week)
+        for team in ranked:
+            week_string += str(team['total']) + ' - ' + team['username']
+            if 'total' in team['tied_on']:
+                week_string += ' (' + str(team['wins']) + ' wins'
 
-                    if sum((t['total'], t['wins']) == (team['total'], team['wins']) for t in week_standings_to_sort) > 1:
-                        week_string += ', ' + str(round(team['points'], 2)) + ' points'
+                if 'wins' in team['tied_on']:
+                    week_string += ', ' + str(round(team['points'], 2)) + ' points'
 
-                    week_string += ')'
+                week_string += ')'
 
-                    number_of_remaining_teams = sum((t['total'], t['wins'], t['points']) == (team['total'], team['wins'], team['points']) for t in week_standings_to_sort)
-                    if number_of_remaining_teams > 1:
-                        week_string += '\n' + '***COIN FLIP TIEBREAKER APPLIED WITH RANDOM NUMBER***'
-                week_string += '\n'
+                if team['decided_by'] == COIN_FLIP:
+                    week_string += '\n' + '***COIN FLIP TIEBREAKER APPLIED WITH RANDOM NUMBER***'
+            week_string += '\n'
 
-            message['attachments'].append({ 'text': week_string })
+        attachments.append({ 'text': week_string })
 
-        return message
-    def get(self):
-        return Tiebreakers.post(self)
+    attachments[-1]['footer'] = 'Wins and points from ' + standings_source
+    return attachments
 
 @api.route('/scoreboard/tiebreakers/playoffs')
 class PlayoffTiebreakers(restful.Resource):
@@ -381,44 +382,42 @@ class PlayoffTiebreakers(restful.Resource):
 
         # TODO - there's a mix of string and int types stored for years and weeks, pick one (probably int)
         week = int(metadata.last_league_week)
-        last_week_of_regular_season = metadata.espn.weeks_in_regular_season
-
-        if week > last_week_of_regular_season:
+        if metadata.espn.bracket.round(week).is_playoff:
             return Response('Playoff tiebreaker calculations are not available after playoffs start.')
 
+        # wins and points from the scores we've saved, or from ESPN if any are missing (see standings.py)
+        team_standings_by_id = team_standings(metadata.league_year, week)
+        standings_source = 'saved scores through week ' + str(week)
+        if team_standings_by_id is None:
+            team_standings_by_id = espn_team_standings(metadata.usernames, week)
+            standings_source = 'ESPN ' + build_freshness_string(metadata.espn.fetched_at)
+
         standings_to_sort = []
         for username in metadata.usernames:
-            espn_owner_id = metadata.player_lookup_by_username[username]['espn_owner_id']
-            espn_team = metadata.team_lookup_by_espn_owner_id[espn_owner_id]
-            team_wins = espn_team.wins
-            team_points = espn_team.points_for
-
+            player_id = metadata.player_lookup_by_username[username].player_id
             standings_to_sort.append({
                     'username': username,
-                    'wins': team_wins,
-                    'points': Decimal(team_points),
-                    'random': random.randint(0, 100)
+                    'wins': team_standings_by_id[player_id]['wins'],
+                    'points': team_standings_by_id[player_id]['points']
                 })
 
         week_string = ''
 
-        # break ties by least wins, then least points, then coin flip
-        for team in sorted(standings_to_sort, key=lambda t: (-t['wins'], -t['points'], t['random'])):
+        # break ties by most points, then coin flip (see ranking.py)
+        ranked = rank_with_coin_flip(standings_to_sort, [ Tiebreak('wins', descending=True), Tiebreak('points', descending=True) ],
+            'playoff-seeding', metadata.league_year, week)
+        for team in ranked:
             week_string += str(team['wins']) + ' - ' + team['username']
-            if sum(t['wins'] == team['wins'] for t in standings_to_sort) > 1:
+            if 'wins' in team['tied_on']:
                 week_string += ' (' + str(team['wins']) + ' wins'
-
-                if sum((t['wins'], t['wins']) == (team['wins'], team['wins']) for t in standings_to_sort) > 1:
-                    week_string += ', ' + str(round(team['points'], 2)) + ' points'
-
+                week_string += ', ' + str(round(team['points'], 2)) + ' points'
                 week_string += ')'
 
-                number_of_remaining_teams = sum((t['wins'], t['wins'], t['points']) == (team['wins'], team['wins'], team['points']) for t in standings_to_sort)
-                if number_of_remaining_teams > 1:
+                if team['decided_by'] == COIN_FLIP:
                     week_string += '\n' + '***COIN FLIP TIEBREAKER APPLIED WITH RANDOM NUMBER***'
             week_string += '\n'
 
-        message['attachments'].append({ 'text': week_string })
+        message['attachments'].append({ 'text': week_string, 'footer': 'Wins and points from ' + standings_source })
 
         return message
     def get(self):
@@ -441,9 +440,12 @@ class Schedule(restful.Resource):
 
         if week_param:
             metadata.insert_matchup_data(int(week_param))
+            # this may have been this week's schedule, so don't wait for the week to roll over
+            metadata.broadcast_invalidation('week')
             return Response('Week ' + week_param + ' schedule submitted successfully.')
 
         metadata.insert_matchup_data()
+        metadata.broadcast_invalidation('week')
         return Response("Next week's schedule submitted successfully.")
 
     def get(self):
@@ -452,7 +454,8 @@ class Schedule(restful.Resource):
 @api.route('/scoreboard/invalidate/week')
 class InvalidateWeek(restful.Resource):
     def post(self):
-        metadata.invalidate_cached_week()
+        # clears this worker's caches now, and every other worker's within a few seconds
+        metadata.broadcast_invalidation('week')
         return Response("League week cache successfully invalidated.")
 
     def get(self):
@@ -461,7 +464,7 @@ class InvalidateWeek(restful.Resource):
 @api.route('/scoreboard/invalidate/year')
 class InvalidateYear(restful.Resource):
     def post(self):
-        metadata.invalidate_cached_year()
+        metadata.broadcast_invalidation('year')
         return Response("League year cache successfully invalidated.")
 
     def get(self):
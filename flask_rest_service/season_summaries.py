@@ -0,0 +1,92 @@
+import click
+from pymongo import DeleteMany, ReplaceOne
+from facades.bulk import BulkWriter
+# see __init__.py for these definitions
+from flask_rest_service import app, mongo, metadata
+
+# How every season finished, saved in the season_summaries collection with one record per year,
+# so the podium, last place and winnings are one read instead of a trip through every game:
+#
+# {
+#     '_id': 2022,
+#     'year': 2022,
+#     'champion': 'Walker', 'champion_score': 133.2,
+#     'runner_up': 'Renato', 'runner_up_score': 101.5,
+#     'third_place': 'Joel', 'third_place_score': 120.0,
+#     'fourth_place': 'Tom', 'fourth_place_score': 99.9,
+#     'last_place': 'Cathy', 'last_place_score': 71.4,
+# }
+#
+# Anything from a game that hasn't been played yet is missing. It's rebuilt from scores_per_matchup
+# with `flask rebuild-season-summaries`, and every time the scoreboard saves the final scores of a
+# finals (or consolation finals) week, that season is updated (see update_season_summary).
+
+# the games a season summary comes from, see season_fields
+FINALS_QUERIES = [
+    { 'consolation': False, 'championship': True, 'third_place': False },
+    { 'consolation': False, 'championship': False, 'third_place': True },
+    { 'consolation': True, 'championship': True },
+]
+
+# what a finals game (from scores_per_matchup, or something shaped like one) says about its season
+def season_fields(matchup):
+    if matchup.get('consolation'):
+        if matchup.get('championship'):
+            # the Breckfast Bowl
+            return { 'last_place': matchup['loser'], 'last_place_score': matchup['losing_score'] }
+    elif matchup.get('championship'):
+        return {
+            'champion': matchup['winner'], 'champion_score': matchup['winning_score'],
+            'runner_up': matchup['loser'], 'runner_up_score': matchup['losing_score'],
+        }
+    elif matchup.get('third_place'):
+        return {
+            'third_place': matchup['winner'], 'third_place_score': matchup['winning_score'],
+            'fourth_place': matchup['loser'], 'fourth_place_score': matchup['losing_score'],
+        }
+    return {}
+
+# every season, latest first
+def find_season_summaries():
+    ensure_season_summaries()
+    return list(mongo.db.season_summaries.find().sort('_id', -1))
+
+# so the history endpoints work before anyone's run the rebuild command
+def ensure_season_summaries():
+    if not mongo.db.season_summaries.find_one():
+        rebuild()
+
+# Called with a week's scores (just like the scores collection saves them, with player IDs), once
+# the scoreboard has the final scores for a finals or consolation finals week; those can be
+# different weeks, so this only sets what that week's games decided, and leaves the rest of the
+# season alone.
+def update_season_summary(scores):
+    fields = {}
+    for matchup in scores['matchups']:
+        fields.update(season_fields(dict(matchup,
+            winner=metadata.player_lookup_by_id[matchup['winner']].display_name,
+            loser=metadata.player_lookup_by_id[matchup['loser']].display_name)))
+
+    with BulkWriter(app, mongo.db.season_summaries) as writer:
+        if fields:
+            writer.upsert({ '_id': scores['year'] }, dict(fields, year=scores['year']))
+    return writer.summary
+
+def rebuild():
+    summaries = {}
+    for query in FINALS_QUERIES:
+        for matchup in mongo.db.scores_per_matchup.find(query):
+            year = int(matchup['year'])
+            summaries.setdefault(year, { '_id': year, 'year': year }).update(season_fields(matchup))
+
+    with BulkWriter(app, mongo.db.season_summaries) as writer:
+        for year, summary in summaries.items():
+            writer.add(ReplaceOne({ '_id': year }, summary, upsert=True))
+        writer.add(DeleteMany({ '_id': { '$nin': list(summaries) } }))
+    return summaries
+
+# Rebuilds every season from scratch. Run it with `flask rebuild-season-summaries`, see the readme.
+@app.cli.command('rebuild-season-summaries')
+def rebuild_season_summaries():
+    summaries = rebuild()
+    click.echo('Rebuilt season summaries for ' + str(len(summaries)) + ' seasons.')
@@ -0,0 +1,92 @@
+import threading
+from decimal import Decimal
+# see __init__.py for these definitions
+from flask_rest_service import app, mongo, metadata
+
+# Everyone's wins and points for the season so far, added up from the scores collection, so the
+# tiebreakers don't have to load the whole league from ESPN (or even be able to reach it).
+#
+# Since the scoreboard started saving them, each week in scores has a result for every team:
+#
+# 'results': [ { 'player_id': 3, 'points': 101.5, 'outcome': 'W' }, ... ]
+#
+# outcome is 'W', 'L', 'T', or 'BYE' for a playoff bye; like ESPN, a bye counts as a win, and the
+# points scored that week count. Games that don't show up in 'matchups' (the consolation ladder games
+# nobody cares about) are in here too, since ESPN counts them. Weeks saved before that only have
+# 'matchups', which is every game in the regular season, but misses byes and those consolation games;
+# so those are only used for the regular season, and a playoff week without results counts as missing.
+
+# a result for each team in a week's matchups, for weeks saved without results
+RESULTS_FROM_MATCHUPS = { '$concatArrays': [
+    { '$map': { 'input': '$matchups', 'as': 'm', 'in': {
+        'player_id': '$$m.winner',
+        'points': '$$m.winning_score',
+        'outcome': { '$cond': [ { '$eq': [ '$$m.winning_score', '$$m.losing_score' ] }, 'T', 'W' ] },
+    } } },
+    { '$map': { 'input': '$matchups', 'as': 'm', 'in': {
+        'player_id': '$$m.loser',
+        'points': '$$m.losing_score',
+        'outcome': { '$cond': [ { '$eq': [ '$$m.winning_score', '$$m.losing_score' ] }, 'T', 'L' ] },
+    } } },
+] }
+
+def standings_pipeline(year, week):
+    return [
+        { '$match': { 'year': int(year), 'week': { '$lte': int(week) },
+            '$or': [ { 'results': { '$exists': True } }, { 'playoffs': False } ] } },
+        { '$project': { 'week': 1, 'results': { '$ifNull': [ '$results', RESULTS_FROM_MATCHUPS ] } } },
+        { '$unwind': '$results' },
+        { '$group': {
+            '_id': '$results.player_id',
+            'wins': { '$sum': { '$cond': [ { '$in': [ '$results.outcome', [ 'W', 'BYE' ] ] }, 1, 0 ] } },
+            'points': { '$sum': '$results.points' },
+            'weeks': { '$addToSet': '$week' },
+        } },
+    ]
+
+# (year, week) -> (scores cache version, standings); only the latest few are kept around
+standings_cache = {}
+standings_cache_lock = threading.Lock()
+
+# Wins and points by player ID, through the given week, like { 3: { 'wins': 7, 'points': Decimal('1344.12') } };
+# None if any week of the season so far hasn't been saved (or is a playoff week saved without results),
+# since the standings would be wrong.
+# Cached until the scoreboard saves a week's final scores, see Metadata.cache_version.
+def team_standings(year, week):
+    key = (str(year), str(week))
+    version = metadata.cache_version('scores')
+    with standings_cache_lock:
+        cached = standings_cache.get(key)
+    if cached and version is not None and cached[0] == version:
+        return cached[1]
+
+    totals = list(mongo.db.scores.aggregate(standings_pipeline(year, week)))
+    weeks_saved = set().union(*[t['weeks'] for t in totals])
+    standings = None
+    if weeks_saved == set(range(1, int(week) + 1)):
+        # summed as floats, so round back to what ESPN shows, or equal totals might not come out equal
+        standings = { t['_id']: { 'wins': t['wins'], 'points': Decimal(str(round(t['points'], 2))) } for t in totals }
+
+    with standings_cache_lock:
+        standings_cache[key] = (version, standings)
+        # sorted as numbers, or week 10 would come before week 9
+        for old_key in sorted(standings_cache, key=lambda k: (int(k[0]), int(k[1])))[:-4]:
+            del standings_cache[old_key]
+    return standings
+
+# The same thing from ESPN, for when a week's scores were never saved: ESPN's record doesn't include
+# the playoffs, so those wins and points are added on from each team's outcomes.
+def espn_team_standings(usernames, week):
+    last_week_of_regular_season = metadata.espn.weeks_in_regular_season
+    standings = {}
+    for username in usernames:
+        player = metadata.player_lookup_by_username[username]
+        espn_team = metadata.team_lookup_by_espn_owner_id[player.espn_owner_id]
+        wins, points = espn_team.wins, espn_team.points_for
+        for index in range(last_week_of_regular_season, min(week, len(espn_team.outcomes))):
+            # (bye weeks count as wins, and bye week points count)
+            if espn_team.outcomes[index] in [ 'W', 'U' ]:
+                wins += 1
+            points += espn_team.scores[index]
+        standings[player.player_id] = { 'wins': wins, 'points': Decimal(points) }
+    return standings
@@ -0,0 +1,51 @@
+import click
+from flask import request, abort, Response
+import flask_restful as restful
+# see __init__.py for these definitions
+from flask_rest_service import app, api, mongo, metadata, outbox, indexes
+
+# These endpoints are for keeping an eye on the app itself, not the league
+@api.route('/status/outbox/')
+class OutboxStatus(restful.Resource):
+    def get(self):
+        return outbox.metrics()
+
+# for a load balancer (or a curious human) to see if this worker has its caches loaded yet
+@api.route('/status/ready/')
+class Readiness(restful.Resource):
+    def get(self):
+        caches = metadata.warm_caches
+        ready = all(caches.values())
+        return {
+            'ready': ready,
+            'warming_up': metadata.is_warming_up,
+            'caches': caches,
+            'last_warm_up': metadata.last_warm_up,
+        }, 200 if ready else 503
+
+# which of the app's queries (see facades/indexes.py) scan a whole collection, if any
+@api.route('/status/indexes/')
+class IndexStatus(restful.Resource):
+    def get(self):
+        queries = indexes.check_query_plans()
+        return {
+            'collection_scans': sum(1 for q in queries if q['collection_scan']),
+            'queries': queries,
+        }
+
+# Run these with `flask ensure-indexes` and `flask check-indexes`, see the readme.
+@app.cli.command('ensure-indexes')
+def ensure_indexes():
+    for result in indexes.ensure():
+        click.echo(result['status'] + ': ' + result['collection'] + ' ' + str(result['keys']) +
+            (' (' + result['error'] + ')' if result['status'] == 'error' else ''))
+
+@app.cli.command('check-indexes')
+def check_indexes():
+    queries = indexes.check_query_plans()
+    for query in queries:
+        click.echo(('COLLECTION SCAN' if query['collection_scan'] else 'ok') + ': ' + query['query'] +
+            ' on ' + query['collection'] + ' ' + str(query['stages']))
+    # so a deploy script can fail on it
+    if any(q['collection_scan'] for q in queries):
+        raise SystemExit(1)
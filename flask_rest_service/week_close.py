@@ -0,0 +1,198 @@
+import click
+from time import perf_counter
+from datetime import datetime
+from flask import request, Response
+import flask_restful as restful
+# see __init__.py for these definitions
+from flask_rest_service import app, api, mongo, metadata, deferred
+from flask_rest_service.scoreboard import (build_scores, save_scores, build_matchup_result, save_matchup_result,
+    build_matchup_result_string, build_tiebreaker_attachments)
+from flask_rest_service.predictions import calculate_predictions, find_prediction_totals
+
+# Closing out a week takes four steps, in order: save the final scores, work out the matchup results
+# from them, score everyone's predictions against those, then the waiver order (tiebreakers) from the
+# new standings. Each used to be its own command, and each read back what the one before it had just
+# saved. This runs all four in one go, handing each step's results straight to the next.
+#
+# Every week's run is saved in the pipeline_runs collection:
+#
+# {
+#     '_id': '2023-5',
+#     'year': '2023',
+#     'week': '5',
+#     'status': 'done',    # or 'waiting' (ESPN doesn't have final scores yet), or 'failed'
+#     'stages': {
+#         'scores': { 'status': 'done', 'seconds': 0.912, 'finished_at': ..., 'writes': { ... } },
+#         ...
+#     },
+#     'updated_at': ...
+# }
+#
+# Every step saves with upserts, so running a week again is safe; steps that are already done are read
+# back from the database instead of being run again (unless forced), so a run that stopped partway
+# picks up where it left off, even after the league's moved on to the next week. Every step works on
+# the year and week of the run, never whatever week it is now. Run it with /scoreboard/closeweek/
+# or `flask close-week`, see the readme.
+
+class WeekNotOver(Exception):
+    pass
+
+# each stage takes the state shared by the whole run, adds its results to it, and returns the
+# attachments to show for it, plus what it wrote (see BulkWriter.flush), if anything
+
+def run_scores(state):
+    box_scores = metadata.espn.final_box_scores(state['week'])
+    if not box_scores.is_final:
+        raise WeekNotOver("ESPN doesn't have final scores for week " + str(state['week']) + ' yet')
+    state['scores'], attachments = build_scores(state['year'], state['week'], box_scores)
+    return attachments, save_scores(state['scores'], box_scores.is_final)
+
+def load_scores(state):
+    state['scores'] = mongo.db.scores.find_one({ 'year': int(state['year']), 'week': state['week'] })
+
+def run_matchup_results(state):
+    state['matchup_result'] = build_matchup_result(state['scores'])
+    return [{ 'text': build_matchup_result_string(state['matchup_result']) }], save_matchup_result(state['matchup_result'])
+
+def load_matchup_results(state):
+    state['matchup_result'] = mongo.db.matchup_results.find_one({ 'year': state['year'], 'week': str(state['week']) })
+
+def run_predictions(state):
+    load_previous_totals(state)
+    attachments, state['totals'] = calculate_predictions(state['year'], state['week'], state['matchup_result'],
+        state['previous_totals'])
+    return attachments, None
+
+def load_predictions(state):
+    load_previous_totals(state)
+    state['totals'] = find_prediction_totals(state['year'], state['week'])
+
+def load_previous_totals(state):
+    state['previous_totals'] = find_prediction_totals(state['year'], state['week'] - 1) if state['week'] > 1 else {}
+
+def run_tiebreakers(state):
+    return build_tiebreaker_attachments(state['year'], state['week'], state['totals'], state['previous_totals']), None
+
+def load_tiebreakers(state):
+    pass
+
+# (name, what to call it in Slack, run, read back when it's already done)
+STAGES = [
+    ('scores', 'Final scores:', run_scores, load_scores),
+    ('matchup_results', 'Matchup results:', run_matchup_results, load_matchup_results),
+    ('predictions', 'Prediction calculations:', run_predictions, load_predictions),
+    ('tiebreakers', 'Tiebreakers (waivers by fewest wins/points, draft standings by most):', run_tiebreakers, load_tiebreakers),
+]
+
+# The scores and tiebreakers come from ESPN, which is only loaded for the league year we're on, so
+# only that season's weeks can be closed out; returns why a week can't be, or None if it can.
+def check_week(year, week):
+    if str(year) != metadata.league_year:
+        return 'Only weeks from ' + metadata.league_year + ' can be closed out, not ' + str(year) + '.'
+    if not str(week).isdigit() or int(week) < 1:
+        return str(week) + ' is not a week.'
+    return None
+
+def close_week(year, week, force=False):
+    year, week = str(year), str(int(week))
+    key = year + '-' + week
+    saved_run = mongo.db.pipeline_runs.find_one({ '_id': key }) or {}
+    done = set() if force else { name for name, stage in saved_run.get('stages', {}).items() if stage['status'] == 'done' }
+
+    state = { 'year': year, 'week': int(week) }
+    run = { 'year': year, 'week': week, 'status': 'done', 'stages': [], 'attachments': [] }
+    for name, pretext, run_stage, load_stage in STAGES:
+        started = perf_counter()
+        if name in done:
+            load_stage(state)
+            run['stages'].append({ 'stage': name, 'status': 'skipped', 'seconds': round(perf_counter() - started, 3) })
+            continue
+
+        stage = { 'status': 'done' }
+        try:
+            attachments, stage['writes'] = run_stage(state)
+            if attachments:
+                attachments[0]['pretext'] = pretext
+            run['attachments'] += attachments
+        except WeekNotOver as e:
+            stage.update(status='waiting', error=str(e))
+        except Exception as e:
+            app.logger.exception('could not close week stage=%s year=%s week=%s', name, year, week)
+            stage.update(status='failed', error=str(e))
+        stage['seconds'] = round(perf_counter() - started, 3)
+        stage['finished_at'] = datetime.now()
+
+        if stage['status'] != 'done':
+            run['status'] = stage['status']
+        elif name != STAGES[-1][0]:
+            run['status'] = 'running'
+        else:
+            run['status'] = 'done'
+        mongo.db.pipeline_runs.update_one({ '_id': key }, { '$set': {
+            'year': year,
+            'week': week,
+            'status': run['status'],
+            'stages.' + name: stage,
+            'updated_at': datetime.now(),
+        } }, upsert=True)
+        run['stages'].append(dict(stage, stage=name))
+        app.logger.info('close week stage=%s status=%s seconds=%.3f year=%s week=%s', name, stage['status'], stage['seconds'], year, week)
+
+        # every stage needs the one before it
+        if stage['status'] != 'done':
+            break
+    return run
+
+def build_timings_string(run):
+    return ', '.join(s['stage'] + ' ' + (s['status'] if s['status'] != 'done' else str(s['seconds']) + 's') +
+        (' (' + s['error'] + ')' if s.get('error') else '') for s in run['stages'])
+
+@api.route('/scoreboard/closeweek/')
+class CloseWeek(restful.Resource):
+    @deferred('close_week')
+    def post(self):
+        # for direct Slack commands, the parameters are in the text, like `/closeweek 5` for a week
+        # that was left partly closed out; it's last week otherwise
+        week = request.form.get('text', '').strip()
+        if not week:
+            # there's no week to close out until the first one is over
+            if metadata.league_week == '1':
+                return Response('Closing out a week is not available until the morning (8am) after Monday Night Football.')
+            week = metadata.last_league_week
+
+        error = check_week(metadata.league_year, week)
+        if error:
+            return Response(error)
+
+        run = close_week(metadata.league_year, week)
+        message = {
+            'response_type': 'in_channel',
+            'text': 'Week ' + run['week'] + ' of ' + run['year'] + (' closed out:' if run['status'] == 'done' else ' not closed out yet:'),
+            'attachments': run['attachments']
+        }
+        message['attachments'].append({ 'text': '', 'footer': build_timings_string(run) })
+        return message
+    def get(self):
+        return CloseWeek.post(self)
+
+# Closes out last week (or any week this season), or picks up where the last try left off.
+# Run it with `flask close-week`, see the readme.
+@app.cli.command('close-week')
+@click.option('--year', help='League year of the week to close out. Defaults to the current one.')
+@click.option('--week', help='Week to close out. Defaults to the last week that\'s over.')
+@click.option('--force', is_flag=True, help='Run every stage again, even the ones that are already done.')
+def close_week_command(year, week, force):
+    year = year or metadata.league_year
+    week = week or metadata.last_league_week
+    error = check_week(year, week)
+    if error:
+        raise click.UsageError(error)
+
+    run = close_week(year, week, force)
+    for attachment in run['attachments']:
+        if attachment.get('pretext'):
+            click.echo(attachment['pretext'])
+        click.echo(attachment.get('text', ''))
+    click.echo('Week ' + run['week'] + ' of ' + run['year'] + ': ' + run['status'] + ' (' + build_timings_string(run) + ')')
+    if run['status'] != 'done':
+        raise SystemExit(1)
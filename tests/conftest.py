@@ -0,0 +1,24 @@
+import os
+import bson
+import mongomock
+import pytest
+
+# The 2017 season, as dumped from the database (see archives-2017 in the root of the repo)
+ARCHIVE_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'archives-2017')
+
+def load_archive(collection_name):
+    with open(os.path.join(ARCHIVE_DIRECTORY, collection_name + '.bson'), 'rb') as f:
+        return bson.decode_all(f.read())
+
+@pytest.fixture(scope='session')
+def archive():
+    return { name: load_archive(name) for name in
+        [ 'league_metadata', 'matchup_metadata', 'matchup_results', 'predictions', 'prediction_standings' ] }
+
+# an empty stand-in for the database, for anything that saves as it goes (like coin flip seeds)
+@pytest.fixture
+def database(monkeypatch):
+    from flask_rest_service import mongo
+    db = mongomock.MongoClient().db
+    monkeypatch.setattr(mongo, 'db', db)
+    return db
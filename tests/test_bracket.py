@@ -0,0 +1,89 @@
+import itertools
+from types import SimpleNamespace
+import pytest
+from facades.bracket import SeasonBracket, WINNERS_CONSOLATION_LADDER, LOSERS_CONSOLATION_LADDER
+
+# The scoreboard and the prediction form each used to work out the playoff flags for a week, and
+# walk both teams' outcomes to decide whether a consolation game counts; SeasonBracket has to come
+# out the same. The old way is kept here to check it against.
+
+def old_flags(last_week_of_regular_season, number_of_teams_in_league, number_of_playoff_teams, week):
+    is_playoff = week > last_week_of_regular_season
+    is_round_one = last_week_of_regular_season + 1 == week
+    is_round_two = last_week_of_regular_season + 2 == week
+    is_round_three = last_week_of_regular_season + 3 == week
+    is_quarterfinals = number_of_playoff_teams > 4 and is_round_one
+    is_semifinals = is_round_two if (number_of_playoff_teams > 4) else is_round_one
+    is_finals = is_round_three if (number_of_playoff_teams > 4) else is_round_two
+    is_consolation_finals = is_semifinals if (number_of_teams_in_league < 12 and number_of_playoff_teams > 4) else is_finals
+    is_consolation_over = is_round_three and not is_consolation_finals
+    return {
+        'is_playoff': is_playoff,
+        'is_round_one': is_round_one,
+        'is_round_two': is_round_two,
+        'is_round_three': is_round_three,
+        'is_quarterfinals': is_quarterfinals,
+        'is_semifinals': is_semifinals,
+        'is_finals': is_finals,
+        'is_consolation_finals': is_consolation_finals,
+        'is_consolation_over': is_consolation_over,
+    }
+
+def old_counts(s, last_week_of_regular_season, flags):
+    winning_team, losing_team = s.home_team, s.away_team
+    if s.matchup_type == 'WINNERS_CONSOLATION_LADDER':
+        if flags['is_round_three']:
+            index_for_round_two = last_week_of_regular_season + 2 - 1
+            if winning_team.outcomes[index_for_round_two] == 'W' or losing_team.outcomes[index_for_round_two] == 'W':
+                return False
+        else:
+            return False
+
+    if s.matchup_type == 'LOSERS_CONSOLATION_LADDER':
+        if flags['is_consolation_over']:
+            return False
+
+        index_for_round_two = last_week_of_regular_season + 2 - 1
+        if flags['is_round_three']:
+            if winning_team.outcomes[index_for_round_two] == 'W' or losing_team.outcomes[index_for_round_two] == 'W':
+                return False
+
+        index_for_round_one = last_week_of_regular_season + 1 - 1
+        if not flags['is_round_one']:
+            if winning_team.outcomes[index_for_round_one] == 'W' or losing_team.outcomes[index_for_round_one] == 'W':
+                return False
+    return True
+
+# 2017's teams, with every week's win or loss from matchup_results; the archive doesn't have the
+# league settings, but with 16 weeks of results and three rounds of playoffs, the regular season
+# was 13 weeks
+def teams_2017(archive):
+    league = archive['league_metadata'][0]
+    # Bryant was Bernie for part of the season
+    aliases = { 'Bernie': 'Bryant' }
+    results = sorted(archive['matchup_results'], key=lambda r: int(r['week']))
+    winners_by_week = [{ aliases.get(w, w) for w in r['winners'] } for r in results]
+    return [SimpleNamespace(team_id=team_id, outcomes=[ 'W' if m['display_name'] in winners else 'L' for winners in winners_by_week ])
+        for team_id, m in enumerate(league['members'], start=1)]
+
+@pytest.mark.parametrize('number_of_teams', [ 10, 12, 14 ])
+@pytest.mark.parametrize('number_of_playoff_teams', [ 4, 6, 8 ])
+def test_bracket_matches_old_logic_for_2017(archive, number_of_teams, number_of_playoff_teams):
+    teams = teams_2017(archive)[:number_of_teams]
+    weeks = len(archive['matchup_results'])
+    last_week_of_regular_season = weeks - 3
+    settings = SimpleNamespace(reg_season_count=last_week_of_regular_season, team_count=number_of_teams,
+        playoff_team_count=number_of_playoff_teams)
+    bracket = SeasonBracket(settings, teams)
+
+    for week in range(1, weeks + 1):
+        flags = old_flags(last_week_of_regular_season, number_of_teams, number_of_playoff_teams, week)
+        playoff_round = bracket.round(week)
+        assert { name: getattr(playoff_round, name) for name in flags } == flags
+        # asked for as a string, like the scoreboard does, it's the same round
+        assert bracket.round(str(week)) is playoff_round
+
+        for matchup_type in [ 'NONE', WINNERS_CONSOLATION_LADDER, LOSERS_CONSOLATION_LADDER ]:
+            for home_team, away_team in itertools.permutations(teams, 2):
+                box_score = SimpleNamespace(matchup_type=matchup_type, home_team=home_team, away_team=away_team)
+                assert bracket.counts(box_score, week) == old_counts(box_score, last_week_of_regular_season, flags)
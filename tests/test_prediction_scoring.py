@@ -0,0 +1,137 @@
+import random
+from decimal import Decimal
+import numpy as np
+import pytest
+from flask_rest_service.prediction_form import get_picks, get_predicted_winners
+from flask_rest_service.prediction_scoring import WeekPicks, score_week, closest_to_pin
+from flask_rest_service.predictions import build_bonus_string
+
+# score_week has to come out exactly the same as scoring everyone one at a time did, which is kept
+# here (from before prediction_scoring.py) to check it against
+
+def is_picked(picks, name, result):
+    return bool(picks.get(name)) and result[name] in picks[name]
+
+def set_closest_to_pin_variables(candidate_winner, candidate_score, actual_score, current_winners, current_closest_score, current_winners_within_one_point):
+    candidate_score_decimal = Decimal(candidate_score)
+    actual_score_decimal = Decimal(actual_score)
+    candidate_distance_to_pin = abs(candidate_score_decimal - actual_score_decimal)
+    if candidate_distance_to_pin <= 1:
+        current_winners_within_one_point.append(candidate_winner)
+
+    if current_winners and current_closest_score:
+        current_closest_decimal = Decimal(current_closest_score)
+        current_distance_to_pin = abs(current_closest_decimal - actual_score_decimal)
+        if current_distance_to_pin == candidate_distance_to_pin:
+            current_winners.append(candidate_winner)
+            return (current_winners, current_closest_score, current_winners_within_one_point)
+        elif current_distance_to_pin > candidate_distance_to_pin:
+            return ([candidate_winner], candidate_score, current_winners_within_one_point)
+        else:
+            return (current_winners, current_closest_score, current_winners_within_one_point)
+    return ([candidate_winner], candidate_score, current_winners_within_one_point)
+
+def old_build_prediction_stats(predictions, result):
+    formula_by_user = {}
+    winners = { 'matchup': [], 'blowout': [], 'closest': [], 'highest': [], 'lowest': [] }
+    stats = {
+        'blowout_matchup': result.get('blowout_matchup', ''),
+        'closest_matchup': result.get('closest_matchup', ''),
+        'highest_pin_winners': [],
+        'highest_pin_score': '',
+        'highest_within_one_point': [],
+        'lowest_pin_winners': [],
+        'lowest_pin_score': '',
+        'lowest_within_one_point': []
+    }
+    actual_winners = result['winners']
+    for prediction in predictions:
+        username = prediction['username']
+        picks = get_picks(prediction)
+        user_formula = { 'username': username, 'matchup_total': 0, 'blowout_bonus': 0, 'closest_bonus': 0,
+            'highest_bonus': 0, 'lowest_bonus': 0 }
+
+        winners['matchup'] = get_predicted_winners(picks)
+        user_formula['matchup_total'] += len(set(winners['matchup']) & set(actual_winners))
+
+        if is_picked(picks, 'blowout', result) and result['blowout'] in winners['matchup']:
+            winners['blowout'].append(username)
+            user_formula['blowout_bonus'] += 1
+
+        if is_picked(picks, 'closest', result):
+            winners['closest'].append(username)
+            user_formula['closest_bonus'] += 1
+
+        if is_picked(picks, 'highest', result):
+            winners['highest'].append(username)
+            user_formula['highest_bonus'] += 1
+            if picks.get('high_score') is not None:
+                stats['highest_pin_winners'], stats['highest_pin_score'], stats['highest_within_one_point'] = (
+                    set_closest_to_pin_variables(username, picks['high_score'], result['high_score'], stats['highest_pin_winners'], stats['highest_pin_score'], stats['highest_within_one_point']))
+
+        if is_picked(picks, 'lowest', result):
+            winners['lowest'].append(username)
+            user_formula['lowest_bonus'] += 1
+            if picks.get('low_score') is not None:
+                stats['lowest_pin_winners'], stats['lowest_pin_score'], stats['lowest_within_one_point'] = (
+                    set_closest_to_pin_variables(username, picks['low_score'], result['low_score'], stats['lowest_pin_winners'], stats['lowest_pin_score'], stats['lowest_within_one_point']))
+
+        formula_by_user[username] = user_formula
+
+    # build_bonus_string used to hand out the closest-to-pin points while it was at it
+    for name in [ 'highest_pin_winners', 'highest_within_one_point' ]:
+        for username in stats[name]:
+            formula_by_user[username]['highest_bonus'] += 1
+    for name in [ 'lowest_pin_winners', 'lowest_within_one_point' ]:
+        for username in stats[name]:
+            formula_by_user[username]['lowest_bonus'] += 1
+    del winners['matchup']
+    return (formula_by_user, winners, stats)
+
+def weeks_of(archive):
+    predictions_by_week = {}
+    for prediction in archive['predictions']:
+        predictions_by_week.setdefault(prediction['week'], []).append(prediction)
+    return [(result, predictions_by_week.get(result['week'], []))
+        for result in sorted(archive['matchup_results'], key=lambda r: int(r['week']))]
+
+def assert_same_scoring(predictions, result):
+    expected = old_build_prediction_stats(predictions, result)
+    formula_by_user, winners, stats = score_week(WeekPicks.from_predictions(predictions, get_picks), result)
+    assert formula_by_user == expected[0]
+    assert winners == expected[1]
+    assert stats == expected[2]
+    assert build_bonus_string(winners, stats) == build_bonus_string(expected[1], expected[2])
+
+def test_score_week_matches_every_2017_week(archive):
+    weeks = weeks_of(archive)
+    assert len(weeks) == 16
+    for result, predictions in weeks:
+        assert_same_scoring(predictions, result)
+
+# the archive only has so many close guesses, so try it again with everyone's scores moved right
+# up against the pin: exact hits, ties, and guesses on either side of a point away
+def test_score_week_matches_2017_weeks_with_close_scores(archive):
+    shuffle = random.Random(2017)
+    for result, predictions in weeks_of(archive):
+        for _ in range(25):
+            close_predictions = []
+            for prediction in predictions:
+                prediction = dict(prediction)
+                for score in [ 'high_score', 'low_score' ]:
+                    actual = Decimal(result[score])
+                    prediction[score] = str(actual + shuffle.choice([ 0, 0, Decimal('0.5'), Decimal('-1'), Decimal('1'),
+                        Decimal('1.01'), Decimal('-0.99'), 2, -3 ]))
+                close_predictions.append(prediction)
+            assert_same_scoring(close_predictions, result)
+
+@pytest.mark.parametrize('scores, actual, expected', [
+    # ties all get the point, and the pin score is the first winner's guess as it was typed
+    ([ '100', '102', '102.0', '90' ], '101', (['a', 'b', 'c'], '100', ['a', 'b', 'c'])),
+    ([ '80.25', '80.3', None, '81.26' ], '80.26', (['a'], '80.25', ['a', 'b', 'd'])),
+    ([ 'NaN', 'nonsense', '', None ], '70', ([], '', [])),
+])
+def test_closest_to_pin(scores, actual, expected):
+    usernames = ['a', 'b', 'c', 'd']
+    candidates = np.array([ True ] * len(usernames))
+    assert closest_to_pin(usernames, candidates, scores, actual) == expected
@@ -0,0 +1,118 @@
+import random
+from decimal import Decimal
+from flask_rest_service.ranking import Tiebreak, rank, rank_with_coin_flip, COIN_FLIP
+
+# Every standings command used to sort with its own key (with a random number last) and count ties
+# by scanning the standings again for every team; rank has to order them the same way and report
+# the same ties. The old way is kept here to check it against, with its random numbers swapped for
+# the same coin flips rank draws, so even the coin flips have to come out the same.
+
+COIN_FLIP_SEED = 2017
+
+def coin_flips(rows, seed=COIN_FLIP_SEED):
+    coin = random.Random(seed)
+    return { username: coin.random() for username in sorted(row['username'] for row in rows) }
+
+def old_waiver_order(rows):
+    flips = coin_flips(rows)
+    order = []
+    for team in sorted(rows, key=lambda t: (-t['total'], t['wins'], t['points'], flips[t['username']])):
+        order.append((team['username'],
+            sum(t['total'] == team['total'] for t in rows) > 1,
+            sum((t['total'], t['wins']) == (team['total'], team['wins']) for t in rows) > 1,
+            sum((t['total'], t['wins'], t['points']) == (team['total'], team['wins'], team['points']) for t in rows) > 1))
+    return order
+
+def waiver_order(rows):
+    ranked = rank(rows, [ Tiebreak('total', descending=True), Tiebreak('wins'), Tiebreak('points') ], coin_flip_seed=COIN_FLIP_SEED)
+    return [(team['username'], 'total' in team['tied_on'], 'wins' in team['tied_on'], team['decided_by'] == COIN_FLIP)
+        for team in ranked]
+
+def old_playoff_seeding(rows):
+    flips = coin_flips(rows)
+    order = []
+    for team in sorted(rows, key=lambda t: (-t['wins'], -t['points'], flips[t['username']])):
+        order.append((team['username'],
+            sum(t['wins'] == team['wins'] for t in rows) > 1,
+            sum((t['wins'], t['points']) == (team['wins'], team['points']) for t in rows) > 1))
+    return order
+
+def playoff_seeding(rows):
+    ranked = rank(rows, [ Tiebreak('wins', descending=True), Tiebreak('points', descending=True) ], coin_flip_seed=COIN_FLIP_SEED)
+    return [(team['username'], 'wins' in team['tied_on'], team['decided_by'] == COIN_FLIP) for team in ranked]
+
+def old_final_standings(rows):
+    return [(team['username'], sum(t['total'] == team['total'] for t in rows) > 1)
+        for team in sorted(rows, key=lambda t: (-t['total'], t['final_standing']))]
+
+def final_standings(rows):
+    ranked = rank(rows, [ Tiebreak('total', descending=True), Tiebreak('final_standing') ])
+    return [(team['username'], 'total' in team['tied_on']) for team in ranked]
+
+# Everyone's draft selection points for each week of 2017 (from prediction_standings), with their
+# team's wins so far (from matchup_results); the archive doesn't have points for, so those are made
+# up, from only a few values so plenty of teams are tied all the way down to the coin flip.
+def weekly_standings(archive, points_choices):
+    league = archive['league_metadata'][0]
+    display_names = { m['slack_username']: m['display_name'] for m in league['members'] }
+    # Bryant was Bernie for part of the season
+    aliases = { 'Bernie': 'Bryant' }
+    results = sorted(archive['matchup_results'], key=lambda r: int(r['week']))
+    totals = { (s['username'], int(s['week'])): s['total'] for s in archive['prediction_standings'] }
+
+    shuffle = random.Random(COIN_FLIP_SEED)
+    wins = { name: 0 for name in display_names.values() }
+    for result in results:
+        week = int(result['week'])
+        for winner in result['winners']:
+            wins[aliases.get(winner, winner)] += 1
+        yield [{
+            'username': username,
+            'total': totals[(username, week)] - totals.get((username, week - 1), 0),
+            'wins': wins[display_names[username]],
+            'points': Decimal(shuffle.choice(points_choices)),
+        } for username in sorted(display_names)]
+
+def test_waiver_order_matches_old_sort_every_2017_week(archive):
+    tied_all_the_way = 0
+    for rows in weekly_standings(archive, [ '1201.5', '1201.5', '1187.25', '1187.3' ]):
+        assert waiver_order(rows) == old_waiver_order(rows)
+        tied_all_the_way += sum(coin for _, _, _, coin in waiver_order(rows))
+    # otherwise this isn't checking the coin flips at all
+    assert tied_all_the_way
+
+def test_playoff_seeding_matches_old_sort_every_2017_week(archive):
+    for rows in weekly_standings(archive, [ '1201.5', '1187.25', '1187.25' ]):
+        assert playoff_seeding(rows) == old_playoff_seeding(rows)
+
+def test_final_standings_match_old_sort_every_2017_week(archive):
+    shuffle = random.Random(COIN_FLIP_SEED)
+    for rows in weekly_standings(archive, [ '0' ]):
+        final_standings_by_username = dict(zip([r['username'] for r in rows], shuffle.sample(range(1, len(rows) + 1), len(rows))))
+        rows = [dict(row, final_standing=final_standings_by_username[row['username']]) for row in rows]
+        assert final_standings(rows) == old_final_standings(rows)
+
+def test_rank_keeps_ties_in_order_without_a_coin_flip():
+    rows = [{ 'username': name, 'total': 3 } for name in [ 'tom', 'cathy', 'joel' ]]
+    ranked = rank(rows, [ Tiebreak('total', descending=True) ])
+    assert [r['username'] for r in ranked] == [ 'tom', 'cathy', 'joel' ]
+    assert all(r['tied_on'] == [ 'total' ] and r['decided_by'] is None for r in ranked)
+
+def test_rank_with_coin_flip_only_draws_a_seed_for_a_tie(database):
+    rows = [{ 'username': 'tom', 'total': 3 }, { 'username': 'cathy', 'total': 2 }]
+    ranked = rank_with_coin_flip(rows, [ Tiebreak('total', descending=True) ], 'waivers', 2017, 5)
+    assert [r['decided_by'] for r in ranked] == [ 'total', 'total' ]
+    assert database.coin_flips.count_documents({}) == 0
+
+def test_rank_with_coin_flip_reuses_the_week_seed(database):
+    rows = [{ 'username': name, 'total': 3 } for name in [ 'tom', 'cathy', 'joel', 'kevin', 'mike' ]]
+    first = rank_with_coin_flip(rows, [ Tiebreak('total', descending=True) ], 'waivers', 2017, 5)
+    # the same people in a different order still flip the same way
+    again = rank_with_coin_flip(list(reversed(rows)), [ Tiebreak('total', descending=True) ], 'waivers', '2017', '5')
+    assert [r['username'] for r in first] == [r['username'] for r in again]
+    assert all(r['decided_by'] == COIN_FLIP for r in first)
+
+    record = database.coin_flips.find_one()
+    assert record['_id'] == 'waivers-2017-5'
+    assert [r['username'] for r in first] == [r['username'] for r in rank(rows, [ Tiebreak('total', descending=True) ],
+        coin_flip_seed=record['seed'])]